@@ -1,9 +1,15 @@
 import dash
-from dash import dcc, html, Input, Output
+from dash import dcc, html, Input, Output, ClientsideFunction
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
 import pytz
 import os
+import threading
+import time
+
+from stations import load_cities
 
 # Initialize Dash app
 app = dash.Dash(__name__)
@@ -11,18 +17,64 @@ app.title = "Weather Forecast"
 server = app.server  # This is needed for gunicorn
 
 # Backend API URL
-BACKEND_URL = "your_app_url_here"
+BACKEND_URL = os.environ.get("BACKEND_URL", "your_app_url_here")
+
+# One pooled session per worker: connections to the backend are kept alive,
+# idempotent GETs are retried on gateway errors, and every call is bounded by
+# a (connect, read) timeout so a hung backend can't block a worker
+BACKEND_TIMEOUT = (float(os.environ.get("BACKEND_CONNECT_TIMEOUT", 3.05)),
+                   float(os.environ.get("BACKEND_READ_TIMEOUT", 10)))
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_maxsize=16, max_retries=Retry(
+    total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504], allowed_methods=["GET"])))
+session.mount("https://", session.get_adapter("http://"))
+
+# Backend responses, reused for WEATHER_CACHE_TTL seconds and then
+# revalidated with their ETag, so an unchanged forecast costs a bodiless 304
+# (the backend forecasts only change once an hour). Errors are never cached.
+WEATHER_CACHE_TTL = float(os.environ.get("WEATHER_CACHE_TTL", 60))
+weather_cache = {}  # path -> (fetched_at, etag, data)
+weather_cache_lock = threading.Lock()
+
+def fresh_weather(path):
+    with weather_cache_lock:
+        entry = weather_cache.get(path)
+    if entry is not None and time.monotonic() - entry[0] < WEATHER_CACHE_TTL:
+        return entry[2]
+    return None
+
+def get_backend_json(path):
+    data = fresh_weather(path)
+    if data is not None:
+        return data
+    with weather_cache_lock:
+        entry = weather_cache.get(path)
+    headers = {"If-None-Match": entry[1]} if entry is not None and entry[1] else {}
+    response = session.get(f"{BACKEND_URL}{path}", headers=headers, timeout=BACKEND_TIMEOUT)
+    if response.status_code == 304 and entry is not None:
+        data = entry[2]
+    else:
+        response.raise_for_status()
+        data = response.json()
+    with weather_cache_lock:
+        weather_cache[path] = (time.monotonic(), response.headers.get("ETag"), data)
+    return data
 
 # Helper function to fetch weather data from the backend
 def fetch_weather_data(city):
+    city = city.lower()
+    prefetched = fresh_weather("/weather/all")
+    if prefetched is not None and city in prefetched:
+        return prefetched[city]
     try:
-        response = requests.get(f"{BACKEND_URL}/weather/{city}")
-        response.raise_for_status()
-        data = response.json()
-        return data
+        return get_backend_json(f"/weather/{city}")
     except requests.exceptions.RequestException as e:
         return {"error": f"Error fetching data: {str(e)}"}
 
+# Forecasts of every city in one backend call, keyed by lowercase city
+def fetch_all_weather_data():
+    return get_backend_json("/weather/all")
+
 # Helper function to determine appropriate icon based on condition and day/night status
 def get_weather_icon(condition, is_day):
     if condition == "clear":
@@ -44,6 +96,19 @@ def get_current_time():
     tz = pytz.timezone("GMT")
     return datetime.now(tz)
 
+# Every PREFETCH_SECONDS the page prefetches all cities into a browser-side
+# store, so switching cities renders from that store without a backend call
+PREFETCH_SECONDS = int(os.environ.get("PREFETCH_SECONDS", 60))
+
+# Backend URL the browser subscribes to for pushed forecasts
+# (assets/forecast_stream.js): BACKEND_URL when set, else the local backend;
+# empty to rely on the prefetch alone
+STREAM_URL = os.environ.get("STREAM_URL", os.environ.get("BACKEND_URL", "http://localhost:8080"))
+
+# Cities of the dropdown, the same cities.json (or CITIES_CONFIG) the
+# backend serves, first city selected
+CITY_NAMES = [city["name"].title() for city in load_cities()]
+
 # App layout
 app.layout = html.Div(
     children=[
@@ -54,12 +119,8 @@ app.layout = html.Div(
                 html.Div(id="current-time-display", className="current-time"),
                 dcc.Dropdown(
                     id="city-dropdown",
-                    options=[
-                        {"label": "Colchester", "value": "Colchester"},
-                        {"label": "London", "value": "London"},
-                        {"label": "Bristol", "value": "Bristol"},
-                    ],
-                    value="Colchester",
+                    options=[{"label": name, "value": name} for name in CITY_NAMES],
+                    value=CITY_NAMES[0],
                     placeholder="Select a city...",
                     className="dropdown",
                 ),
@@ -68,6 +129,10 @@ app.layout = html.Div(
         ),
         # Weather display content in a responsive container
         html.Div(id="weather-display", className="weather-section"),
+        dcc.Store(id="weather-store"),
+        dcc.Interval(id="prefetch-interval", interval=PREFETCH_SECONDS * 1000, n_intervals=0),
+        dcc.Store(id="stream-url", data=STREAM_URL),
+        dcc.Store(id="stream-status"),
 
         # Footer Section
         html.Div(
@@ -92,14 +157,38 @@ def update_current_time(city):
     current_time = get_current_time()
     return f"{current_time.strftime('%I:%M %p %Z')}"
 
+# Callback to prefetch the forecasts of all cities, on page load and then
+# every PREFETCH_SECONDS; a failed prefetch keeps the previous data
+@app.callback(
+    Output("weather-store", "data"),
+    [Input("prefetch-interval", "n_intervals")]
+)
+def prefetch_weather(n_intervals):
+    try:
+        return fetch_all_weather_data()
+    except requests.exceptions.RequestException:
+        return dash.no_update
+
+# Browser-side callback subscribing to the forecast stream, which then
+# writes new forecasts into the weather store as they are issued
+app.clientside_callback(
+    ClientsideFunction(namespace="weather", function_name="subscribe"),
+    Output("stream-status", "data"),
+    [Input("stream-url", "data")]
+)
+
 # Callback to update weather display
 @app.callback(
     Output("weather-display", "children"),
-    [Input("city-dropdown", "value")]
+    [Input("city-dropdown", "value"), Input("weather-store", "data")]
 )
-def update_weather_display(city):
-    # Fetch weather data
-    weather_data = fetch_weather_data(city)
+def update_weather_display(city, prefetched):
+    if not city:
+        return html.Div("Select a city to see its forecast.", className="error-message")
+    # Render from the prefetched data, or fetch this city if it isn't there yet
+    weather_data = (prefetched or {}).get(city.lower())
+    if weather_data is None:
+        weather_data = fetch_weather_data(city)
     if "error" in weather_data:
         return html.Div(weather_data["error"], className="error-message")
 
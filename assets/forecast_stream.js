@@ -0,0 +1,19 @@
+// Keeps the weather store current from the backend's forecast stream
+// (/weather/stream): every event holds the new forecasts of one or more
+// cities, merged into the store so the display re-renders without polling.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    weather: {
+        subscribe: function (streamUrl) {
+            if (!streamUrl || window.weatherStream || typeof EventSource === "undefined") {
+                return window.dash_clientside.no_update;
+            }
+            var forecasts = {};
+            window.weatherStream = new EventSource(streamUrl + "/weather/stream");
+            window.weatherStream.addEventListener("forecast", function (event) {
+                Object.assign(forecasts, JSON.parse(event.data));
+                window.dash_clientside.set_props("weather-store", {data: Object.assign({}, forecasts)});
+            });
+            return streamUrl;
+        }
+    }
+});
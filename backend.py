@@ -1,4 +1,5 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import requests
 import pandas as pd
@@ -6,11 +7,24 @@ import numpy as np
 from joblib import load
 import joblib
 from datetime import datetime
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
 
 import pandas as pd
+import os
+import secrets
 from retry_requests import retry
-from google.cloud import bigquery
-from google.auth import default
+
+import metrics
+from forecast_cache import ForecastCache
+from forecast_responses import EncodedForecast, combine, encode_json, respond
+from forecast_stream import ForecastBroadcaster
+from forecasting import (PREDICTORS, WINDOW_SIZE, blend_forecasts, categorize_weather, forecast_weather,
+                         forecast_weather_batch, model_timings, observation_time, stage_seconds, window_frame)
+from stations import StationIndex, idw_weights, load_cities as load_city_config
+from storage import CITIES, get_storage
 
 # Initialize FastAPI app
 app = FastAPI()
@@ -22,255 +36,297 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# import os
-# os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "bigquery-key.json"
-# #Initialize BigQuery Client
-# bq_client = bigquery.Client()
-
-# Use default credentials from the environment
-credentials, project_id = default()
-bq_client = bigquery.Client(credentials=credentials, project=project_id)
-
-# Define BigQuery table references
-PROJECT_ID = "gcp_project_id_here"
-DATASET_ID = "weather_data"
-TABLES = {
-    "colchester": f"{PROJECT_ID}.{DATASET_ID}.colchester",
-    "london": f"{PROJECT_ID}.{DATASET_ID}.london",
-    "bristol": f"{PROJECT_ID}.{DATASET_ID}.bristol",
-}
-
-def load_data(table_name):
-    query = f"""
-    SELECT *
-    FROM `{table_name}`
-    """
-    query_job = bq_client.query(query)
-    results = query_job.result()
-    table = results.to_arrow()  # Use Arrow for conversion
-    data = table.to_pandas()
-    data = data.iloc[len(data.index)-5 : ].reset_index(drop = True)
-    data["is_day"] = data["is_day"].astype(int)
-    return data
+# Every request is timed per stage: totals go to the histograms served on
+# /metrics and each response lists its own stages in a Server-Timing header
+# (see metrics.py). METRICS_ENABLED=0 switches the timers off.
+app.add_middleware(metrics.TimingMiddleware)
+cache_requests = metrics.Counter("weather_cache_requests_total", "Forecast lookups answered from memory or refreshed",
+                                 ["result"])
+
+# Observations are read through the storage selected by WEATHER_STORAGE
+# (BigQuery by default, see storage.py)
+storage = get_storage()
+
+# Per-city ring buffers with the most recent observations, topped up with
+# rows newer than the last one held instead of re-reading the whole table.
+# Rows rewritten in place (buffer replays, backfills) keep their time, so a
+# top-up can't see them: reset_windows drops the buffers of cities whose
+# observations were written, and the next read starts over.
+city_windows = {}
+city_window_locks = defaultdict(threading.Lock)
+
+def reset_windows(cities):
+    for city in cities:
+        with city_window_locks[city]:
+            city_windows.pop(city, None)
+
+# Current windows of several cities, refreshed with a single storage read.
+# Cities with fewer than WINDOW_SIZE observations yet are left out.
+def load_windows(cities):
+    locks = [city_window_locks[city] for city in sorted(set(cities))]
+    for lock in locks:
+        lock.acquire()
+    try:
+        last_rows = {}
+        for city in cities:
+            window = city_windows.setdefault(city, deque(maxlen=WINDOW_SIZE))
+            last_rows[city] = window[-1] if window else None
+        with metrics.stage("storage", stage_seconds, stage="storage"):
+            new_rows = storage.read_latest(last_rows, WINDOW_SIZE)
+        for city, rows in new_rows.items():
+            city_windows[city].extend(rows)
+        windows = {city: list(city_windows[city]) for city in cities}
+    finally:
+        for lock in locks:
+            lock.release()
+    return {city: window_frame(rows) for city, rows in windows.items() if len(rows) >= WINDOW_SIZE}
+
+def load_data(city):
+    windows = load_windows([city])
+    if city not in windows:
+        raise ValueError(f"Not enough observations for {city} yet")
+    return windows[city]
 
 # Replace CSV loading with BigQuery data fetching
-# colchester_weather = load_data(TABLES['colchester'])
-# london_weather = load_data(TABLES['london'])
-# bristol_weather = load_data(TABLES['bristol'])
-
-
-temperature_model = joblib.load('Models/temperature_model.joblib')
-rain_model = joblib.load('Models/rain_model.joblib')
-cloud_model = joblib.load('Models/cloud_cover_model.joblib')
-windspeed_model = joblib.load('Models/wind_model.joblib')
-snow_model = joblib.load('Models/snow_model.joblib')
-x_scaler_cloud = joblib.load('Scalers/x_scaler_cloud.joblib')
-y_scaler_cloud = joblib.load('Scalers/y_scaler_cloud.joblib')
-x_scaler_rain = joblib.load('Scalers/x_scaler_rain.joblib')
-y_scaler_rain = joblib.load('Scalers/y_scaler_rain.joblib')
-x_scaler_snow = joblib.load('Scalers/x_scaler_snow.joblib')
-y_scaler_snow = joblib.load('Scalers/y_scaler_snow.joblib')
-x_scaler_temperature = joblib.load('Scalers/x_scaler_temperature.joblib')
-y_scaler_temperature = joblib.load('Scalers/y_scaler_temperature.joblib')
-x_scaler_wind = joblib.load('Scalers/x_scaler_wind.joblib')
-y_scaler_wind = joblib.load('Scalers/y_scaler_wind.joblib')
-
-def predict_temp(data):
-    data = data[['temperature_2m', 'apparent_temperature', 'showers', 'cloud_cover', 'wind_speed_10m', 'month',
-                 'day', 'cluster']]
-
-    lagged_data = data.copy()
-    for lag in range(1, 2):  # Create lags
-        for col in data.columns:
-            lagged_data[f'{col}_lag_{lag}'] = data[col].shift(lag)
-
-    for lag in range(1, 6):
-        lagged_data[f'future_temp_{lag}'] = lagged_data['temperature_2m'].shift(-lag)
-        
-    x = lagged_data.drop(['future_temp_1', 'future_temp_2', 'future_temp_3', 'future_temp_4', 'future_temp_5'], axis = 1)
-    x = pd.DataFrame([x.iloc[-1]]).reset_index(drop = True)
-    x = x_scaler_temperature.transform(x)
-    
-    pred = temperature_model.predict(x)
-    pred = y_scaler_temperature.inverse_transform(pred)
-    
-    list_data = pred.tolist()[0]
-    list_data = [round(x) for x in list_data]
-    return list_data
-
-def predict_rain(data):
-    data = data[['precipitation', 'apparent_temperature', 'showers', 'pressure_msl', 'cloud_cover', 'wind_direction_10m',
-          'wind_gusts_10m', 'is_day', 'month', 'day', 'cluster']]
-
-    lagged_data = data.copy()
-    for lag in range(1, 3):  # Create lags
-        for col in data.columns:
-            lagged_data[f'{col}_lag_{lag}'] = data[col].shift(lag)
-
-    for lag in range(1, 6):
-        lagged_data[f'future_rain_{lag}'] = lagged_data['precipitation'].shift(-lag)
-        
-    x = lagged_data.drop(['future_rain_1', 'future_rain_2', 'future_rain_3', 'future_rain_4', 'future_rain_5'], axis = 1)
-    x = pd.DataFrame([x.iloc[-1]]).reset_index(drop = True)
-    x = x_scaler_rain.transform(x)
-    
-    pred = rain_model.predict(x)
-    pred = y_scaler_rain.inverse_transform(pred)
-    
-    list_data = pred.tolist()[0]
-    list_data = [x if x >= 0 else 0 for x in list_data]
-    list_data = [round(x, 1) for x in list_data]
-    return list_data
-
-def predict_snow(data):
-    data = data[['snowfall', 'precipitation']]
-
-    lagged_data = data.copy()
-    for lag in range(1, 2):  # Create lags
-        for col in data.columns:
-            lagged_data[f'{col}_lag_{lag}'] = data[col].shift(lag)
-
-    for lag in range(1, 6):
-        lagged_data[f'future_snow_{lag}'] = lagged_data['snowfall'].shift(-lag)
-        
-    x = lagged_data.drop(['future_snow_1', 'future_snow_2', 'future_snow_3', 'future_snow_4', 'future_snow_5'], axis = 1)
-    x = pd.DataFrame([x.iloc[-1]]).reset_index(drop = True)
-    x = x_scaler_snow.transform(x)
-    
-    pred = snow_model.predict(x)
-    pred = y_scaler_snow.inverse_transform(pred)
-    
-    list_data = pred.tolist()[0]
-    list_data = [x if x >= 0 else 0 for x in list_data]
-    list_data = [round(x, 1) for x in list_data]
-    return list_data
-
-def predict_cloud_cover(data):
-    data = data[['cloud_cover', 'temperature_2m', 'relative_humidity_2m', 'apparent_temperature', 'precipitation', 'rain',
-          'showers', 'snowfall', 'pressure_msl', 'wind_speed_10m', 'wind_direction_10m', 'wind_gusts_10m', 'is_day',
-          'month', 'day', 'hour', 'cluster']]
-
-    lagged_data = data.copy()
-    for lag in range(1, 2):  # Create lags
-        for col in data.columns:
-            lagged_data[f'{col}_lag_{lag}'] = data[col].shift(lag)
-
-    for lag in range(1, 6):
-        lagged_data[f'future_cloud_{lag}'] = lagged_data['cloud_cover'].shift(-lag)
-        
-    x = lagged_data.drop(['future_cloud_1', 'future_cloud_2', 'future_cloud_3', 'future_cloud_4', 'future_cloud_5'], axis = 1)
-    x = pd.DataFrame([x.iloc[-1]]).reset_index(drop = True)
-    x = x_scaler_cloud.transform(x)
-    
-    pred = cloud_model.predict(x)
-    pred = y_scaler_cloud.inverse_transform(pred)
-    
-    list_data = pred.tolist()[0]
-    list_data = [x if x >= 0 else 0 for x in list_data]
-    list_data = [round(x) for x in list_data]
-    return list_data
-
-def predict_windspeed(data):
-    data = data[['wind_speed_10m', 'temperature_2m', 'apparent_temperature', 'precipitation', 'rain', 'showers', 'snowfall',
-          'pressure_msl', 'surface_pressure', 'cloud_cover', 'wind_direction_10m', 'wind_gusts_10m', 'is_day', 'month', 'day',
-          'hour', 'cluster']]
-
-    lagged_data = data.copy()
-    for lag in range(1, 2):  # Create lags
-        for col in data.columns:
-            lagged_data[f'{col}_lag_{lag}'] = data[col].shift(lag)
-
-    for lag in range(1, 6):
-        lagged_data[f'future_windspeed_{lag}'] = lagged_data['wind_speed_10m'].shift(-lag)
-        
-    x = lagged_data.drop(['future_windspeed_1', 'future_windspeed_2', 'future_windspeed_3', 'future_windspeed_4',
-                          'future_windspeed_5'], axis = 1)
-    x = pd.DataFrame([x.iloc[-1]]).reset_index(drop = True)
-    x = x_scaler_wind.transform(x)
-    
-    pred = windspeed_model.predict(x)
-    pred = y_scaler_wind.inverse_transform(pred)
-    
-    list_data = pred.tolist()[0]
-    list_data = [x if x >= 0 else 0 for x in list_data]
-    list_data = [round(x, 1) for x in list_data]
-    return list_data
-
-def categorize_weather(row):
-    # Extract relevant values
-    precipitation = row['precipitation']
-    snowfall = row['snowfall']
-    cloud_cover = row['cloud_cover']
-
-    # Sunny
-    if precipitation == 0 and cloud_cover < 40:
-        return 'clear'
-    
-    # Cloudy
-    elif precipitation == 0 and cloud_cover >= 40:
-        return 'cloudy'
-    
-    # Rain and Sunny
-    elif precipitation > 0 and cloud_cover < 40:
-        return 'rain and clear'
-    
-    # Rain and Cloudy
-    elif precipitation > 0 and cloud_cover >= 40:
-        return 'rain and cloudy'
-    
-    # Snow and Sunny
-    elif snowfall > 0 and cloud_cover < 40:
-        return 'snow and clear'
-    
-    # Snow and Cloudy
-    elif snowfall > 0 and cloud_cover >= 40:
-        return 'snow and cloudy'
-
-def forecast_weather(data):
-    tempre_list = predict_temp(data)
-    precipitation_list = predict_rain(data)
-    snow_list = predict_snow(data)
-    cloud_list = predict_cloud_cover(data)
-    windspeed_list = predict_windspeed(data)
-    
-    forecast_df = pd.DataFrame({
-        "temperature": tempre_list,
-        "precipitation": precipitation_list,
-        "snowfall": snow_list,
-        "cloud_cover": cloud_list,
-        "wind": windspeed_list
-    })
-
-    forecast_df['conditions']  = forecast_df.apply(categorize_weather, axis=1)
-    
-    now_df = pd.DataFrame([data.iloc[-1]]).reset_index(drop = True)
-    now_df['conditions']  = now_df.apply(categorize_weather, axis=1)
-    
-    return {
-        "forecast": forecast_df.to_dict(orient="records"),
-        "current": {
-            "temperature": int(round(now_df.temperature_2m[0])),
-            "feels_like": int(round(now_df.apparent_temperature[0])),
-            "precipitation": round(now_df.precipitation[0]),
-            "snowfall": round(now_df.snowfall[0]),
-            "windspeed": round(now_df.wind_speed_10m[0], 1),
-            "conditions": now_df.conditions[0],
-            "is_day": bool(now_df.is_day[0]),
-            "humidity": round(now_df.relative_humidity_2m[0]),
-            "pressure": round(now_df.surface_pressure[0], 1)
-        },
-    }
+# colchester_weather = load_data('colchester')
+# london_weather = load_data('london')
+# bristol_weather = load_data('bristol')
+
+
+# Forecasts are cached per (city, newest observation); see forecast_cache.py
+forecast_cache = ForecastCache(
+    ttl=float(os.environ.get("FORECAST_CACHE_TTL", 60)),
+    stale_ttl=float(os.environ.get("FORECAST_CACHE_STALE_TTL", 600)),
+    max_entries=int(os.environ.get("FORECAST_CACHE_SIZE", 256)),
+)
+
+# The routes are async, so blocking work is kept off the event loop:
+# storage reads run on a bounded I/O pool and model inference on its own
+# executor. Worker counts bound the concurrency of each uvicorn worker.
+io_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("IO_WORKERS", 8)),
+                             thread_name_prefix="storage-io")
+inference_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("INFERENCE_WORKERS", 2)),
+                                    thread_name_prefix="inference")
+
+def load_cities(cities):
+    windows = load_windows(cities)
+    return {city: (observation_time(data), data) for city, data in windows.items()}
+
+def infer_forecasts(datas):
+    return inference_pool.submit(metrics.in_context(forecast_weather_batch), datas).result()
+
+# Responses are cached encoded, one per (city, issue time); see
+# forecast_responses.py
+def encode_forecasts(issued):
+    with metrics.stage("serialize", stage_seconds, stage="serialize"):
+        return [EncodedForecast(forecast, issued_at) for issued_at, forecast in issued]
+
+def compute_forecasts(datas):
+    return encode_forecasts(list(zip(map(observation_time, datas), infer_forecasts(datas))))
+
+# FORECAST_MODE=materialized reads the forecasts the ingestion service
+# computes once per new observation (see files_updation.py) instead of
+# running the models per request; cities without a stored forecast yet are
+# computed on demand. Either way the cache keeps them per issue time.
+FORECAST_MODE = os.environ.get("FORECAST_MODE", "on_demand")
+if FORECAST_MODE not in ("on_demand", "materialized"):
+    raise ValueError(f"Unknown FORECAST_MODE {FORECAST_MODE!r}, expected on_demand or materialized")
+
+# Loads (issue time, forecast) pairs, which the cache's compute step only
+# has to encode
+def load_materialized(cities):
+    with metrics.stage("storage", stage_seconds, stage="storage"):
+        stored = storage.read_forecasts(cities)
+    forecasts = {city: (issued_at, (issued_at, forecast)) for city, (issued_at, forecast) in stored.items()}
+    missing = [city for city in cities if city not in forecasts]
+    if missing:
+        loaded = load_cities(missing)
+        if loaded:
+            computed = infer_forecasts([data for _, data in loaded.values()])
+            forecasts.update({city: (observed_at, (observed_at, forecast))
+                              for (city, (observed_at, _)), forecast in zip(loaded.items(), computed)})
+    return forecasts
+
+# Forecasts of the `cities` that have one; a city without observations yet
+# is left out so it doesn't hold up the others
+async def cached_forecasts(cities):
+    # Cache hits are answered on the event loop without a thread hop
+    forecasts = forecast_cache.get_fresh(cities)
+    if forecasts is not None:
+        cache_requests.inc(result="fresh")
+    else:
+        cache_requests.inc(result="refresh")
+        loop = asyncio.get_running_loop()
+        if FORECAST_MODE == "materialized":
+            load_many, compute_many = load_materialized, encode_forecasts
+        else:
+            load_many, compute_many = load_cities, compute_forecasts
+        forecasts = await loop.run_in_executor(io_pool, metrics.in_context(forecast_cache.get_many), cities,
+                                               load_many, compute_many)
+    return {city: forecast for city, forecast in forecasts.items() if forecast is not None}
+
+def unavailable(cities):
+    return HTTPException(status_code=404, detail=f"No forecast for {', '.join(cities)} yet: not enough observations")
+
+def json_response(content):
+    with metrics.stage("serialize", stage_seconds, stage="serialize"):
+        return Response(encode_json(content), media_type="application/json")
+
+# Route names of the cities of a request, all cities when omitted
+def city_names(cities):
+    if cities is None:
+        return list(CITIES)
+    names = list(dict.fromkeys(name.strip().lower() for name in cities.split(",") if name.strip()))
+    unknown = [name for name in names if name not in CITIES]
+    if unknown or not names:
+        raise HTTPException(status_code=404, detail=f"City not found: {', '.join(unknown)}")
+    return names
+
+# Stations for coordinate lookups: the cities of cities.json, in a spatial
+# index built once (see stations.py). A location is answered from its
+# STATION_NEIGHBOURS nearest stations within STATION_MAX_KM km.
+station_index = StationIndex(load_city_config())
+STATION_NEIGHBOURS = int(os.environ.get("STATION_NEIGHBOURS", 3))
+STATION_MAX_KM = float(os.environ.get("STATION_MAX_KM", 250))
 
+# Inverse-distance blend of the forecasts of the stations nearest to a
+# location, listing the stations used and their weights
+async def location_forecast(request, lat, lon, k):
+    if lat is None or lon is None:
+        raise HTTPException(status_code=422, detail="lat and lon must be given together")
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise HTTPException(status_code=422, detail="lat must be within [-90, 90] and lon within [-180, 180]")
+    if k is not None and not 1 <= k <= 32:
+        raise HTTPException(status_code=422, detail="k must be between 1 and 32")
+    with metrics.stage("nearest", stage_seconds, stage="nearest"):
+        nearest = station_index.nearest(lat, lon, k or STATION_NEIGHBOURS, STATION_MAX_KM)
+    if not nearest:
+        raise HTTPException(status_code=404, detail=f"No station within {STATION_MAX_KM:g} km")
+    # Stations without a forecast yet are left out of the blend
+    names = [name for name, _ in nearest]
+    forecasts = await cached_forecasts(names)
+    nearest = [(name, distance) for name, distance in nearest if name in forecasts]
+    if not nearest:
+        raise unavailable(names)
+    weights = idw_weights([distance for _, distance in nearest])
+    nearest, weights = zip(*[(station, weight) for station, weight in zip(nearest, weights) if weight > 0])
+    names = [name for name, _ in nearest]
+    blended = blend_forecasts([forecasts[name].forecast for name in names], weights)
+    blended["location"] = {"lat": lat, "lon": lon}
+    blended["stations"] = [{"city": name, "distance_km": round(distance, 2), "weight": round(float(weight), 4)}
+                           for (name, distance), weight in zip(nearest, weights)]
+    with metrics.stage("serialize", stage_seconds, stage="serialize"):
+        encoded = EncodedForecast(blended, max(forecasts[name].issued_at for name in names))
+    return respond(request, encoded)
+
+# Route to get weather data for several cities at once, e.g.
+# /weather?cities=london,bristol (all cities when omitted), or for any
+# location, e.g. /weather?lat=51.6&lon=0.3 (optionally &k=2 stations)
+@app.get("/weather")
+async def get_predicted_data_batch(request: Request, cities: str = None, lat: float = None, lon: float = None,
+                                   k: int = None):
+    if lat is not None or lon is not None:
+        if cities is not None:
+            raise HTTPException(status_code=422, detail="Ask for either cities or lat/lon")
+        return await location_forecast(request, lat, lon, k)
+    names = city_names(cities)
+    forecasts = await cached_forecasts(names)
+    if not forecasts:
+        raise unavailable(names)
+    return respond(request, combine(forecasts))
+
+@app.get("/weather/all")
+async def get_all_predicted_data(request: Request):
+    return await get_predicted_data_batch(request)
+
+# Open dashboards subscribe to a stream instead of polling; see
+# forecast_stream.py. The ingestion service can announce new forecasts on
+# /weather/notify with NOTIFY_TOKEN as bearer token so they are pushed
+# without waiting for the next poll; without NOTIFY_TOKEN the route is off.
+STREAM_POLL_SECONDS = float(os.environ.get("STREAM_POLL_SECONDS", 15))
+STREAM_KEEPALIVE_SECONDS = float(os.environ.get("STREAM_KEEPALIVE_SECONDS", 20))
+NOTIFY_TOKEN = os.environ.get("NOTIFY_TOKEN")
+broadcaster = ForecastBroadcaster(cached_forecasts, STREAM_POLL_SECONDS)
+
+def sse_event(encoded):
+    return b"event: forecast\ndata: " + encoded.body + b"\n\n"
+
+# Server-Sent Events stream of forecasts, e.g. /weather/stream?cities=london.
+# The first event holds every requested city that has a forecast; each later
+# one the cities whose forecast changed. All events are JSON objects keyed by
+# city.
+@app.get("/weather/stream")
+async def stream_forecasts(cities: str = None):
+    names = city_names(cities)
+    queue = broadcaster.subscribe(names)
+    try:
+        current = await cached_forecasts(names)
+    except Exception:
+        broadcaster.unsubscribe(names, queue)
+        raise
+
+    async def events():
+        try:
+            sent = {city: encoded.etag for city, encoded in current.items()}
+            if current:
+                yield sse_event(combine(current))
+            while True:
+                try:
+                    city, encoded = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                if sent.get(city) != encoded.etag:
+                    sent[city] = encoded.etag
+                    yield sse_event(combine({city: encoded}))
+        finally:
+            broadcaster.unsubscribe(names, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/weather/notify")
+async def notify_forecasts(request: Request, cities: str = None):
+    if not NOTIFY_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not secrets.compare_digest(request.headers.get("authorization", ""), f"Bearer {NOTIFY_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid notify token")
+    names = city_names(cities)
+    reset_windows(names)
+    forecast_cache.expire(names)
+    broadcaster.notify()
+    return Response(status_code=204)
 
 # Route to get weather data for a city
 @app.get("/weather/{city}")
-async def get_predicted_data(city: str):
+async def get_predicted_data(request: Request, city: str):
     city = city.lower()
-    if city not in TABLES:
+    if city not in CITIES:
         raise HTTPException(status_code=404, detail="City not found")
     
-    # Load data dynamically for the city
-    data = load_data(TABLES[city])
-    forecast = forecast_weather(data)
+    # Load data dynamically for the city, reusing the cached forecast while
+    # its newest observation is unchanged
+    forecasts = await cached_forecasts([city])
+    if city not in forecasts:
+        raise unavailable([city])
+
+    return respond(request, forecasts[city])
+
+# Route to get the forecasts issued for a city, newest first, e.g.
+# /weather/london/history?limit=24. Only materialized forecasts are kept.
+@app.get("/weather/{city}/history")
+async def get_forecast_history(city: str, limit: int = 24):
+    city = city.lower()
+    if city not in CITIES:
+        raise HTTPException(status_code=404, detail="City not found")
+    if not 1 <= limit <= 1000:
+        raise HTTPException(status_code=422, detail="limit must be between 1 and 1000")
+
+    loop = asyncio.get_running_loop()
+    history = await loop.run_in_executor(io_pool, metrics.in_context(storage.read_forecast_history), city, limit)
+    return json_response([{"issued_at": issued_at.isoformat(), **forecast} for issued_at, forecast in history])
 
-    return forecast
\ No newline at end of file
+# Prometheus scrape endpoint
+@app.get("/metrics")
+def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from features import FEATURE_COLUMNS, MAX_LAG, build_windows
+from model_registry import MANIFEST_PATH, ModelRegistry
+
+# Rolling-origin backtest of the deployed forecast path. Every hour of a
+# history file with MAX_LAG hours before it and FORECAST_HOURS after it is
+# treated as an issue time: its window is built as the backend builds it
+# (all windows at once, features.build_windows), every predictor of
+# forecasting.py runs over large batches of windows, and its rounded,
+# clipped forecast is scored against the hours that followed.
+#
+#   python backtest.py                                    # Data/processed.csv
+#   python backtest.py Data/processed.csv london=london.csv --manifest candidate/manifest.json
+#
+# Issue times whose window or horizon isn't a run of consecutive hours are
+# skipped. MAE and RMSE are reported per forecast field and hour ahead, and
+# broken down by the month and weather cluster of the issue time.
+
+DATA_PATH = "Data/processed.csv"
+RESULTS_PATH = "backtest_results.json"
+FORECAST_HOURS = 5
+BATCH_ROWS = int(os.environ.get("BACKTEST_BATCH_ROWS", 8192))
+
+# Observation column each forecast field predicts
+FIELD_COLUMNS = {
+    "temperature": "temperature_2m",
+    "precipitation": "precipitation",
+    "snowfall": "snowfall",
+    "cloud_cover": "cloud_cover",
+    "wind": "wind_speed_10m",
+}
+
+COLUMNS = list(dict.fromkeys(FEATURE_COLUMNS + list(FIELD_COLUMNS.values()) + ["year", "month", "day", "hour",
+                                                                              "cluster"]))
+
+
+# A CSV or Parquet file, or a directory of Parquet parts (harvester.py)
+def read_history(path):
+    if path.endswith(".parquet") or os.path.isdir(path):
+        return pd.read_parquet(path, columns=COLUMNS)
+    return pd.read_csv(path, usecols=COLUMNS)
+
+
+# Windows of the scorable issue times of one history, the observed values of
+# the FORECAST_HOURS after each, and the month and cluster of each
+def issue_times(data):
+    data = data.reset_index(drop=True)
+    hours = (pd.to_datetime(data[["year", "month", "day", "hour"]]).to_numpy()
+             .astype("datetime64[h]").astype(np.int64))
+    span = MAX_LAG + FORECAST_HOURS
+    if len(data) <= span:
+        return None
+    # Hours spanned by the MAX_LAG + 1 + FORECAST_HOURS rows around each issue time
+    consecutive = (sliding_window_view(hours, span + 1) == hours[:len(hours) - span, None] + np.arange(span + 1))
+    rows = np.flatnonzero(consecutive.all(axis=1)) + MAX_LAG
+    windows = build_windows(data)[rows]
+    observed = {field: sliding_window_view(data[column].to_numpy(dtype=np.float64)[1:], FORECAST_HOURS)[rows]
+                for field, column in FIELD_COLUMNS.items()}
+    return {
+        "windows": windows,
+        "observed": observed,
+        "month": data["month"].to_numpy(dtype=np.int64)[rows],
+        "cluster": data["cluster"].to_numpy(dtype=np.int64)[rows],
+        "skipped": len(data) - span - len(rows),
+    }
+
+
+# Forecasts of every field for every window, BATCH_ROWS windows per predict
+def predict_all(windows, batch_rows=BATCH_ROWS):
+    from forecasting import run_predictors
+    predictions = {field: [] for field in FIELD_COLUMNS}
+    for start in range(0, len(windows), batch_rows):
+        batch = run_predictors(windows[start:start + batch_rows])
+        for field in FIELD_COLUMNS:
+            predictions[field].append(np.asarray(batch[field], dtype=np.float64))
+    return {field: np.vstack(chunks) for field, chunks in predictions.items()}
+
+
+# MAE/RMSE of `error` (issue times x hours) for each value of `groups`
+def grouped_scores(error, groups):
+    keys, index = np.unique(groups, return_inverse=True)
+    counts = np.bincount(index)
+    absolute = np.bincount(index, np.abs(error).mean(axis=1))
+    squared = np.bincount(index, (error ** 2).mean(axis=1))
+    return {str(key): {"n": int(n), "mae": float(a / n), "rmse": float(np.sqrt(s / n))}
+            for key, n, a, s in zip(keys, counts, absolute, squared)}
+
+
+def score(predictions, observed, month, cluster):
+    report = {}
+    for field in FIELD_COLUMNS:
+        error = predictions[field] - observed[field]
+        report[field] = {
+            "n": len(error),
+            "mae": float(np.abs(error).mean()),
+            "rmse": float(np.sqrt((error ** 2).mean())),
+            "by_hour": {
+                str(hour + 1): {"mae": float(mae), "rmse": float(rmse)}
+                for hour, (mae, rmse) in enumerate(zip(np.abs(error).mean(axis=0),
+                                                       np.sqrt((error ** 2).mean(axis=0))))
+            },
+            "by_month": grouped_scores(error, month),
+            "by_cluster": grouped_scores(error, cluster),
+        }
+    return report
+
+
+def backtest(histories, batch_rows=BATCH_ROWS):
+    parts = []
+    skipped = 0
+    for name, path in histories:
+        part = issue_times(read_history(path))
+        if part is None:
+            print(f"Skipping {name}: fewer than {MAX_LAG + FORECAST_HOURS + 1} rows")
+            continue
+        print(f"{name}: {len(part['windows'])} issue times, {part['skipped']} skipped for gaps")
+        skipped += part["skipped"]
+        parts.append(part)
+    if not parts:
+        raise ValueError("No issue times to score")
+    windows = np.vstack([part["windows"] for part in parts])
+    observed = {field: np.vstack([part["observed"][field] for part in parts]) for field in FIELD_COLUMNS}
+    start = time.perf_counter()
+    predictions = predict_all(windows, batch_rows)
+    seconds = time.perf_counter() - start
+    report = score(predictions, observed, np.concatenate([part["month"] for part in parts]),
+                   np.concatenate([part["cluster"] for part in parts]))
+    return {"issue_times": len(windows), "skipped": skipped, "predict_seconds": seconds, "fields": report}
+
+
+def parse_history(arg):
+    name, sep, path = arg.partition("=")
+    return (name, path) if sep else (os.path.splitext(os.path.basename(arg))[0], arg)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest the forecast models over historical observations")
+    parser.add_argument("histories", nargs="*", default=[DATA_PATH],
+                        help="CSV or Parquet histories, optionally as name=path")
+    parser.add_argument("--manifest", default=MANIFEST_PATH, help="models to backtest (default: the deployed ones)")
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS)
+    parser.add_argument("--output", default=RESULTS_PATH)
+    args = parser.parse_args()
+
+    import forecasting
+    if args.manifest != MANIFEST_PATH:
+        forecasting.registry = ModelRegistry(args.manifest)
+        forecasting.pipelines.clear()
+    results = backtest([parse_history(arg) for arg in args.histories], args.batch_rows)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Scored {results['issue_times']} issue times in {results['predict_seconds']:.1f} s")
+    for field, report in results["fields"].items():
+        by_hour = " ".join(f"{scores['mae']:7.3f}" for scores in report["by_hour"].values())
+        print(f"{field:14s} MAE {report['mae']:7.3f}  RMSE {report['rmse']:7.3f}  MAE by hour {by_hour}")
+    print(f"Results written to {args.output}")
@@ -0,0 +1,327 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from storage import OBSERVATION_COLUMNS, set_storage
+
+# Benchmarks of the forecast and ingestion hot paths. Observations are
+# replayed from Data/processed.csv through a stub storage, so no cloud access
+# is needed, and each stage is timed on its own:
+#
+#   load_data              window top-up through backend.load_data
+#   build_window           features.build_window on one city window
+#   predict_<field>        each backend predictor on one window
+#   forecast_weather       backend.forecast_weather end to end
+#   endpoint_cached        concurrent GET /weather/{city}, forecast cache on
+#   endpoint_uncached      the same with every request recomputing
+#   ingest_tick            files_updation.ingest for every city: fetch from
+#                          a replayed Open-Meteo client, extract, buffer and
+#                          flush to the stub storage
+#   assign_clusters        clustering on every row of the replayed file
+#
+# Results (p50/p95/p99 latency in ms, throughput, peak traced memory) are
+# written as JSON and compared with a stored baseline:
+#
+#   python benchmark.py --save-baseline       # on the reference build
+#   python benchmark.py                       # exits 1 on a regression
+#
+# A stage that raises is recorded with its error and fails the run, as does
+# a baseline stage missing from the new results.
+
+OUTPUT_PATH = "benchmark_results.json"
+BASELINE_PATH = "benchmark_baseline.json"
+
+
+# Storage serving a moving window over a CSV: every top-up read returns the
+# next row, as if one observation had been ingested since the last request.
+# Writes are only counted and forecasts kept in memory.
+class ReplayStorage:
+    def __init__(self, data_path="Data/processed.csv", latency=0.0):
+        data = pd.read_csv(data_path, usecols=OBSERVATION_COLUMNS)
+        data["date"] = pd.to_datetime(data["date"]).dt.date
+        data["is_day"] = data["is_day"].astype(bool)
+        self.rows = data.to_dict("records")
+        self.latency = latency
+        self.positions = {}
+        self.rows_written = 0
+        self.forecasts = {}
+
+    def read_latest(self, last_rows, n):
+        if self.latency:
+            time.sleep(self.latency)
+        new_rows = {}
+        for city, last_row in last_rows.items():
+            if city not in self.positions:
+                self.positions[city] = n + len(self.positions) * 997 % (len(self.rows) - n)
+            if last_row is None:
+                position = self.positions[city]
+                new_rows[city] = [dict(row) for row in self.rows[position - n:position]]
+            else:
+                position = self.positions[city] = self.positions[city] % (len(self.rows) - 1) + 1
+                new_rows[city] = [dict(self.rows[position])]
+        return new_rows
+
+    def create_tables(self):
+        pass
+
+    def append_observations(self, dataframe):
+        self.rows_written += len(dataframe)
+
+    def bulk_load(self, city, dataframe):
+        self.rows_written += len(dataframe)
+        return len(dataframe)
+
+    def write_forecasts(self, records):
+        for city, issued_at, forecast in records:
+            self.forecasts[city] = (issued_at, forecast)
+
+    def read_forecasts(self, cities):
+        return {city: self.forecasts[city] for city in cities if city in self.forecasts}
+
+    def read_forecast_history(self, city, n):
+        return [self.forecasts[city]] if city in self.forecasts else []
+
+
+# Open-Meteo client answering each call with the next replayed row of every
+# requested location, as if an hour had passed since the previous call
+class ReplayClient:
+    def __init__(self, rows, variables):
+        self.rows = rows
+        self.variables = variables
+        self.position = 0
+
+    def weather_api(self, url, params):
+        self.position += 1
+        return [ReplayResponse(self.rows[(self.position + i * 997) % len(self.rows)], self.variables)
+                for i in range(len(params["latitude"]))]
+
+
+# Open-Meteo response with the current values of one replayed row
+class ReplayResponse:
+    def __init__(self, row, variables):
+        timestamp = datetime(int(row["year"]), int(row["month"]), int(row["day"]), int(row["hour"]),
+                             tzinfo=timezone.utc).timestamp()
+        self.values = [row.get(name, 0.0) for name in variables]
+        self.time = int(timestamp)
+
+    def Current(self):
+        return self
+
+    def Variables(self, i):
+        return ReplayValue(self.values[i])
+
+    def Time(self):
+        return self.time
+
+
+class ReplayValue:
+    def __init__(self, value):
+        self.value = value
+
+    def Value(self):
+        return self.value
+
+
+def summarize(latencies, wall_seconds, peak_bytes):
+    ms = np.asarray(latencies) * 1000
+    return {
+        "n": len(ms),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "mean_ms": float(ms.mean()),
+        "throughput_per_s": len(ms) / wall_seconds,
+        "peak_memory_kb": peak_bytes / 1024,
+    }
+
+
+# Latencies of `fn` over `iterations` calls, then its peak traced memory over
+# a shorter pass (tracing slows every allocation, so it is kept apart)
+def run_stage(fn, iterations, warmup=5):
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t0)
+    wall = time.perf_counter() - start
+    tracemalloc.start()
+    for _ in range(min(iterations, 20)):
+        fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return summarize(latencies, wall, peak)
+
+
+# `requests` GETs of /weather/{city} with at most `concurrency` in flight
+async def load_test(app, cities, requests, concurrency):
+    import httpx
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(client, i):
+        async with semaphore:
+            t0 = time.perf_counter()
+            response = await client.get(f"/weather/{cities[i % len(cities)]}")
+            latencies.append(time.perf_counter() - t0)
+            response.raise_for_status()
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        await asyncio.gather(*(one(client, i) for i in range(concurrency)))  # warm-up
+        latencies.clear()
+        tracemalloc.start()
+        start = time.perf_counter()
+        await asyncio.gather(*(one(client, i) for i in range(requests)))
+        wall = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return summarize(latencies, wall, peak)
+
+
+def run(data_path, iterations, requests, concurrency, storage_latency, stages=None):
+    replay = ReplayStorage(data_path, storage_latency)
+    set_storage(replay)
+    os.environ.setdefault("INGEST_BUFFER_PATH", os.path.join(tempfile.mkdtemp(), "ingest_buffer.sqlite"))
+
+    import backend
+    from features import build_window
+    from forecast_cache import ForecastCache
+
+    def wanted(name):
+        return stages is None or any(name.startswith(stage) for stage in stages)
+
+    results = {}
+
+    def record(name, measure):
+        if not wanted(name):
+            return
+        try:
+            results[name] = measure()
+        except Exception as e:
+            results[name] = {"error": f"{type(e).__name__}: {e}"}
+        summary = results[name]
+        if "error" in summary:
+            print(f"{name:24s} FAILED ({summary['error']})")
+        else:
+            print(f"{name:24s} p50 {summary['p50_ms']:9.3f} ms  p95 {summary['p95_ms']:9.3f} ms  "
+                  f"p99 {summary['p99_ms']:9.3f} ms  {summary['throughput_per_s']:10.1f}/s  "
+                  f"peak {summary['peak_memory_kb']:9.1f} KB")
+
+    city = backend.CITIES[0]
+    data = backend.load_data(city)
+    windows = np.vstack([build_window(data)])
+
+    record("load_data", lambda: run_stage(lambda: backend.load_data(city), iterations))
+    record("build_window", lambda: run_stage(lambda: build_window(data), iterations))
+    for name, predictor in backend.PREDICTORS.items():
+        record(f"predict_{name}", lambda predictor=predictor: run_stage(lambda: predictor(windows), iterations))
+    record("forecast_weather", lambda: run_stage(lambda: backend.forecast_weather(data), iterations))
+
+    def endpoint(ttl):
+        cache = backend.forecast_cache
+        backend.forecast_cache = ForecastCache(ttl=ttl, stale_ttl=0 if ttl == 0 else cache.stale_ttl,
+                                               max_entries=cache.max_entries)
+        try:
+            return asyncio.run(load_test(backend.app, backend.CITIES, requests, concurrency))
+        finally:
+            backend.forecast_cache = cache
+
+    record("endpoint_cached", lambda: endpoint(backend.forecast_cache.ttl))
+    record("endpoint_uncached", lambda: endpoint(0))
+
+    if wanted("ingest_tick"):
+        import files_updation
+        client = ReplayClient(replay.rows, files_updation.CURRENT_VARIABLES)
+        record("ingest_tick", lambda: run_stage(lambda: files_updation.ingest(client=client), iterations))
+    if wanted("assign_clusters"):
+        from clustering import load_assigner
+        from model_registry import ModelRegistry
+        assigner = load_assigner(ModelRegistry())
+        features = pd.read_csv(data_path, usecols=assigner.features)
+        record("assign_clusters", lambda: run_stage(lambda: assigner.assign_frame(features), iterations))
+    return results
+
+
+# Stages whose p50/p95 latency or peak memory grew by more than `tolerance`
+# over the baseline, and baseline stages that failed or are missing among the
+# `stages` run. Absolute floors keep microsecond jitter from counting.
+def compare(results, baseline, tolerance, stages=None, min_ms=0.05, min_kb=64):
+    regressions = []
+    for name, base in baseline.items():
+        wanted = stages is None or any(name.startswith(stage) for stage in stages)
+        if wanted and "error" not in base and "skipped" not in base and name not in results:
+            regressions.append(f"{name}: missing from the results")
+    for name, summary in results.items():
+        if "error" in summary:
+            regressions.append(f"{name}: {summary['error']}")
+            continue
+        base = baseline.get(name)
+        if base is None or "error" in base or "skipped" in base:
+            continue
+        for metric, floor in (("p50_ms", min_ms), ("p95_ms", min_ms), ("peak_memory_kb", min_kb)):
+            if summary[metric] > base[metric] * (1 + tolerance) + floor:
+                regressions.append(f"{name} {metric}: {base[metric]:.3f} -> {summary[metric]:.3f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the forecast and ingestion hot paths")
+    parser.add_argument("--data", default="Data/processed.csv")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=500, help="requests of the endpoint load tests")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--storage-latency", type=float, default=0.0,
+                        help="seconds added to every storage read, e.g. 0.3 for BigQuery")
+    parser.add_argument("--stages", nargs="*", help="only stages starting with these names")
+    parser.add_argument("--output", default=OUTPUT_PATH)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="also store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown")
+    args = parser.parse_args()
+
+    results = run(args.data, args.iterations, args.requests, args.concurrency, args.storage_latency, args.stages)
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "settings": {"iterations": args.iterations, "requests": args.requests, "concurrency": args.concurrency,
+                     "storage_latency": args.storage_latency},
+        "stages": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    failed = [name for name, summary in results.items() if "error" in summary]
+    if failed:
+        print(f"FAILED stages: {', '.join(failed)}")
+        sys.exit(1)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["stages"]
+        regressions = compare(results, baseline, args.tolerance, args.stages)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    else:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one")
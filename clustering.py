@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from model_registry import MANIFEST_PATH, ModelRegistry
+from pipelines import scaler_vectors
+
+
+# Weather cluster assignment without sklearn. The fitted cluster scaler and
+# KMeans centroids are reduced to plain arrays once, with the scaler folded
+# into the distances: for raw feature rows x, the squared distance to
+# centroid c in the scaled space is
+#
+#   sum(((x - mean) / scale - c) ** 2) = sum(x**2 / scale**2) + x @ weights[:, k] + bias[k]
+#
+# and the first term is the same for every centroid, so the nearest centroid
+# of every row is argmin(X @ weights + bias): one matrix product whatever
+# the number of rows.
+#
+# `python clustering.py compile` caches the arrays in
+# Models/compiled/cluster_centroids.npz (the manifest's "centroids" entry),
+# so the services load them without unpickling the estimators, and
+# `python clustering.py relabel ...` recomputes the `cluster` column of
+# stored city tables or CSV/Parquet files after the clustering changed.
+TARGET = "cluster"
+CENTROIDS_PATH = "Models/compiled/cluster_centroids.npz"
+RELABEL_CHUNK_ROWS = int(os.environ.get("RELABEL_CHUNK_ROWS", 200000))
+
+
+class ClusterAssigner:
+    def __init__(self, features, mean, scale, centroids, version=None):
+        self.features = list(features)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.centroids = np.asarray(centroids, dtype=np.float64)  # (clusters, features), scaled space
+        self.version = version
+        # Centroids in raw feature units, and the per-feature weights of the
+        # scaled distance
+        raw = self.centroids * self.scale + self.mean
+        inverse_variance = 1.0 / self.scale ** 2
+        self.weights = (-2.0 * raw * inverse_variance).T  # (features, clusters)
+        self.bias = (raw ** 2 * inverse_variance).sum(axis=1)
+
+    @classmethod
+    def from_estimators(cls, features, scaler, model, version=None):
+        mean, scale = scaler_vectors(scaler, len(features))
+        return cls(features, mean, scale, model.cluster_centers_, version)
+
+    @classmethod
+    def from_registry(cls, registry):
+        return cls.from_estimators(registry.features(TARGET), registry.x_scaler(TARGET), registry.model(TARGET),
+                                   registry.version(TARGET))
+
+    # Cluster of every row of raw feature values, in `features` order
+    def assign(self, X):
+        scores = np.asarray(X, dtype=np.float64) @ self.weights
+        scores += self.bias
+        return scores.argmin(axis=1)
+
+    def assign_frame(self, dataframe):
+        return self.assign(dataframe[self.features].to_numpy(dtype=np.float64))
+
+    def save(self, path):
+        np.savez(path, features=np.array(self.features), mean=self.mean, scale=self.scale,
+                 centroids=self.centroids, version=np.array(self.version or ""))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays["features"].tolist(), arrays["mean"], arrays["scale"], arrays["centroids"],
+                       str(arrays["version"]) or None)
+
+
+# The cached arrays when they match the registered model version, else
+# arrays extracted from the registered estimators
+def load_assigner(registry):
+    path = registry.manifest[TARGET].get("centroids")
+    if path is not None:
+        try:
+            assigner = ClusterAssigner.load(os.path.join(registry.root, path))
+        except FileNotFoundError:
+            assigner = None
+        if (assigner is not None and assigner.version == registry.version(TARGET)
+                and assigner.features == registry.features(TARGET)):
+            return assigner
+        print(f"Ignoring stale cluster centroids {path}")
+    return ClusterAssigner.from_registry(registry)
+
+
+# Rows whose cluster differs from KMeans.predict on `n` random rows spread
+# around the centroids
+def check_parity(registry, assigner, n=20000, seed=0):
+    rng = np.random.RandomState(seed)
+    scaled = assigner.centroids[rng.randint(len(assigner.centroids), size=n)]
+    scaled = scaled + rng.normal(size=scaled.shape)
+    X = scaled * assigner.scale + assigner.mean
+    expected = registry.model(TARGET).predict(registry.x_scaler(TARGET).transform(X))
+    return int((assigner.assign(X) != expected).sum())
+
+
+def compile_centroids(manifest_path=MANIFEST_PATH):
+    registry = ModelRegistry(manifest_path, mmap_mode=None)
+    assigner = ClusterAssigner.from_registry(registry)
+    mismatches = check_parity(registry, assigner)
+    if mismatches:
+        raise ValueError(f"Cluster assignment differs from the model on {mismatches} rows")
+    os.makedirs(os.path.join(registry.root, os.path.dirname(CENTROIDS_PATH)), exist_ok=True)
+    assigner.save(os.path.join(registry.root, CENTROIDS_PATH))
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    manifest["models"][TARGET]["centroids"] = CENTROIDS_PATH
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+        f.write("\n")
+    print(f"Compiled {len(assigner.centroids)} cluster centroids over {len(assigner.features)} features "
+          f"(version {assigner.version})")
+
+
+# Rewrite the `cluster` column of a CSV or Parquet file in place, `chunk_rows`
+# rows at a time; the other columns are copied as they are. Returns
+# (rows, rows whose cluster changed).
+def relabel_file(path, assigner, chunk_rows=RELABEL_CHUNK_ROWS):
+    tmp_path = f"{path}.relabel"
+    rows = changed = 0
+    try:
+        if path.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            source = pq.ParquetFile(path)
+            with pq.ParquetWriter(tmp_path, source.schema_arrow) as writer:
+                for batch in source.iter_batches(batch_size=chunk_rows):
+                    X = np.column_stack([batch.column(name).to_numpy(zero_copy_only=False)
+                                         for name in assigner.features]).astype(np.float64)
+                    labels = assigner.assign(X)
+                    index = batch.schema.get_field_index("cluster")
+                    old = batch.column(index).to_numpy(zero_copy_only=False)
+                    column = pa.array(labels).cast(batch.schema.field(index).type)
+                    writer.write_batch(batch.set_column(index, batch.schema.field(index), column))
+                    rows += len(labels)
+                    changed += int((old != labels).sum())
+        else:
+            # Read as text so the copied columns keep their exact formatting
+            chunks = pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=chunk_rows)
+            for i, chunk in enumerate(chunks):
+                labels = assigner.assign(chunk[assigner.features].astype(np.float64).to_numpy())
+                changed += int((chunk["cluster"].astype(float).to_numpy() != labels).sum())
+                rows += len(labels)
+                chunk["cluster"] = labels
+                chunk.to_csv(tmp_path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return rows, changed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vectorized weather cluster assignment")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compile_parser = subparsers.add_parser("compile", help="cache the centroids of the registered model")
+    compile_parser.add_argument("--manifest", default=MANIFEST_PATH)
+    verify_parser = subparsers.add_parser("verify", help="check the cached centroids against the model")
+    verify_parser.add_argument("--manifest", default=MANIFEST_PATH)
+    relabel_parser = subparsers.add_parser("relabel", help="recompute the cluster column of stored rows")
+    relabel_parser.add_argument("files", nargs="*", help="CSV or Parquet files, rewritten in place")
+    relabel_parser.add_argument("--cities", nargs="*", default=[],
+                                help="city tables of the storage selected by WEATHER_STORAGE")
+    relabel_parser.add_argument("--chunk-rows", type=int, default=RELABEL_CHUNK_ROWS)
+    relabel_parser.add_argument("--manifest", default=MANIFEST_PATH)
+    args = parser.parse_args()
+
+    if args.command == "compile":
+        compile_centroids(args.manifest)
+    elif args.command == "verify":
+        registry = ModelRegistry(args.manifest)
+        mismatches = check_parity(registry, load_assigner(registry))
+        print(f"cluster: {mismatches} mismatched rows {'ok' if not mismatches else 'FAILED'}")
+        sys.exit(1 if mismatches else 0)
+    else:
+        if not args.files and not args.cities:
+            parser.error("relabel needs files or --cities")
+        assigner = load_assigner(ModelRegistry(args.manifest))
+        for path in args.files:
+            rows, changed = relabel_file(path, assigner, args.chunk_rows)
+            print(f"Relabeled {path}: {rows} rows, {changed} changed")
+        if args.cities:
+            from storage import get_storage
+            storage = get_storage()
+            for city in args.cities:
+                changed = storage.relabel_clusters(city, assigner, args.chunk_rows)
+                print(f"Relabeled {city}: {changed} rows changed")
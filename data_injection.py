@@ -1,39 +1,138 @@
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import pandas as pd
-from google.cloud import bigquery
 
-# Set your BigQuery credentials and project details
-PROJECT_ID = "gcp_project_id"  # Replace with your project ID
-DATASET_ID = "weather_data"  # Replace with your dataset name
-TABLE_ID = "london"  # Replace with your table name
+from storage import OBSERVATION_COLUMNS, get_storage
+
+# Historical backfill: streams city CSV/Parquet files into the storage
+# selected by WEATHER_STORAGE (BigQuery by default, see storage.py).
+#
+#   python data_injection.py london.csv bristol=Data/bristol_2020.parquet
+#
+# Each file is read `chunk_rows` rows at a time, typed once per chunk and
+# uploaded by a bounded pool of workers; at most `workers` chunks are read
+# ahead, so memory stays flat whatever the file size. Finished chunks are
+# recorded in a checkpoint file, and a rerun of an interrupted backfill skips
+# them. A chunk uploaded just before a crash, but not yet recorded, is
+# uploaded again on resume; uploads are upserts on (city, date, hour), so it
+# replaces its own rows instead of duplicating them.
+
+# Set your BigQuery credentials
+os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", "your_credential_json_file")
+
+CHUNK_ROWS = int(os.environ.get("BACKFILL_CHUNK_ROWS", 50000))
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", 4))
+CHECKPOINT_PATH = os.environ.get("BACKFILL_CHECKPOINT", "backfill_checkpoint.json")
+
+# Column types of the tables; 'date' is derived from year/month/day
+DTYPES = {column: "float64" for column in OBSERVATION_COLUMNS if column != "date"}
+DTYPES.update({"is_day": "bool", "year": "int64", "month": "int64", "day": "int64", "hour": "int64",
+               "cluster": "int64"})
+
+
+# Rows of a CSV or Parquet file, or of a directory of Parquet parts such as
+# a city partition written by harvester.py, in chunks of `chunk_rows`
+def read_chunks(path, chunk_rows):
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".parquet"):
+                yield from read_chunks(os.path.join(path, name), chunk_rows)
+    elif path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=OBSERVATION_COLUMNS):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, index_col=False, usecols=OBSERVATION_COLUMNS, chunksize=chunk_rows)
+
+
+# Clean one chunk to match the table schema in a single conversion. Dates are
+# rebuilt from year/month/day, which every export has in the same form,
+# rather than parsing the day-first or ISO 'date' strings
+def clean_chunk(chunk):
+    chunk = chunk.astype(DTYPES)
+    chunk["date"] = pd.to_datetime(chunk[["year", "month", "day"]])
+    return chunk[OBSERVATION_COLUMNS]
+
+
+# Finished chunks per file, saved atomically after every chunk
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    # Progress of one file, restarted if the file or the chunk size changed
+    def start(self, city, path, chunk_rows):
+        key = f"{city}:{os.path.abspath(path)}"
+        stat = os.stat(path)
+        source = {"size": stat.st_size, "mtime": stat.st_mtime, "chunk_rows": chunk_rows}
+        with self.lock:
+            entry = self.state.get(key)
+            if entry is None or entry["source"] != source:
+                entry = self.state[key] = {"source": source, "done": []}
+            return key, set(entry["done"])
+
+    def mark_done(self, key, index):
+        with self.lock:
+            self.state[key]["done"].append(index)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.state, f)
+            os.replace(tmp, self.path)
 
-import os
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "your_credential_json_file"
 
-# Initialize BigQuery client
-client = bigquery.Client()
+def backfill(files, chunk_rows=CHUNK_ROWS, workers=BACKFILL_WORKERS, checkpoint_path=CHECKPOINT_PATH):
+    storage = get_storage()
+    storage.create_tables()
+    checkpoint = Checkpoint(checkpoint_path)
 
-# Load the CSV file into a Pandas DataFrame
-file_path = "london.csv"  # Update the path if necessary
-df = pd.read_csv(file_path, index_col=False)
+    def upload(city, key, index, chunk):
+        storage.bulk_load(city, clean_chunk(chunk))
+        checkpoint.mark_done(key, index)
+        return len(chunk)
 
-# Clean the data to match BigQuery schema
-df['date'] = pd.to_datetime(df['date'], errors='coerce', dayfirst=True)
-#df['date'] = pd.to_datetime(df['date'], format='%d-%m-%Y').dt.date  # Convert 'date' to YYYY-MM-DD
-df['is_day'] = df['is_day'].astype(bool)  # Convert 'is_day' to boolean
-df['year'] = df['year'].astype(int)  # Ensure 'year' is an integer
-df['month'] = df['month'].astype(int)  # Ensure 'month' is an integer
-df['day'] = df['day'].astype(int)  # Ensure 'day' is an integer
-df['hour'] = df['hour'].astype(int)  # Ensure 'hour' is an integer
-df['cluster'] = df['cluster'].astype(int)  # Ensure 'cluster' is an integer
+    loaded = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as pool:
+        in_flight = set()
+        for city, path in files:
+            key, done = checkpoint.start(city, path, chunk_rows)
+            if done:
+                print(f"Resuming {path} for {city}: skipping {len(done)} finished chunks.")
+            for index, chunk in enumerate(read_chunks(path, chunk_rows)):
+                if index in done:
+                    continue
+                # Bound the chunks held in memory to the ones being uploaded
+                if len(in_flight) >= workers:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    loaded += sum(future.result() for future in finished)
+                in_flight.add(pool.submit(upload, city, key, index, chunk))
+        loaded += sum(future.result() for future in wait(in_flight).done)
+    print(f"Backfilled {loaded} rows from {len(files)} files.")
+    return loaded
 
-# Specify the full table ID
-table_id = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
 
-# Upload the DataFrame to BigQuery
-job = client.load_table_from_dataframe(df, table_id)
+# 'city=path', or a path named after its city
+def parse_file(arg):
+    city, sep, path = arg.partition("=")
+    if not sep:
+        path = arg
+        city = os.path.splitext(os.path.basename(arg))[0]
+    return city, path
 
-# Wait for the job to complete
-job.result()
 
-# Confirm the data upload
-print(f"Loaded {job.output_rows} rows into {table_id}.")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill historical observations from CSV/Parquet files")
+    parser.add_argument("files", nargs="*", default=["london.csv"],
+                        help="city=path, or a path named after its city (default: london.csv)")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    args = parser.parse_args()
+    backfill([parse_file(arg) for arg in args.files], args.chunk_rows, args.workers, args.checkpoint)
@@ -0,0 +1,71 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Input columns and number of lags for each target model. The scalers were
+# fitted on the columns in this order, followed by every column at lag 1,
+# then every column at lag 2, and so on.
+MODEL_FEATURES = {
+    "temperature": (['temperature_2m', 'apparent_temperature', 'showers', 'cloud_cover', 'wind_speed_10m', 'month',
+                     'day', 'cluster'], 1),
+    "rain": (['precipitation', 'apparent_temperature', 'showers', 'pressure_msl', 'cloud_cover', 'wind_direction_10m',
+              'wind_gusts_10m', 'is_day', 'month', 'day', 'cluster'], 2),
+    "snow": (['snowfall', 'precipitation'], 1),
+    "cloud": (['cloud_cover', 'temperature_2m', 'relative_humidity_2m', 'apparent_temperature', 'precipitation', 'rain',
+               'showers', 'snowfall', 'pressure_msl', 'wind_speed_10m', 'wind_direction_10m', 'wind_gusts_10m',
+               'is_day', 'month', 'day', 'hour', 'cluster'], 1),
+    "wind": (['wind_speed_10m', 'temperature_2m', 'apparent_temperature', 'precipitation', 'rain', 'showers',
+              'snowfall', 'pressure_msl', 'surface_pressure', 'cloud_cover', 'wind_direction_10m', 'wind_gusts_10m',
+              'is_day', 'month', 'day', 'hour', 'cluster'], 1),
+}
+
+# Union of the columns read by any model, and the deepest lag
+FEATURE_COLUMNS = list(dict.fromkeys(col for cols, _ in MODEL_FEATURES.values() for col in cols))
+MAX_LAG = max(lags for _, lags in MODEL_FEATURES.values())
+
+
+# Column names in the order the scaler of `target` expects
+def feature_names(target):
+    columns, lags = MODEL_FEATURES[target]
+    names = list(columns)
+    for lag in range(1, lags + 1):
+        names += [f'{col}_lag_{lag}' for col in columns]
+    return names
+
+
+# Positions of a model's features in the flattened window built below, where
+# row 0 is the newest observation and row k is lag k
+def _feature_index(target):
+    columns, lags = MODEL_FEATURES[target]
+    col_idx = np.array([FEATURE_COLUMNS.index(col) for col in columns])
+    return np.concatenate([lag * len(FEATURE_COLUMNS) + col_idx for lag in range(lags + 1)])
+
+FEATURE_INDEX = {target: _feature_index(target) for target in MODEL_FEATURES}
+
+
+# The newest MAX_LAG + 1 observations of every feature column as one flat
+# float array, newest row first. Missing history is padded with NaN, the same
+# values `shift` produced for a short window.
+def build_window(data):
+    values = data[FEATURE_COLUMNS].to_numpy(dtype=np.float64)[::-1][:MAX_LAG + 1]
+    if len(values) < MAX_LAG + 1:
+        padding = np.full((MAX_LAG + 1 - len(values), len(FEATURE_COLUMNS)), np.nan)
+        values = np.vstack([values, padding])
+    return np.ascontiguousarray(values).ravel()
+
+
+# build_window for every row of `data` at once: row i is the window whose
+# newest observation is row i, taken from a strided view of the columns and
+# NaN-padded before the first row, as build_window pads a short history
+def build_windows(data):
+    values = data[FEATURE_COLUMNS].to_numpy(dtype=np.float64)
+    padded = np.vstack([np.full((MAX_LAG, len(FEATURE_COLUMNS)), np.nan), values])
+    view = sliding_window_view(padded, MAX_LAG + 1, axis=0)  # (rows, columns, oldest..newest)
+    return view[:, :, ::-1].transpose(0, 2, 1).reshape(len(values), -1)
+
+
+# Model input for `target`: one row per window (a single window or a stack
+# of windows from several cities)
+def model_input(windows, target):
+    return np.atleast_2d(windows).take(FEATURE_INDEX[target], axis=1)
+
@@ -6,69 +6,85 @@ from datetime import datetime, timedelta
 import joblib
 import pytz
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import openmeteo_requests
 import requests_cache
 import pandas as pd
 from retry_requests import retry
-from google.cloud import bigquery
-from google.auth import default
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify
+
+import metrics
+from clustering import load_assigner
+from ingest_buffer import IngestBuffer
+from stations import load_cities
+from forecasting import WINDOW_SIZE, forecast_weather_batch, observation_time, registry, window_frame
+from storage import get_storage
 
 app = Flask(__name__)
 
-cluster_model = joblib.load('Models/cluster.joblib')
-cluster_scaler = joblib.load('Scalers/cluster_scaler.joblib')
-x_scaler_cloud = joblib.load('Scalers/x_scaler_cloud.joblib')
-y_scaler_cloud = joblib.load('Scalers/y_scaler_cloud.joblib')
-
-# import os
-# os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "bigquery-key.json"
-# Use default credentials from the environment
-credentials, project_id = default()
-
-# Initialize BigQuery Client
-bq_client = bigquery.Client(credentials=credentials, project=project_id)
-#bq_client = bigquery.Client()
-
-# Define BigQuery table references
-PROJECT_ID = "project-id" #replace project id with your gcp project id
-DATASET_ID = "weather_data"
-TABLES = {
-    "colchester": f"{PROJECT_ID}.{DATASET_ID}.colchester",
-    "london": f"{PROJECT_ID}.{DATASET_ID}.london",
-    "bristol": f"{PROJECT_ID}.{DATASET_ID}.bristol",
-}
-
-# Function to upload data to BigQuery
-def update_bigquery_table(dataframe, table_name):
+# Nearest-centroid assignment with the cluster scaler folded in (see clustering.py)
+cluster_assigner = load_assigner(registry)
+
+# Observations are written through the storage selected by WEATHER_STORAGE
+# (BigQuery by default, see storage.py), which gets a table for every city of
+# cities.json on startup
+storage = get_storage()
+storage.create_tables()
+
+# With FORECAST_MODE=materialized the forecasts of every city that received
+# observations are computed here, once per new observation, and stored by
+# city and issue time for the API to serve (see backend.py). A failure is
+# logged and counted but never undoes the write that triggered it.
+FORECAST_MODE = os.environ.get("FORECAST_MODE", "on_demand")
+
+def materialize_forecasts(cities):
+    if FORECAST_MODE != "materialized":
+        return
     try:
-        job = bq_client.load_table_from_dataframe(dataframe, table_name)
-        job.result()  # Wait for the job to complete
-        print(f"Inserted {len(dataframe)} rows into {table_name}.")
+        windows = storage.read_latest({city: None for city in cities}, WINDOW_SIZE)
+        # A city's first hours can't be forecast yet (see forecasting.full_window)
+        datas = {city: window_frame(rows) for city, rows in windows.items() if len(rows) >= WINDOW_SIZE}
+        if len(datas) < len(windows):
+            print(f"Not enough observations to forecast {', '.join(sorted(set(windows) - set(datas)))} yet")
+        if not datas:
+            return
+        forecasts = forecast_weather_batch(list(datas.values()))
+        storage.write_forecasts([(city, observation_time(data), forecast)
+                                 for (city, data), forecast in zip(datas.items(), forecasts)])
     except Exception as e:
-        print(f"Failed to insert data into {table_name}: {e}")
+        print(f"Failed to materialize forecasts for {', '.join(cities)}: {e}")
+        for city in cities:
+            ingest_failures.inc(city=city, stage="forecast")
+
+# After a write the backend is told which cities changed, so it pushes their
+# forecasts to open dashboards right away (the /weather/notify route of
+# backend.py, which needs the shared NOTIFY_TOKEN); without
+# FORECAST_NOTIFY_URL it finds them on its next poll
+FORECAST_NOTIFY_URL = os.environ.get("FORECAST_NOTIFY_URL")
+NOTIFY_TOKEN = os.environ.get("NOTIFY_TOKEN")
+if FORECAST_NOTIFY_URL and not NOTIFY_TOKEN:
+    print("FORECAST_NOTIFY_URL is set without NOTIFY_TOKEN; the backend will not be notified")
 
-def data_extraction(responses, table_name):
-    response = responses[0]
+def notify_backend(cities):
+    if not FORECAST_NOTIFY_URL or not NOTIFY_TOKEN:
+        return
+    try:
+        response = requests.post(FORECAST_NOTIFY_URL, params={"cities": ",".join(cities)},
+                                 headers={"Authorization": f"Bearer {NOTIFY_TOKEN}"}, timeout=5)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to notify the backend about {', '.join(cities)}: {e}")
+
+# Current observation of one Open-Meteo response as a dictionary
+def read_current(response):
     # Current values. The order of variables needs to be the same as requested.
     current = response.Current()
-    current_temperature_2m = current.Variables(0).Value()
-    current_relative_humidity_2m = current.Variables(1).Value()
-    current_apparent_temperature = current.Variables(2).Value()
-    current_is_day = current.Variables(3).Value()
-    current_precipitation = current.Variables(4).Value()
-    current_rain = current.Variables(5).Value()
-    current_showers = current.Variables(6).Value()
-    current_snowfall = current.Variables(7).Value()
-    current_weather_code = current.Variables(8).Value()
-    current_cloud_cover = current.Variables(9).Value()
-    current_pressure_msl = current.Variables(10).Value()
-    current_surface_pressure = current.Variables(11).Value()
-    current_wind_speed_10m = current.Variables(12).Value()
-    current_wind_direction_10m = current.Variables(13).Value()
-    current_wind_gusts_10m = current.Variables(14).Value()
-    
+    values = {name: current.Variables(i).Value() for i, name in enumerate(CURRENT_VARIABLES)}
+
     tt = current.Time()
     # Convert Unix timestamp to datetime object
     local_time = datetime.fromtimestamp(tt)
@@ -77,27 +93,30 @@ def data_extraction(responses, table_name):
     gmt_time = local_time.astimezone(gmt_timezone)
     # Format the datetime in the required format
     formatted_time = gmt_time.strftime("%Y-%m-%d %H:%M:%S%z")
-    
-    new_dic = {
-        "date": [formatted_time],
-        "temperature_2m": [current_temperature_2m],
-        "relative_humidity_2m": [current_relative_humidity_2m],
-        'apparent_temperature': [current_apparent_temperature],
-        'precipitation': [current_precipitation],
-        'rain': [current_rain],
-        'showers': [current_showers],
-        'snowfall': [current_snowfall],
-        'pressure_msl': [current_pressure_msl],
-        'surface_pressure': [current_surface_pressure],
-        'cloud_cover': [current_cloud_cover],
-        'wind_speed_10m': [current_wind_speed_10m],
-        'wind_direction_10m': [current_wind_direction_10m],
-        'wind_gusts_10m': [current_wind_gusts_10m],
-        'is_day': [current_is_day]
+
+    return {
+        "date": formatted_time,
+        "temperature_2m": values["temperature_2m"],
+        "relative_humidity_2m": values["relative_humidity_2m"],
+        'apparent_temperature': values["apparent_temperature"],
+        'precipitation': values["precipitation"],
+        'rain': values["rain"],
+        'showers': values["showers"],
+        'snowfall': values["snowfall"],
+        'pressure_msl': values["pressure_msl"],
+        'surface_pressure': values["surface_pressure"],
+        'cloud_cover': values["cloud_cover"],
+        'wind_speed_10m': values["wind_speed_10m"],
+        'wind_direction_10m': values["wind_direction_10m"],
+        'wind_gusts_10m': values["wind_gusts_10m"],
+        'is_day': values["is_day"]
     }
-    
-    new_df = pd.DataFrame(new_dic)
-    
+
+# One row per response with the derived date parts and weather cluster, all
+# cities converted and clustered together
+def extract_observations(responses):
+    new_df = pd.DataFrame([read_current(response) for response in responses])
+
     # Ensure the 'date' column is in datetime format
     new_df['date'] = pd.to_datetime(new_df['date'])
     new_df['year'] = new_df['date'].dt.year
@@ -106,15 +125,9 @@ def data_extraction(responses, table_name):
     new_df['hour'] = new_df['date'].dt.hour
     # Remove the time component from the 'date' column, keeping only the date
     new_df['date'] = new_df['date'].dt.date
-    
-    cluster_df = new_df[['temperature_2m', 'precipitation', 'rain', 'showers']]
-    scaled_cluster_df = cluster_scaler.transform(cluster_df)
-    
-    # generate the cluster
-    cluster_labels = cluster_model.predict(scaled_cluster_df)
-
-    # Add cluster labels to the original dataset
-    new_df['cluster'] = cluster_labels
+
+    # Cluster every row in one vectorized distance computation
+    new_df['cluster'] = cluster_assigner.assign_frame(new_df)
     new_df['date'] = pd.to_datetime(new_df['date'], format='%d-%m-%Y', errors='coerce').dt.date
     new_df['is_day'] = new_df['is_day'].astype(bool)  # Convert 'is_day' to boolean
     new_df['year'] = new_df['year'].astype(int)  # Ensure 'year' is an integer
@@ -122,77 +135,184 @@ def data_extraction(responses, table_name):
     new_df['day'] = new_df['day'].astype(int)  # Ensure 'day' is an integer
     new_df['hour'] = new_df['hour'].astype(int)  # Ensure 'hour' is an integer
     new_df['cluster'] = new_df['cluster'].astype(int)  # Ensure 'cluster' is an integer
-
-    update_bigquery_table(new_df, table_name)
+    return new_df
 
 # Define your cache session and retry session
 cache_session = requests_cache.CachedSession('.cache', expire_after=600)
 retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
 openmeteo = openmeteo_requests.Client(session = retry_session)
 
-url = "https://api.open-meteo.com/v1/forecast"
-
-# Function to fetch data
-def fetch_weather_colchester():
-    colchester_params = {
-        "latitude": 51.8959,
-        "longitude": 0.8919,
-        "current": [
-            "temperature_2m", "relative_humidity_2m", "apparent_temperature", "is_day", "precipitation", "rain",
-            "showers", "snowfall", "weather_code", "cloud_cover", "pressure_msl", "surface_pressure",
-            "wind_speed_10m", "wind_direction_10m", "wind_gusts_10m"
-        ]
-    }
-    try:
-        colchester_response = openmeteo.weather_api(url, params=colchester_params)
-        data_extraction(colchester_response, TABLES["colchester"])
-    except Exception as e:
-        print(f"Error fetching Colchester weather data: {e}")
-        
-# Function to fetch data
-def fetch_weather_london():
-    london_params = {
-        "latitude": 51.5072,
-        "longitude": 0.1276,
-        "current": [
-            "temperature_2m", "relative_humidity_2m", "apparent_temperature", "is_day", "precipitation", "rain",
-            "showers", "snowfall", "weather_code", "cloud_cover", "pressure_msl", "surface_pressure",
-            "wind_speed_10m", "wind_direction_10m", "wind_gusts_10m"
-        ]
-    }
-    try:
-        london_response = openmeteo.weather_api(url, params=london_params)
-        data_extraction(london_response, TABLES["london"])
-    except Exception as e:
-        print(f"Error fetching London weather data: {e}")
-        
-# Function to fetch data
-def fetch_weather_bristol():
-    bristol_params = {
-        "latitude": 51.4545,
-        "longitude": 2.5879,
-        "current": [
-            "temperature_2m", "relative_humidity_2m", "apparent_temperature", "is_day", "precipitation", "rain",
-            "showers", "snowfall", "weather_code", "cloud_cover", "pressure_msl", "surface_pressure",
-            "wind_speed_10m", "wind_direction_10m", "wind_gusts_10m"
-        ]
+# OPEN_METEO_URL can point the ingestion at a local stub of the API
+url = os.environ.get("OPEN_METEO_URL", "https://api.open-meteo.com/v1/forecast")
+
+CURRENT_VARIABLES = [
+    "temperature_2m", "relative_humidity_2m", "apparent_temperature", "is_day", "precipitation", "rain",
+    "showers", "snowfall", "weather_code", "cloud_cover", "pressure_msl", "surface_pressure",
+    "wind_speed_10m", "wind_direction_10m", "wind_gusts_10m"
+]
+
+# Coordinates of the cities ingested on every tick, from cities.json (see
+# stations.py)
+CITIES = {city["name"]: {"latitude": city["latitude"], "longitude": city["longitude"]} for city in load_cities()}
+
+# Open-Meteo answers many coordinates in one call; larger city lists are
+# split into chunks fetched with bounded parallelism
+LOCATIONS_PER_CALL = int(os.environ.get("LOCATIONS_PER_CALL", 100))
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", 4))
+
+# A failed call is retried FETCH_RETRIES times with jittered exponential
+# backoff. Cities whose call still fails are skipped for the rest of the
+# tick without holding up the others, and sit out later ticks for a backoff
+# doubling per consecutive failure, up to CITY_BACKOFF_MAX_SECONDS. When due
+# again they are fetched one per call, so one bad location can't fail a
+# whole chunk twice.
+FETCH_RETRIES = int(os.environ.get("FETCH_RETRIES", 2))
+FETCH_BACKOFF_SECONDS = float(os.environ.get("FETCH_BACKOFF_SECONDS", 1))
+CITY_BACKOFF_MAX_SECONDS = float(os.environ.get("CITY_BACKOFF_MAX_SECONDS", 3600))
+
+# city -> (consecutive failed ticks, monotonic time it is due again)
+city_backoff = {}
+city_backoff_lock = threading.Lock()
+
+def fetch_chunk(cities, client):
+    params = {
+        "latitude": [CITIES[city]["latitude"] for city in cities],
+        "longitude": [CITIES[city]["longitude"] for city in cities],
+        "current": CURRENT_VARIABLES,
     }
+    for attempt in range(FETCH_RETRIES + 1):
+        try:
+            with metrics.stage("open-meteo", api_seconds):
+                responses = client.weather_api(url, params=params)
+            return dict(zip(cities, responses))
+        except Exception:
+            if attempt == FETCH_RETRIES:
+                for city in cities:
+                    ingest_failures.inc(city=city, stage="fetch")
+                raise
+            time.sleep(FETCH_BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5))
+
+def record_fetch(cities, failed):
+    with city_backoff_lock:
+        for city in cities:
+            if not failed:
+                city_backoff.pop(city, None)
+                continue
+            failures = city_backoff.get(city, (0, 0))[0] + 1
+            delay = min(FETCH_BACKOFF_SECONDS * 2 ** failures, CITY_BACKOFF_MAX_SECONDS)
+            city_backoff[city] = (failures, time.monotonic() + delay)
+
+# Current responses of the `cities` that are not backing off, keyed by city;
+# cities that failed are missing
+def fetch_weather(cities=None, client=None):
+    cities = list(cities or CITIES)
+    client = client or openmeteo
+    now = time.monotonic()
+    with city_backoff_lock:
+        healthy = [city for city in cities if city not in city_backoff]
+        retrying = [city for city in cities if city in city_backoff and city_backoff[city][1] <= now]
+    chunks = [healthy[i:i + LOCATIONS_PER_CALL] for i in range(0, len(healthy), LOCATIONS_PER_CALL)]
+    chunks += [[city] for city in retrying]
+    responses = {}
+    if not chunks:
+        return responses
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(chunks))) as pool:
+        futures = {pool.submit(fetch_chunk, chunk, client): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                responses.update(future.result())
+            except Exception as e:
+                print(f"Error fetching weather data for {', '.join(chunk)}: {e}")
+                record_fetch(chunk, failed=True)
+            else:
+                record_fetch(chunk, failed=False)
+    return {city: responses[city] for city in cities if city in responses}
+
+# API latency, rows written and failures per city, served on /metrics
+# (see metrics.py)
+api_seconds = metrics.Histogram("ingest_api_seconds", "Open-Meteo call latency")
+tick_seconds = metrics.Histogram("ingest_tick_seconds", "Ingestion tick latency")
+rows_written = metrics.Counter("ingest_rows_written_total", "Observations written to storage", ["city"])
+ingest_failures = metrics.Counter("ingest_failures_total", "Failed fetches, writes and forecasts",
+                                  ["city", "stage"])
+duplicates_skipped = metrics.Counter("ingest_duplicates_skipped_total",
+                                     "Observations already ingested, e.g. from a cached API response", ["city"])
+
+# Write a flushed batch and count it per city; raises so the buffer keeps it.
+# A batch replayed after a restart can repeat an hour; only its last row is
+# kept, and the storage upserts it over any copy already written.
+def write_observations(dataframe):
+    dataframe = dataframe.drop_duplicates(["city", "date", "hour"], keep="last")
+    counts = dataframe["city"].value_counts()
     try:
-        bristol_response = openmeteo.weather_api(url, params=bristol_params)
-        data_extraction(bristol_response, TABLES["bristol"])
-    except Exception as e:
-        print(f"Error fetching Bristol weather data: {e}")
+        storage.append_observations(dataframe)
+    except Exception:
+        for city in counts.index:
+            ingest_failures.inc(city=city, stage="write")
+        raise
+    for city, n in counts.items():
+        rows_written.inc(int(n), city=city)
+    materialize_forecasts(list(counts.index))
+    notify_backend(list(counts.index))
+
+# Extracted rows go through a local write-ahead log (see ingest_buffer.py) and
+# are flushed to BigQuery once INGEST_FLUSH_ROWS rows are pending or the oldest
+# is INGEST_FLUSH_SECONDS old. The default of 0 seconds flushes on every tick;
+# raise it to batch several ticks into one write.
+ingest_buffer = IngestBuffer(
+    os.environ.get("INGEST_BUFFER_PATH", "ingest_buffer.sqlite"),
+    writer=write_observations,
+    flush_rows=int(os.environ.get("INGEST_FLUSH_ROWS", 1000)),
+    flush_seconds=float(os.environ.get("INGEST_FLUSH_SECONDS", 0)),
+)
+# Replay whatever a previous run left unflushed
+ingest_buffer.flush()
+
+# Observation time (date, hour) last buffered per city. Responses are cached
+# for 10 minutes, so ticks closer together than that see the same
+# observation again; it is dropped here instead of being rewritten.
+last_ingested = {}
+last_ingested_lock = threading.Lock()
+
+def observation_keys(new_df):
+    return list(zip(new_df["city"], new_df["date"], new_df["hour"]))
+
+def drop_ingested(new_df):
+    with last_ingested_lock:
+        fresh = [last_ingested.get(city) != (day, hour) for city, day, hour in observation_keys(new_df)]
+    for city in new_df["city"][[not keep for keep in fresh]]:
+        duplicates_skipped.inc(city=city)
+    return new_df[fresh]
+
+# One ingestion tick: fetch every city, extract them together, log the new
+# observations and flush the buffer if a micro-batch is due
+def ingest(cities=None, client=None):
+    responses = fetch_weather(cities, client)
+    if not responses:
+        return None
+    new_df = extract_observations(list(responses.values()))
+    new_df.insert(0, "city", list(responses))
+    new_df = drop_ingested(new_df)
+    if len(new_df):
+        ingest_buffer.append(new_df)
+        with last_ingested_lock:
+            last_ingested.update((city, (day, hour)) for city, day, hour in observation_keys(new_df))
+    ingest_buffer.flush_if_due()
+    return new_df
 
 
 @app.route("/")
 def main():
-    fetch_weather_colchester()
-    fetch_weather_london()
-    fetch_weather_bristol()
+    with metrics.stage("tick", tick_seconds):
+        ingest()
     return jsonify({"message": "Weather data updated successfully"}), 200
 
+# Prometheus scrape endpoint
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))  # Use the PORT environment variable or default to 8080
     app.run(host="0.0.0.0", port=port)
-
-
@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+# Forecasts only change when a new observation is ingested, so results are
+# kept per (city, latest observation time). Each city also remembers when its
+# latest observation was last checked:
+#   - younger than `ttl`: served straight from memory
+#   - younger than `ttl + stale_ttl`: served stale while one background
+#     refresh re-checks the city
+#   - otherwise: the caller waits for a refresh
+# Concurrent refreshes of the same city are coalesced into a single call.
+#
+# Loading and computing are batched so several cities can share one query
+# and one predict call per model:
+#   load_many(cities) -> {city: (observed_at, data)}
+#   compute_many([data, ...]) -> [forecast, ...]
+#
+# load_many leaves out cities with nothing to forecast yet, such as a city
+# without observations. Lookups give None for them, remembered and
+# re-checked like any other city.
+#
+# expire(cities) forgets what is cached for the cities, e.g. after their
+# observations were written; a refresh that was already running for them
+# still answers its callers but doesn't cache what it read.
+class ForecastCache:
+    def __init__(self, ttl=60, stale_ttl=600, max_entries=256, refresh_workers=2):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (city, observed_at) -> forecast
+        self.latest = {}  # city -> ((city, observed_at) or None, checked_at)
+        self.in_flight = {}  # city -> Future
+        self.expired = {}  # city -> number of expire() calls, to spot refreshes that overlap one
+        self.lock = threading.Lock()
+        self.refresh_pool = ThreadPoolExecutor(max_workers=refresh_workers,
+                                               thread_name_prefix="forecast-refresh")
+
+    # Fresh forecasts for all `cities` straight from memory, or None if any of
+    # them needs a refresh. Never blocks on loading or computing.
+    def get_fresh(self, cities):
+        now = time.monotonic()
+        results = {}
+        with self.lock:
+            for city in cities:
+                latest = self.latest.get(city)
+                if latest is None or now - latest[1] >= self.ttl:
+                    return None
+                if latest[0] is None:
+                    results[city] = None
+                elif latest[0] in self.entries:
+                    results[city] = self.entries[latest[0]]
+                else:
+                    return None
+        return results
+
+    def get(self, city, load_many, compute_many):
+        return self.get_many([city], load_many, compute_many)[city]
+
+    def get_many(self, cities, load_many, compute_many):
+        now = time.monotonic()
+        results, waiting, leading, stale = {}, {}, {}, {}
+        with self.lock:
+            for city in cities:
+                latest = self.latest.get(city)
+                if latest is not None and (latest[0] is None or latest[0] in self.entries):
+                    key, checked_at = latest
+                    age = now - checked_at
+                    if age < self.ttl:
+                        if key is not None:
+                            self.entries.move_to_end(key)
+                        results[city] = self.entries.get(key)
+                        continue
+                    if age < self.ttl + self.stale_ttl:
+                        results[city] = self.entries.get(key)
+                        if city not in self.in_flight:
+                            stale[city] = self.in_flight[city] = Future()
+                        continue
+                if city in self.in_flight:
+                    waiting[city] = self.in_flight[city]
+                else:
+                    leading[city] = self.in_flight[city] = Future()
+        if stale:
+            self.refresh_pool.submit(self._refresh, stale, load_many, compute_many)
+        if leading:
+            self._refresh(leading, load_many, compute_many)
+        for city, future in {**waiting, **leading}.items():
+            results[city] = future.result()
+        return {city: results[city] for city in cities}
+
+    def _refresh(self, futures, load_many, compute_many):
+        with self.lock:
+            started = {city: self.expired.get(city, 0) for city in futures}
+        try:
+            loaded = load_many(list(futures))
+            keys = {city: (city, loaded[city][0]) for city in futures if city in loaded}
+            with self.lock:
+                forecasts = {city: self.entries[key] for city, key in keys.items() if key in self.entries}
+            missing = [city for city in keys if city not in forecasts]
+            if missing:
+                forecasts.update(zip(missing, compute_many([loaded[city][1] for city in missing])))
+            with self.lock:
+                checked_at = time.monotonic()
+                for city in futures:
+                    if self.expired.get(city, 0) != started[city]:
+                        continue
+                    key = keys.get(city)
+                    if key is not None:
+                        self.entries[key] = forecasts[city]
+                        self.entries.move_to_end(key)
+                    self.latest[city] = (key, checked_at)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        except Exception as e:
+            print(f"Failed to refresh forecasts for {', '.join(futures)}: {e}")
+            for future in futures.values():
+                future.set_exception(e)
+        else:
+            for city, future in futures.items():
+                future.set_result(forecasts.get(city))
+        finally:
+            with self.lock:
+                for city in futures:
+                    self.in_flight.pop(city, None)
+
+    # Make the next lookup of `cities` reload them. Their cached forecasts
+    # are dropped too, since an observation may have been rewritten in place
+    # and keep its time.
+    def expire(self, cities):
+        cities = set(cities)
+        with self.lock:
+            for city in cities:
+                self.latest.pop(city, None)
+                self.expired[city] = self.expired.get(city, 0) + 1
+            for key in [key for key in self.entries if key[0] in cities]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.latest.clear()
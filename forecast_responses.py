@@ -0,0 +1,86 @@
+import gzip
+import hashlib
+import json
+import os
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # optional, the standard encoder gives the same bytes more slowly
+    orjson = None
+
+
+# Forecast responses are encoded once per (city, issue time) and kept in the
+# forecast cache as bytes, with an ETag and Last-Modified taken from the
+# issue time, so a request only picks bytes or answers 304 Not Modified.
+# Bodies of at least GZIP_MIN_BYTES are also gzipped once, on first demand.
+GZIP_MIN_BYTES = int(os.environ.get("GZIP_MIN_BYTES", 512))
+
+
+def encode_json(content):
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def http_date(timestamp):
+    return format_datetime(timestamp.to_pydatetime().replace(tzinfo=timezone.utc), usegmt=True)
+
+
+class EncodedForecast:
+    def __init__(self, forecast, issued_at, body=None):
+        self.forecast = forecast
+        self.issued_at = issued_at
+        self.body = encode_json(forecast) if body is None else body
+        # The issue time names the observation; the digest tells forecasts of
+        # the same observation by different model versions apart
+        digest = hashlib.blake2b(self.body, digest_size=8).hexdigest()
+        self.etag = f'"{issued_at:%Y%m%d%H}-{digest}"'
+        self.last_modified = http_date(issued_at)
+        self._gzipped = None
+
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, mtime=0)
+        return self._gzipped
+
+
+# Several cities as one JSON object keyed by city, built from their bytes
+def combine(encoded):
+    body = b"{" + b",".join(encode_json(city) + b":" + item.body for city, item in encoded.items()) + b"}"
+    return EncodedForecast(None, max(item.issued_at for item in encoded.values()), body)
+
+
+def not_modified(request, encoded):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or encoded.etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return since.tzinfo is not None and since >= parsedate_to_datetime(encoded.last_modified)
+    return False
+
+
+# 304 when the client's copy is current, else the (possibly gzipped) bytes
+def respond(request, encoded):
+    headers = {
+        "ETag": encoded.etag,
+        "Last-Modified": encoded.last_modified,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if not_modified(request, encoded):
+        return Response(status_code=304, headers=headers)
+    body = encoded.body
+    if len(body) >= GZIP_MIN_BYTES and "gzip" in request.headers.get("accept-encoding", ""):
+        body = encoded.gzipped()
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, media_type="application/json", headers=headers)
@@ -0,0 +1,71 @@
+import asyncio
+from collections import defaultdict
+
+
+# Pushes new forecasts to stream subscribers. One watcher task checks the
+# cities that have subscribers every `poll_seconds`, or at once when woken by
+# the ingestion service, through the same cached path as the other routes,
+# and hands each changed forecast to every subscriber of its city. Backend
+# load therefore follows the number of updates, not the number of viewers.
+#
+#   fetch(cities) -> {city: EncodedForecast}   (async)
+class ForecastBroadcaster:
+    def __init__(self, fetch, poll_seconds=15, queue_size=64):
+        self.fetch = fetch
+        self.poll_seconds = poll_seconds
+        self.queue_size = queue_size
+        self.subscribers = defaultdict(set)  # city -> {asyncio.Queue}
+        self.etags = {}  # city -> etag of the last forecast pushed
+        self.wake = None
+        self.task = None
+
+    # Queue receiving (city, EncodedForecast) for every change in `cities`
+    def subscribe(self, cities):
+        if self.task is None or self.task.done():
+            self.wake = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        for city in cities:
+            self.subscribers[city].add(queue)
+        return queue
+
+    def unsubscribe(self, cities, queue):
+        for city in cities:
+            self.subscribers[city].discard(queue)
+            if not self.subscribers[city]:
+                del self.subscribers[city]
+
+    # Check now instead of at the next poll, e.g. after an ingestion
+    def notify(self):
+        if self.wake is not None:
+            self.wake.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            cities = list(self.subscribers)
+            if not cities:
+                continue
+            try:
+                forecasts = await self.fetch(cities)
+            except Exception as e:
+                print(f"Failed to check forecasts for {', '.join(cities)}: {e}")
+                continue
+            for city, encoded in forecasts.items():
+                if self.etags.get(city) == encoded.etag:
+                    continue
+                self.etags[city] = encoded.etag
+                for queue in list(self.subscribers.get(city, ())):
+                    self.publish(queue, (city, encoded))
+
+    # A subscriber that stopped reading loses its oldest updates, never blocks
+    # the others
+    @staticmethod
+    def publish(queue, item):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(item)
@@ -0,0 +1,231 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from features import MAX_LAG, MODEL_FEATURES, build_window, feature_names, model_input
+from model_registry import ModelRegistry
+from pipelines import build_pipeline
+
+# Forecasts from observation windows, shared by the API (backend.py) and by
+# the ingestion service when it materializes forecasts (files_updation.py)
+
+stage_seconds = metrics.Histogram("weather_stage_seconds", "Forecast latency by stage", ["stage"])
+model_seconds = metrics.Histogram("weather_model_seconds", "Fused pipeline predict latency by model", ["model"])
+
+# The models only look at the latest observation and its lags, so a request
+# never needs more than MAX_LAG + 1 rows (the rain model uses two lags)
+WINDOW_SIZE = MAX_LAG + 1
+
+# Whether a window holds the newest observation and all MAX_LAG lags. A
+# shorter one would be padded with NaN lags, which the fused and compiled
+# models don't reject, so it is never forecast.
+def full_window(data):
+    return len(data) >= WINDOW_SIZE
+
+# Timestamp of the newest observation in a window, used as the cache key
+def observation_time(data):
+    last = data.iloc[-1]
+    return pd.Timestamp(last["date"]) + pd.Timedelta(hours=int(last["hour"]))
+
+# Observation rows (oldest first) as the window frame the models expect
+def window_frame(rows):
+    data = pd.DataFrame(list(rows))
+    data["is_day"] = data["is_day"].astype(int)
+    return data
+
+
+# Models and scalers are listed in Models/manifest.json and loaded lazily,
+# memory-mapped, on first use. MODEL_WARMUP=1 loads them at startup instead.
+registry = ModelRegistry()
+for target in MODEL_FEATURES:
+    if registry.features(target) != feature_names(target):
+        raise ValueError(f"Manifest features of {target} don't match features.MODEL_FEATURES")
+if os.environ.get("MODEL_WARMUP", "0") == "1":
+    registry.warm_up(list(MODEL_FEATURES))
+
+# Tree ensembles compiled by tree_compiler.py into flat arrays are much faster
+# for the handful of rows of a request; past COMPILED_MAX_ROWS rows the native
+# estimators win again. COMPILED_MODELS=0 always uses the originals.
+USE_COMPILED = os.environ.get("COMPILED_MODELS", "1") == "1"
+COMPILED_MAX_ROWS = int(os.environ.get("COMPILED_MAX_ROWS", 128))
+
+# Scalers and model fused into one pipeline per target (see pipelines.py),
+# built on first use
+pipelines = {}
+
+def pipeline(target):
+    fused = pipelines.get(target)
+    if fused is None:
+        fused = pipelines[target] = build_pipeline(registry, target, USE_COMPILED, COMPILED_MAX_ROWS)
+    return fused
+
+# Each predictor takes a stack of feature windows from features.build_window
+# (one row per city), built once per request and shared by all five models,
+# and returns one 5-hour forecast per row
+
+def predict_temp(windows):
+    pred = pipeline("temperature").predict(model_input(windows, "temperature"))
+    return np.rint(pred).astype(int).tolist()
+
+def predict_rain(windows):
+    pred = pipeline("rain").predict(model_input(windows, "rain"))
+    return np.round(np.maximum(pred, 0), 1).tolist()
+
+def predict_snow(windows):
+    pred = pipeline("snow").predict(model_input(windows, "snow"))
+    return np.round(np.maximum(pred, 0), 1).tolist()
+
+def predict_cloud_cover(windows):
+    pred = pipeline("cloud").predict(model_input(windows, "cloud"))
+    return np.rint(np.maximum(pred, 0)).astype(int).tolist()
+
+def predict_windspeed(windows):
+    pred = pipeline("wind").predict(model_input(windows, "wind"))
+    return np.round(np.maximum(pred, 0), 1).tolist()
+
+WEATHER_CONDITIONS = np.array(['clear', 'cloudy', 'rain and clear', 'rain and cloudy', 'snow and clear',
+                               'snow and cloudy', None], dtype=object)
+
+# Vectorized over arrays of hours; the first matching condition wins
+def categorize_weather(precipitation, snowfall, cloud_cover):
+    precipitation = np.asarray(precipitation, dtype=np.float64)
+    snowfall = np.asarray(snowfall, dtype=np.float64)
+    cloud_cover = np.asarray(cloud_cover, dtype=np.float64)
+    sunny = cloud_cover < 40
+    cloudy = cloud_cover >= 40
+    conditions = [
+        (precipitation == 0) & sunny,   # Sunny
+        (precipitation == 0) & cloudy,  # Cloudy
+        (precipitation > 0) & sunny,    # Rain and Sunny
+        (precipitation > 0) & cloudy,   # Rain and Cloudy
+        (snowfall > 0) & sunny,         # Snow and Sunny
+        (snowfall > 0) & cloudy,        # Snow and Cloudy
+    ]
+    labels = np.select(conditions, range(len(conditions)), default=len(conditions))
+    return WEATHER_CONDITIONS[labels].tolist()
+
+# Forecast fields and the predictor producing each of them
+PREDICTORS = {
+    "temperature": predict_temp,
+    "precipitation": predict_rain,
+    "snowfall": predict_snow,
+    "cloud_cover": predict_cloud_cover,
+    "wind": predict_windspeed,
+}
+
+# How the five predictors of a request are run:
+#   serial  - one after another
+#   thread  - concurrently on a thread pool; the tree ensembles and numpy
+#             release the GIL for most of their predict time
+#   process - concurrently on a process pool, for estimators that hold it
+INFERENCE_MODE = os.environ.get("INFERENCE_MODE", "thread")
+if INFERENCE_MODE == "serial":
+    model_pool = None
+elif INFERENCE_MODE == "thread":
+    model_pool = ThreadPoolExecutor(max_workers=len(PREDICTORS), thread_name_prefix="model")
+elif INFERENCE_MODE == "process":
+    model_pool = ProcessPoolExecutor(max_workers=int(os.environ.get("MODEL_PROCESSES", len(PREDICTORS))))
+else:
+    raise ValueError(f"Unknown INFERENCE_MODE {INFERENCE_MODE!r}, expected serial, thread or process")
+
+# Duration in seconds of the latest call of each predictor
+model_timings = {}
+
+def timed_predict(name, windows):
+    start = time.perf_counter()
+    result = PREDICTORS[name](windows)
+    return result, time.perf_counter() - start
+
+def run_predictors(windows):
+    if model_pool is None:
+        results = {name: timed_predict(name, windows) for name in PREDICTORS}
+    else:
+        futures = {name: model_pool.submit(timed_predict, name, windows) for name in PREDICTORS}
+        results = {name: future.result() for name, future in futures.items()}
+    model_timings.update({name: seconds for name, (_, seconds) in results.items()})
+    for name, (_, seconds) in results.items():
+        metrics.record(f"model-{name}", seconds, model_seconds, model=name)
+    return {name: result for name, (result, _) in results.items()}
+
+def forecast_weather(data):
+    return forecast_weather_batch([data])[0]
+
+# Forecasts for several cities with one predict call per model
+def forecast_weather_batch(datas):
+    if not all(full_window(data) for data in datas):
+        raise ValueError(f"Not enough observations: forecasts need the latest {WINDOW_SIZE} hours of each city")
+    with metrics.stage("features", stage_seconds, stage="features"):
+        windows = np.vstack([build_window(data) for data in datas])
+    predictions = run_predictors(windows)
+    with metrics.stage("postprocess", stage_seconds, stage="postprocess"):
+        return build_forecasts(datas, predictions)
+
+# Response dictionaries of the cities from the predictions of all models
+def build_forecasts(datas, predictions):
+    tempre_lists = predictions["temperature"]
+    precipitation_lists = predictions["precipitation"]
+    snow_lists = predictions["snowfall"]
+    cloud_lists = predictions["cloud_cover"]
+    windspeed_lists = predictions["wind"]
+
+    forecasts = []
+    for i, data in enumerate(datas):
+        conditions_list = categorize_weather(precipitation_lists[i], snow_lists[i], cloud_lists[i])
+        forecast = [
+            {
+                "temperature": temperature,
+                "precipitation": precipitation,
+                "snowfall": snowfall,
+                "cloud_cover": cloud_cover,
+                "wind": wind,
+                "conditions": conditions,
+            }
+            for temperature, precipitation, snowfall, cloud_cover, wind, conditions in zip(
+                tempre_lists[i], precipitation_lists[i], snow_lists[i], cloud_lists[i], windspeed_lists[i],
+                conditions_list)
+        ]
+
+        now = data.iloc[-1]
+        forecasts.append({
+            "forecast": forecast,
+            "current": {
+                "temperature": int(round(float(now.temperature_2m))),
+                "feels_like": int(round(float(now.apparent_temperature))),
+                "precipitation": round(float(now.precipitation)),
+                "snowfall": round(float(now.snowfall)),
+                "windspeed": round(float(now.wind_speed_10m), 1),
+                "conditions": categorize_weather([now.precipitation], [now.snowfall], [now.cloud_cover])[0],
+                "is_day": bool(now.is_day),
+                "humidity": round(float(now.relative_humidity_2m)),
+                "pressure": round(float(now.surface_pressure), 1)
+            },
+        })
+    return forecasts
+
+
+# Forecast of a location between stations: the stations' forecasts averaged
+# hour by hour with `weights` (summing to 1), rounded like the predictors
+# round them, with conditions recomputed from the blended values. Current
+# conditions are observations, so they are the heaviest station's.
+def blend_forecasts(forecasts, weights):
+    weights = np.asarray(weights, dtype=np.float64)
+    def blended(field):
+        return weights @ np.array([[hour[field] for hour in forecast["forecast"]] for forecast in forecasts],
+                                  dtype=np.float64)
+    temperature = np.rint(blended("temperature")).astype(int).tolist()
+    precipitation = np.round(blended("precipitation"), 1).tolist()
+    snowfall = np.round(blended("snowfall"), 1).tolist()
+    cloud_cover = np.rint(blended("cloud_cover")).astype(int).tolist()
+    wind = np.round(blended("wind"), 1).tolist()
+    conditions = categorize_weather(precipitation, snowfall, cloud_cover)
+    return {
+        "forecast": [
+            {"temperature": t, "precipitation": p, "snowfall": s, "cloud_cover": c, "wind": w, "conditions": k}
+            for t, p, s, c, w, k in zip(temperature, precipitation, snowfall, cloud_cover, wind, conditions)
+        ],
+        "current": forecasts[int(weights.argmax())]["current"],
+    }
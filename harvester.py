@@ -0,0 +1,186 @@
+import argparse
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+import openmeteo_requests
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
+from retry_requests import retry
+
+from clustering import load_assigner
+from data_injection import DTYPES
+from model_registry import ModelRegistry
+from stations import load_cities
+from storage import OBSERVATION_COLUMNS
+
+# Historical hourly observations from the Open-Meteo historical forecast API,
+# the source of Data/raw.csv and Data/processed.csv, for any date range and
+# any number of locations:
+#
+#   python harvester.py colchester=51.8959,0.8919 london=51.5072,-0.1276 \
+#       --start 2022-01-01 --end 2024-10-31 --output Data/history
+#
+# Without locations, every city of cities.json is harvested.
+#
+# The range is split into chunks of `chunk_days` days and the locations into
+# groups of `locations_per_call` answered by one API call; at most `workers`
+# calls are in flight. Each chunk of each location is typed like the city
+# tables, given its year/month/day/hour and cluster columns, and written as
+# its own Parquet file of a dataset partitioned by city:
+#
+#   Data/history/city=london/20220101-20220331.parquet
+#
+# Parts are written atomically, so a rerun after a failure only fetches the
+# chunks that have no part yet. Memory stays bounded by the chunks in flight
+# whatever the range. Part files and city directories can be fed to
+# data_injection.py, training.py and backtest.py.
+
+HISTORICAL_API_URL = os.environ.get("HISTORICAL_API_URL", "https://historical-forecast-api.open-meteo.com/v1/forecast")
+CHUNK_DAYS = int(os.environ.get("HARVEST_CHUNK_DAYS", 90))
+LOCATIONS_PER_CALL = int(os.environ.get("HARVEST_LOCATIONS_PER_CALL", 10))
+HARVEST_WORKERS = int(os.environ.get("HARVEST_WORKERS", 4))
+
+DERIVED_COLUMNS = ["year", "month", "day", "hour", "cluster"]
+# Hourly variables requested, in response order
+HOURLY_VARIABLES = [column for column in OBSERVATION_COLUMNS if column not in DERIVED_COLUMNS + ["date"]]
+
+SCHEMA = pa.schema([("date", pa.timestamp("ns"))] + [
+    (column, pa.from_numpy_dtype(np.dtype(DTYPES[column]))) for column in OBSERVATION_COLUMNS if column != "date"])
+
+
+def default_client():
+    return openmeteo_requests.Client(session=retry(requests.Session(), retries=5, backoff_factor=0.2))
+
+
+# (first day, last day) pairs covering start..end, both inclusive
+def date_chunks(start, end, chunk_days=CHUNK_DAYS):
+    start, end = pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize()
+    chunks = []
+    while start <= end:
+        last = min(start + pd.Timedelta(days=chunk_days - 1), end)
+        chunks.append((start, last))
+        start = last + pd.Timedelta(days=1)
+    return chunks
+
+
+def part_path(output, city, first, last):
+    return os.path.join(output, f"city={city}", f"{first:%Y%m%d}-{last:%Y%m%d}.parquet")
+
+
+# Hourly rows of one response with the derived columns, typed like the city
+# tables. Hours the API has no values for are dropped.
+def observations(response, assigner):
+    hourly = response.Hourly()
+    times = pd.date_range(
+        start=pd.to_datetime(hourly.Time(), unit="s", utc=True),
+        end=pd.to_datetime(hourly.TimeEnd(), unit="s", utc=True),
+        freq=pd.Timedelta(seconds=hourly.Interval()),
+        inclusive="left",
+    ).tz_convert(None)
+    frame = pd.DataFrame({name: hourly.Variables(i).ValuesAsNumpy() for i, name in enumerate(HOURLY_VARIABLES)})
+    frame = frame[frame.notna().all(axis=1).to_numpy()]
+    times = times[frame.index]
+    frame.insert(0, "date", times.normalize())
+    frame["year"] = times.year
+    frame["month"] = times.month
+    frame["day"] = times.day
+    frame["hour"] = times.hour
+    frame["cluster"] = assigner.assign_frame(frame)
+    return frame.astype(DTYPES)[OBSERVATION_COLUMNS].reset_index(drop=True)
+
+
+def write_part(path, frame):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    pq.write_table(pa.Table.from_pandas(frame, schema=SCHEMA, preserve_index=False), tmp_path)
+    os.replace(tmp_path, path)
+
+
+# One API call for a group of locations over one chunk; writes a part per
+# location and returns the rows written
+def harvest_chunk(client, locations, first, last, output, assigner):
+    params = {
+        "latitude": [latitude for _, latitude, _ in locations],
+        "longitude": [longitude for _, _, longitude in locations],
+        "start_date": f"{first:%Y-%m-%d}",
+        "end_date": f"{last:%Y-%m-%d}",
+        "hourly": HOURLY_VARIABLES,
+    }
+    responses = client.weather_api(HISTORICAL_API_URL, params=params)
+    rows = 0
+    for (city, _, _), response in zip(locations, responses):
+        frame = observations(response, assigner)
+        write_part(part_path(output, city, first, last), frame)
+        rows += len(frame)
+    return rows
+
+
+def harvest(locations, start, end, output, chunk_days=CHUNK_DAYS, locations_per_call=LOCATIONS_PER_CALL,
+            workers=HARVEST_WORKERS, client=None):
+    client = client or default_client()
+    assigner = load_assigner(ModelRegistry())
+    tasks = []
+    for first, last in date_chunks(start, end, chunk_days):
+        missing = [location for location in locations
+                   if not os.path.exists(part_path(output, location[0], first, last))]
+        for i in range(0, len(missing), locations_per_call):
+            tasks.append((missing[i:i + locations_per_call], first, last))
+    print(f"Harvesting {len(tasks)} chunks into {output}.")
+
+    def describe(task):
+        group, first, last = task
+        return f"{', '.join(city for city, _, _ in group)} {first:%Y-%m-%d}..{last:%Y-%m-%d}"
+
+    rows = failed = 0
+
+    def collect(finished):
+        nonlocal rows, failed
+        for future in finished:
+            task = in_flight.pop(future)
+            try:
+                rows += future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Failed to harvest {describe(task)}: {e}")
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="harvest") as pool:
+        in_flight = {}
+        for task in tasks:
+            if len(in_flight) >= workers:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+            in_flight[pool.submit(harvest_chunk, client, *task, output, assigner)] = task
+        collect(wait(in_flight).done)
+    print(f"Harvested {rows} rows; {failed} of {len(tasks)} chunks failed"
+          + (", rerun to retry them." if failed else "."))
+    return rows, failed
+
+
+# 'name=latitude,longitude'
+def parse_location(arg):
+    name, sep, coordinates = arg.partition("=")
+    try:
+        latitude, longitude = (float(value) for value in coordinates.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected name=latitude,longitude, got {arg!r}")
+    return name, latitude, longitude
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Harvest historical hourly observations into Parquet")
+    parser.add_argument("locations", nargs="*", type=parse_location,
+                        help="name=latitude,longitude (default: the cities of cities.json)")
+    parser.add_argument("--start", required=True, help="first day, YYYY-MM-DD")
+    parser.add_argument("--end", required=True, help="last day, YYYY-MM-DD")
+    parser.add_argument("--output", default="Data/history")
+    parser.add_argument("--chunk-days", type=int, default=CHUNK_DAYS)
+    parser.add_argument("--locations-per-call", type=int, default=LOCATIONS_PER_CALL)
+    parser.add_argument("--workers", type=int, default=HARVEST_WORKERS)
+    args = parser.parse_args()
+    locations = args.locations or [(city["name"], city["latitude"], city["longitude"]) for city in load_cities()]
+    _, failed = harvest(locations, args.start, args.end, args.output, args.chunk_days,
+                        args.locations_per_call, args.workers)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,97 @@
+import io
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+# Write-ahead buffer for ingested observations. Every extracted batch is
+# first committed to a local SQLite log as a Parquet segment, then flushed to
+# the warehouse in micro-batches once `flush_rows` rows are pending or the
+# oldest pending segment is `flush_seconds` old. Segments are only deleted
+# after the writer succeeded, so a failed flush or a crash keeps them for the
+# next flush, including the replay on restart.
+#
+# The writer receives one DataFrame with every pending row and must raise on
+# failure. Delivery is at-least-once: a crash between a successful write and
+# the delete replays that batch.
+class IngestBuffer:
+    def __init__(self, path, writer, flush_rows=1000, flush_seconds=0, claim_timeout=600):
+        self.path = path
+        self.writer = writer
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        # Claims older than this belong to a flush that died and are retried
+        self.claim_timeout = claim_timeout
+        self.lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS segments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    appended_at REAL NOT NULL,
+                    n_rows INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    claim TEXT,
+                    claimed_at REAL
+                )
+            """)
+
+    # Connection committed on success and always closed
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA synchronous=FULL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def append(self, dataframe):
+        buf = io.BytesIO()
+        dataframe.to_parquet(buf, index=False)
+        with self._connect() as conn:
+            conn.execute("INSERT INTO segments (appended_at, n_rows, data) VALUES (?, ?, ?)",
+                         (time.time(), len(dataframe), buf.getvalue()))
+
+    # Number of pending rows and age in seconds of the oldest pending segment
+    def pending(self):
+        with self._connect() as conn:
+            n_rows, oldest = conn.execute("SELECT COALESCE(SUM(n_rows), 0), MIN(appended_at) FROM segments").fetchone()
+        return n_rows, 0.0 if oldest is None else time.time() - oldest
+
+    def flush_if_due(self):
+        n_rows, age = self.pending()
+        if n_rows and (n_rows >= self.flush_rows or age >= self.flush_seconds):
+            return self.flush()
+        return 0
+
+    # Write every unclaimed segment in one batch; returns the rows written
+    def flush(self):
+        with self.lock:
+            claim = uuid.uuid4().hex
+            now = time.time()
+            with self._connect() as conn:
+                conn.execute("""
+                    UPDATE segments SET claim = ?, claimed_at = ?
+                    WHERE claim IS NULL OR claimed_at < ?
+                """, (claim, now, now - self.claim_timeout))
+                segments = conn.execute("SELECT data FROM segments WHERE claim = ? ORDER BY id",
+                                        (claim,)).fetchall()
+            if not segments:
+                return 0
+            try:
+                batch = pd.concat([pd.read_parquet(io.BytesIO(data)) for data, in segments], ignore_index=True)
+                self.writer(batch)
+            except Exception as e:
+                print(f"Failed to flush {len(segments)} buffered segments, keeping them: {e}")
+                with self._connect() as conn:
+                    conn.execute("UPDATE segments SET claim = NULL, claimed_at = NULL WHERE claim = ?", (claim,))
+                return 0
+            with self._connect() as conn:
+                conn.execute("DELETE FROM segments WHERE claim = ?", (claim,))
+            return len(batch)
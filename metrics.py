@@ -0,0 +1,180 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+
+# In-process counters and histograms, rendered in the Prometheus text format
+# by the /metrics routes of the backend and the ingestion service.
+#
+# `stage(...)` times a block into a histogram and, during a request of the
+# FastAPI backend, into that request's Server-Timing header. Work handed to
+# executors keeps the request's timings when submitted under its context
+# (see `in_context`). METRICS_ENABLED=0 turns every timer into a no-op.
+ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+metrics = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not ENABLED:
+            return
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def observe(self, value, **labels):
+        if not ENABLED:
+            return
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_labels(names, key + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {counts[-1]}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def render():
+    return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+# Stage durations of the current request: name -> seconds
+request_timings = ContextVar("request_timings", default=None)
+
+def record(name, seconds, histogram=None, **labels):
+    if not ENABLED:
+        return
+    if histogram is not None:
+        histogram.observe(seconds, **labels)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_no_timer = _NoTimer()
+
+@contextmanager
+def _timer(name, histogram, labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, histogram, **labels)
+
+# Time a block as `name` in the request timings and into `histogram`
+def stage(name, histogram=None, **labels):
+    if not ENABLED:
+        return _no_timer
+    return _timer(name, histogram, labels)
+
+
+# `fn` bound to the current context, for executors that don't copy it
+def in_context(fn):
+    if not ENABLED:
+        return fn
+    context = copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+http_request_seconds = Histogram("http_request_seconds", "Request latency by route", ["route"])
+http_requests_total = Counter("http_requests_total", "Requests by route and status", ["route", "status"])
+
+
+# ASGI middleware recording every request and answering with a Server-Timing
+# header listing the stage timings recorded while it was handled
+class TimingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not ENABLED or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        timings = {}
+        token = request_timings.set(timings)
+        status = [500]
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings.items()]
+                entries.append(f"total;dur={(time.perf_counter() - start) * 1000:.2f}")
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", ", ".join(entries).encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_timings.reset(token)
+            endpoint = scope.get("endpoint")
+            route = endpoint.__name__ if endpoint is not None else "unmatched"
+            http_request_seconds.observe(time.perf_counter() - start, route=route)
+            http_requests_total.inc(route=route, status=status[0])
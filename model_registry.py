@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import threading
+
+import joblib
+
+
+# Models/manifest.json lists, for every target, the model and scaler files,
+# a version and the feature columns the model was trained on:
+#
+#   {"models": {"rain": {"model": "Models/rain_model.joblib",
+#                        "x_scaler": "Scalers/x_scaler_rain.joblib",
+#                        "y_scaler": "Scalers/y_scaler_rain.joblib",
+#                        "compiled": "Models/compiled/rain_model.joblib",
+#                        "version": "2024-11-18",
+#                        "features": ["precipitation", ...]}, ...}}
+#
+# "compiled" is optional and written by tree_compiler.py.
+#
+# Files are loaded lazily on first use with joblib's mmap_mode, so the numpy
+# arrays inside the estimators (tree node tables, scaler vectors) are mapped
+# from the page cache and shared by every server worker instead of each
+# worker holding a private copy. This requires uncompressed joblib files;
+# `python model_registry.py export` rewrites them that way.
+MANIFEST_PATH = "Models/manifest.json"
+
+
+class ModelRegistry:
+    def __init__(self, manifest_path=MANIFEST_PATH, mmap_mode="r"):
+        self.manifest_path = manifest_path
+        self.root = os.path.dirname(os.path.dirname(os.path.abspath(manifest_path)))
+        self.mmap_mode = mmap_mode
+        with open(manifest_path) as f:
+            self.manifest = json.load(f)["models"]
+        self.loaded = {}
+        self.lock = threading.Lock()
+
+    def targets(self):
+        return list(self.manifest)
+
+    def version(self, target):
+        return self.manifest[target]["version"]
+
+    def features(self, target):
+        return self.manifest[target]["features"]
+
+    def model(self, target):
+        return self._load(target, "model")
+
+    def x_scaler(self, target):
+        return self._load(target, "x_scaler")
+
+    def y_scaler(self, target):
+        return self._load(target, "y_scaler")
+
+    # Flat-array version of the model built by tree_compiler.py, or None
+    def compiled(self, target):
+        return self._load(target, "compiled")
+
+    # Load every file of `targets` (all by default) up front, e.g. before a
+    # worker starts serving so the first requests don't pay for it
+    def warm_up(self, targets=None):
+        for target in targets or self.targets():
+            for kind in ("model", "x_scaler", "y_scaler", "compiled"):
+                self._load(target, kind)
+
+    def _load(self, target, kind):
+        key = (target, kind)
+        try:
+            return self.loaded[key]
+        except KeyError:
+            pass
+        with self.lock:
+            if key not in self.loaded:
+                path = self.manifest[target].get(kind)
+                self.loaded[key] = None if path is None else self._read(target, kind, path)
+            return self.loaded[key]
+
+    def _read(self, target, kind, path):
+        obj = joblib.load(os.path.join(self.root, path), mmap_mode=self.mmap_mode)
+        if kind == "x_scaler":
+            # The scalers were fitted on DataFrames; check their column order
+            # against the manifest once so they can be fed plain arrays
+            fitted = getattr(obj, "feature_names_in_", None)
+            if fitted is not None:
+                if list(fitted) != self.features(target):
+                    raise ValueError(f"Scaler {path} expects columns {list(fitted)}, "
+                                     f"manifest lists {self.features(target)}")
+                del obj.feature_names_in_
+        return obj
+
+
+# Rewrite the registered files uncompressed so they can be memory-mapped,
+# optionally stamping a new version on every entry
+def export(manifest_path=MANIFEST_PATH, version=None):
+    registry = ModelRegistry(manifest_path, mmap_mode=None)
+    manifest = {"models": registry.manifest}
+    for target, entry in registry.manifest.items():
+        for kind in ("model", "x_scaler", "y_scaler", "compiled"):
+            if entry.get(kind) is None:
+                continue
+            path = os.path.join(registry.root, entry[kind])
+            joblib.dump(joblib.load(path), path)
+            print(f"Exported {target} {kind} to {entry[kind]}")
+        if version is not None:
+            entry["version"] = version
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+        f.write("\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the model registry")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="rewrite registered files in mmap-able form")
+    export_parser.add_argument("--manifest", default=MANIFEST_PATH)
+    export_parser.add_argument("--version", help="version to record for every entry")
+    args = parser.parse_args()
+    if args.command == "export":
+        export(args.manifest, args.version)
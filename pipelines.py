@@ -0,0 +1,221 @@
+import argparse
+import copy
+import sys
+import threading
+
+import numpy as np
+
+from model_registry import MANIFEST_PATH, ModelRegistry
+
+
+# Each target used to be predicted in three sklearn calls: x scaler
+# transform, model predict, y scaler inverse_transform, each validating its
+# input and allocating new arrays. A fused pipeline turns the scalers into
+# plain mean/scale vectors once and, where the model allows it, folds them
+# into the model itself:
+#   - linear models: into the coefficients and intercepts
+#   - compiled tree ensembles (tree_compiler.py): into the split thresholds,
+#     the per-output leaf weights and the base scores
+# so a request becomes a single pass over the raw feature rows.
+
+# Per-feature vectors of a fitted x scaler with transform(x) = (x - mean) / scale,
+# computed in that order to match StandardScaler bit for bit
+def scaler_vectors(scaler, n_features):
+    if type(scaler).__name__ == "StandardScaler":
+        mean = scaler.mean_ if scaler.mean_ is not None else np.zeros(n_features)
+        scale = scaler.scale_ if scaler.scale_ is not None else np.ones(n_features)
+        return mean, scale
+    # Any other per-feature affine scaler, e.g. MinMaxScaler
+    offset = scaler.transform(np.zeros((1, n_features)))[0]
+    gain = scaler.transform(np.ones((1, n_features)))[0] - offset
+    return -offset / gain, 1.0 / gain
+
+
+# Inverse of a fitted y scaler as inverse_transform(y) = y * scale + mean
+def inverse_vectors(scaler, n_outputs):
+    if type(scaler).__name__ == "StandardScaler":
+        mean = scaler.mean_ if scaler.mean_ is not None else np.zeros(n_outputs)
+        scale = scaler.scale_ if scaler.scale_ is not None else np.ones(n_outputs)
+        return mean, scale
+    mean = scaler.inverse_transform(np.zeros((1, n_outputs)))[0]
+    return mean, scaler.inverse_transform(np.ones((1, n_outputs)))[0] - mean
+
+
+# Scratch arrays reused by the calls of one thread
+_buffers = threading.local()
+
+def _buffer(key, shape):
+    buffers = _buffers.__dict__.setdefault("arrays", {})
+    buf = buffers.get(key)
+    if buf is None or buf.shape != shape:
+        buf = buffers[key] = np.empty(shape)
+    return buf
+
+
+# Unfolded path: precomputed vectors around the model's own predict
+class ScaledModel:
+    def __init__(self, model, x_scaler, y_scaler, n_outputs):
+        self.model = model
+        self.x_mean, self.x_scale = scaler_vectors(x_scaler, model.n_features_in_)
+        self.y_mean, self.y_scale = inverse_vectors(y_scaler, n_outputs)
+
+    def predict(self, X):
+        x = np.subtract(X, self.x_mean, out=_buffer(id(self), X.shape))
+        x /= self.x_scale
+        y = np.asarray(self.model.predict(x), dtype=np.float64)
+        y *= self.y_scale
+        y += self.y_mean
+        return y
+
+
+# A MultiOutputRegressor of linear models folded with both scalers:
+# y = X @ weights + bias
+class FoldedLinear:
+    def __init__(self, model, x_scaler, y_scaler):
+        estimators = model.estimators_ if hasattr(model, "estimators_") else [model]
+        coef = np.vstack([np.ravel(est.coef_) for est in estimators]).T  # (features, outputs)
+        intercept = np.array([np.ravel(est.intercept_)[0] for est in estimators])
+        x_mean, x_scale = scaler_vectors(x_scaler, coef.shape[0])
+        y_mean, y_scale = inverse_vectors(y_scaler, coef.shape[1])
+        self.weights = coef / x_scale[:, None] * y_scale
+        self.bias = (intercept - (x_mean / x_scale) @ coef) * y_scale + y_mean
+
+    def predict(self, X):
+        y = np.matmul(X, self.weights, out=_buffer(id(self), (len(X), len(self.bias))))
+        y += self.bias
+        return y.copy()
+
+
+# Doubles as int64 keys with the same ordering, and back
+def _float_key(x):
+    bits = x.view(np.int64)
+    return np.where(bits < 0, np.int64(-2**63) - bits, bits)
+
+def _key_float(key):
+    return np.where(key < 0, np.int64(-2**63) - key, key).view(np.float64)
+
+
+# Raw split thresholds equivalent to `threshold` on scaled features: for
+# every float64 x, scaled(x) <= threshold exactly when x <= the result. The
+# scaled value is computed as (x - mean) / scale (and rounded to float32 for
+# models that compare float32 features), which is monotonic in x, so the
+# largest such x is found by bisecting over the ordered float64 values.
+def raw_thresholds(threshold, mean, scale, float32):
+    def scaled(x):
+        value = (x - mean) / scale
+        return value.astype(np.float32).astype(np.float64) if float32 else value
+
+    guess = threshold * scale + mean
+    width = np.abs(guess) * 1e-6 + 1e-12
+    lo, hi = guess - width, guess + width
+    for _ in range(64):
+        bad_lo = scaled(lo) > threshold
+        bad_hi = scaled(hi) <= threshold
+        if not (bad_lo.any() or bad_hi.any()):
+            break
+        width = np.where(bad_lo | bad_hi, width * 16, width)
+        lo = np.where(bad_lo, guess - width, lo)
+        hi = np.where(bad_hi, guess + width, hi)
+    lo_key, hi_key = _float_key(lo), _float_key(hi)
+    while (hi_key - lo_key > 1).any():
+        mid_key = lo_key + (hi_key - lo_key) // 2
+        goes_left = scaled(_key_float(mid_key)) <= threshold
+        lo_key = np.where(goes_left, mid_key, lo_key)
+        hi_key = np.where(goes_left, hi_key, mid_key)
+    return _key_float(lo_key)
+
+
+# A compiled tree ensemble with the x scaler folded into its split
+# thresholds and the y scaler into its output weights and base scores. Trees
+# with nodes treating zero as missing (LightGBM zero_as_missing) stay
+# unfolded: their zero is the scaled zero, i.e. a raw value at the mean.
+def fold_trees(compiled, x_scaler, y_scaler):
+    x_mean, x_scale = scaler_vectors(x_scaler, compiled.n_features_in_)
+    y_mean, y_scale = inverse_vectors(y_scaler, len(compiled.base))
+    if (x_scale <= 0).any() or compiled.has_missing:
+        return None
+    folded = copy.copy(compiled)
+    threshold = np.array(compiled.threshold)
+    split = np.isfinite(threshold)
+    feature = compiled.feature[split]
+    threshold[split] = raw_thresholds(threshold[split], x_mean[feature], x_scale[feature], compiled.float32)
+    folded.threshold = threshold
+    folded.tree_outputs = compiled.tree_outputs * y_scale
+    folded.base = compiled.base * y_scale + y_mean
+    # Thresholds now apply to the raw float64 features
+    folded.float32 = False
+    return folded
+
+
+class FusedPipeline:
+    def __init__(self, folded, scaled, max_folded_rows=None):
+        self.folded = folded
+        self.scaled = scaled
+        self.max_folded_rows = max_folded_rows
+
+    def predict(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        if self.folded is not None and (self.max_folded_rows is None or len(X) <= self.max_folded_rows):
+            return self.folded.predict(X)
+        return self.scaled.predict(X)
+
+
+# Fused pipeline for `target`. Compiled trees are only used for batches of up
+# to `compiled_max_rows` rows; past that the native estimators are faster.
+def build_pipeline(registry, target, use_compiled=True, compiled_max_rows=128):
+    model = registry.model(target)
+    x_scaler = registry.x_scaler(target)
+    y_scaler = registry.y_scaler(target)
+    n_outputs = len(y_scaler.scale_) if hasattr(y_scaler, "scale_") else y_scaler.n_features_in_
+    scaled = ScaledModel(model, x_scaler, y_scaler, n_outputs)
+    estimators = model.estimators_ if hasattr(model, "estimators_") else [model]
+    if all(type(est).__name__ in ("LinearRegression", "Ridge", "Lasso", "ElasticNet") for est in estimators):
+        return FusedPipeline(FoldedLinear(model, x_scaler, y_scaler), scaled)
+    compiled = registry.compiled(target) if use_compiled else None
+    if compiled is not None:
+        return FusedPipeline(fold_trees(compiled, x_scaler, y_scaler), scaled, compiled_max_rows)
+    return FusedPipeline(None, scaled)
+
+
+# The original three-step path, for comparison
+def three_step_predict(registry, target, X):
+    x = registry.x_scaler(target).transform(X)
+    return registry.y_scaler(target).inverse_transform(registry.model(target).predict(x))
+
+
+# Compare every fused pipeline with the three-step path on real feature rows
+# built from Data/processed.csv
+def verify(manifest_path=MANIFEST_PATH, data_path="Data/processed.csv", n=2000, tolerance=1e-6):
+    import pandas as pd
+    from features import MODEL_FEATURES, build_window, model_input
+
+    data = pd.read_csv(data_path)
+    starts = np.random.RandomState(0).randint(0, len(data) - 3, n)
+    windows = np.vstack([build_window(data.iloc[i:i + 3]) for i in starts])
+    registry = ModelRegistry(manifest_path)
+    ok = True
+    for target in MODEL_FEATURES:
+        try:
+            pipeline = build_pipeline(registry, target)
+        except FileNotFoundError as e:
+            print(f"Skipping {target}: {e}")
+            continue
+        X = model_input(windows, target)
+        expected = three_step_predict(registry, target, X)
+        for name, rows in (("single rows", 1), ("batch", len(X))):
+            got = np.vstack([pipeline.predict(X[i:i + rows]) for i in range(0, len(X), rows)])
+            error = np.abs(got - expected).max()
+            ok &= error <= tolerance
+            print(f"{target} ({name}): max error {error:.2e} {'ok' if error <= tolerance else 'FAILED'}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check fused pipelines against the three-step path")
+    parser.add_argument("command", choices=["verify"])
+    parser.add_argument("--manifest", default=MANIFEST_PATH)
+    parser.add_argument("--data", default="Data/processed.csv")
+    parser.add_argument("--tolerance", type=float, default=1e-6)
+    args = parser.parse_args()
+    if not verify(args.manifest, args.data, tolerance=args.tolerance):
+        sys.exit(1)
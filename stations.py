@@ -0,0 +1,61 @@
+import json
+import os
+
+import numpy as np
+
+# Cities with their coordinates, from the file at CITIES_CONFIG:
+#
+#   {"cities": [{"name": "london", "latitude": 51.5072, "longitude": -0.1276}, ...]}
+#
+# Each city is a station whose observations are fetched at its coordinates.
+# StationIndex answers nearest-station queries for arbitrary coordinates
+# with a ball tree over the stations on the sphere (haversine distance),
+# built once, so a lookup costs O(log n) whatever the number of stations.
+CITIES_PATH = os.environ.get("CITIES_CONFIG", "cities.json")
+EARTH_RADIUS_KM = 6371.0088
+
+# A location this close to a station gets that station's forecast as is
+EXACT_KM = 0.01
+
+
+def load_cities(path=CITIES_PATH):
+    with open(path) as f:
+        cities = json.load(f)["cities"]
+    names = set()
+    for city in cities:
+        name = city["name"]
+        if name in names or name != name.lower():
+            raise ValueError(f"City names in {path} must be unique and lowercase, got {name!r}")
+        if not (-90 <= city["latitude"] <= 90 and -180 <= city["longitude"] <= 180):
+            raise ValueError(f"Invalid coordinates for {name} in {path}")
+        names.add(name)
+    return cities
+
+
+class StationIndex:
+    def __init__(self, cities):
+        from sklearn.neighbors import BallTree
+        self.names = [city["name"] for city in cities]
+        coordinates = np.radians([[city["latitude"], city["longitude"]] for city in cities])
+        self.tree = BallTree(coordinates, metric="haversine")
+
+    def __len__(self):
+        return len(self.names)
+
+    # Up to k (name, distance in km) pairs, nearest first, optionally only
+    # within max_km
+    def nearest(self, latitude, longitude, k, max_km=None):
+        k = min(k, len(self.names))
+        distances, indices = self.tree.query(np.radians([[latitude, longitude]]), k=k)
+        return [(self.names[i], float(d * EARTH_RADIUS_KM)) for d, i in zip(distances[0], indices[0])
+                if max_km is None or d * EARTH_RADIUS_KM <= max_km]
+
+
+# Normalized inverse-distance weights of stations at `distances` km
+def idw_weights(distances, power=2):
+    distances = np.asarray(distances, dtype=np.float64)
+    if distances[0] < EXACT_KM:
+        weights = (distances < EXACT_KM).astype(np.float64)
+    else:
+        weights = distances ** -power
+    return weights / weights.sum()
@@ -0,0 +1,460 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from stations import load_cities
+
+
+# Storage for the hourly observations of every city. Two implementations share
+# one interface:
+#   create_tables()                 create the tables of cities added to the
+#                                   config since the last run
+#   append_observations(dataframe)  rows of several cities, with a 'city' column
+#   read_latest(last_rows, n)       per city, up to the n newest rows after the
+#                                   given last row (None: the n newest), oldest
+#                                   first, as dictionaries
+#   bulk_load(city, dataframe)      historical rows of one city
+#   deduplicate(city)               drop duplicate rows stored before writes
+#                                   were upserts; returns the rows removed
+#   relabel_clusters(city, assigner, chunk_rows)
+#                                   recompute the cluster of every row of a
+#                                   city with a clustering.ClusterAssigner;
+#                                   returns the number of rows changed
+#
+# and keep the forecasts materialized by the ingestion service, keyed by city
+# and issue time (the time of the observation they were computed from):
+#   write_forecasts(records)        (city, issued_at, forecast) tuples;
+#                                   rewriting an issue time replaces it
+#   read_forecasts(cities)          {city: (issued_at, forecast)}, the latest
+#                                   of each city that has one
+#   read_forecast_history(city, n)  [(issued_at, forecast)], newest first
+#
+# Observations are keyed by city and observation time (date, hour). Both
+# writes are upserts on that key, so replaying a batch, re-ingesting a cached
+# API response or rerunning a backfill leaves one row per hour, and the
+# windows read for the lag features never repeat an hour.
+#
+# BigQueryStorage is the production warehouse with one table per city.
+# SQLiteStorage keeps everything in one local file, uniquely indexed on
+# (city, date, hour) so tail reads only touch the rows they return; it needs
+# no credentials and serves offline runs, load tests and edge deployments.
+#
+# WEATHER_STORAGE picks the implementation: "bigquery" (default) or "sqlite",
+# with the file at WEATHER_DB_PATH.
+
+PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "gcp_project_id_here")  # replace with your gcp project id
+DATASET_ID = "weather_data"
+# One table per city of cities.json (see stations.py)
+CITIES = [city["name"] for city in load_cities()]
+TABLES = {city: f"{PROJECT_ID}.{DATASET_ID}.{city}" for city in CITIES}
+FORECAST_TABLE = f"{PROJECT_ID}.{DATASET_ID}.forecasts"
+
+# Columns of an observation row, in table order
+OBSERVATION_COLUMNS = [
+    "date", "temperature_2m", "relative_humidity_2m", "apparent_temperature", "precipitation", "rain", "showers",
+    "snowfall", "pressure_msl", "surface_pressure", "cloud_cover", "wind_speed_10m", "wind_direction_10m",
+    "wind_gusts_10m", "is_day", "year", "month", "day", "hour", "cluster",
+]
+# Observation time of a row, unique per city
+KEY_COLUMNS = ["date", "hour"]
+
+
+class BigQueryStorage:
+    def __init__(self, tables=TABLES, forecast_table=FORECAST_TABLE, client=None):
+        from google.cloud import bigquery
+        self.bigquery = bigquery
+        if client is None:
+            from google.auth import default
+            # Use default credentials from the environment
+            credentials, project_id = default()
+            client = bigquery.Client(credentials=credentials, project=project_id)
+        self.client = client
+        self.tables = tables
+        self.forecast_table = forecast_table
+        self.staging_prefix = f"{PROJECT_ID}.{DATASET_ID}._ingest_"
+
+    # Tables of cities new to the config, partitioned by month so an upsert
+    # only scans the months of its batch
+    def create_tables(self):
+        columns = ", ".join(f"{column} {_bigquery_type(column)}" for column in OBSERVATION_COLUMNS)
+        self.client.query("\n".join(
+            f"CREATE TABLE IF NOT EXISTS `{table}` ({columns}) PARTITION BY DATE_TRUNC(date, MONTH);"
+            for table in self.tables.values())).result()
+
+    # One MERGE of the staged rows of a city into its table, keyed on
+    # (date, hour). The source keeps one row per hour, and the date range of
+    # the batch in the join condition prunes the partitions of the target.
+    def _merge(self, table, staging_table, where, first, last):
+        columns = [column for column in OBSERVATION_COLUMNS if column != "date"]
+        key = " AND ".join(f"T.{column} = S.{column}" for column in KEY_COLUMNS)
+        return f"""
+        MERGE `{table}` T
+        USING (
+            SELECT CAST(date AS DATE) AS date, {', '.join(columns)}
+            FROM `{staging_table}`
+            WHERE {where}
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY CAST(date AS DATE), hour) = 1
+        ) S
+        ON {key} AND T.date BETWEEN DATE '{first}' AND DATE '{last}'
+        WHEN MATCHED THEN UPDATE SET {', '.join(f"{column} = S.{column}" for column in columns
+                                                if column not in KEY_COLUMNS)}
+        WHEN NOT MATCHED THEN INSERT ({', '.join(OBSERVATION_COLUMNS)}) VALUES ({', '.join(OBSERVATION_COLUMNS)});
+        """
+
+    # Rows loaded into a temporary staging table, merged into each of the
+    # (table, filter of the staged rows) targets in one script, and the stage
+    # dropped; returns the rows staged. Raises on failure.
+    def _upsert(self, dataframe, targets):
+        staging_table = f"{self.staging_prefix}{uuid.uuid4().hex}"
+        try:
+            job = self.client.load_table_from_dataframe(dataframe, staging_table)
+            job.result()  # Wait for the job to complete
+            first, last = _date_range(dataframe)
+            script = [self._merge(table, staging_table, where, first, last) for table, where in targets]
+            script.append(f"DROP TABLE `{staging_table}`;")
+            self.client.query("\n".join(script)).result()
+            return job.output_rows
+        except Exception:
+            self.client.delete_table(staging_table, not_found_ok=True)
+            raise
+
+    # Rows of several cities with a constant number of jobs: one load job into
+    # a staging table, then one script merging each city's rows into its table
+    # and dropping the stage. Raises on failure.
+    def append_observations(self, dataframe):
+        cities = list(dataframe["city"].unique())
+        try:
+            self._upsert(dataframe, [(self.tables[city], f"city = '{city}'") for city in cities])
+            print(f"Merged {len(dataframe)} rows into {', '.join(self.tables[city] for city in cities)}.")
+        except Exception as e:
+            print(f"Failed to merge data into {', '.join(self.tables[city] for city in cities)}: {e}")
+            raise
+
+    # The new tail rows of several cities in one query
+    def read_latest(self, last_rows, n):
+        subqueries = []
+        query_parameters = []
+        for i, (city, last_row) in enumerate(last_rows.items()):
+            if last_row is None:
+                # Cold start: only the newest n rows
+                where = ""
+            else:
+                # Top-up: rows newer than the last one held. The date filter
+                # is kept as a plain range so a date-partitioned table is pruned
+                where = f"WHERE date >= @last_date_{i} AND (date > @last_date_{i} OR hour > @last_hour_{i})"
+                query_parameters += [
+                    self.bigquery.ScalarQueryParameter(f"last_date_{i}", "DATE", last_row["date"]),
+                    self.bigquery.ScalarQueryParameter(f"last_hour_{i}", "INT64", int(last_row["hour"])),
+                ]
+            subqueries.append(f"""(
+            SELECT '{city}' AS city, *
+            FROM `{self.tables[city]}`
+            {where}
+            ORDER BY date DESC, hour DESC
+            LIMIT {n}
+            )""")
+        query = "\nUNION ALL\n".join(subqueries)
+        job_config = self.bigquery.QueryJobConfig(query_parameters=query_parameters)
+        query_job = self.client.query(query, job_config=job_config)
+        results = query_job.result()
+        table = results.to_arrow()  # Use Arrow for conversion
+
+        new_rows = {city: [] for city in last_rows}
+        for row in sorted(table.to_pylist(), key=lambda row: (row["date"], row["hour"])):
+            new_rows[row.pop("city")].append(row)
+        return new_rows
+
+    # Staged and merged like append_observations, so a rerun chunk replaces
+    # its rows instead of adding them again
+    def bulk_load(self, city, dataframe):
+        rows = self._upsert(dataframe, [(self.tables[city], "TRUE")])
+        print(f"Merged {rows} rows into {self.tables[city]}.")
+        return rows
+
+    # Rewrites the table with one row per hour in a single MERGE, which
+    # keeps its partitioning and schema
+    def deduplicate(self, city):
+        table = self.tables[city]
+        job = self.client.query(f"""
+        MERGE `{table}` T
+        USING (SELECT ANY_VALUE(observation).* FROM `{table}` observation GROUP BY {', '.join(KEY_COLUMNS)}) S
+        ON FALSE
+        WHEN NOT MATCHED BY SOURCE THEN DELETE
+        WHEN NOT MATCHED BY TARGET THEN INSERT ROW
+        """)
+        job.result()
+        # Every row is deleted and the distinct ones inserted again
+        affected = job.num_dml_affected_rows or 0
+        rows = self.client.get_table(table).num_rows
+        return affected - 2 * rows
+
+    # One UPDATE in the warehouse: the assigner's scores are linear in the
+    # raw features, so the nearest centroid is computed by the query itself
+    # and no rows leave BigQuery. `chunk_rows` is unused.
+    def relabel_clusters(self, city, assigner, chunk_rows=None):
+        scores = ", ".join(
+            " + ".join([repr(float(bias))] + [f"{feature} * {float(weight)!r}"
+                                              for feature, weight in zip(assigner.features, weights)])
+            for weights, bias in zip(assigner.weights.T, assigner.bias))
+        nearest = f"(SELECT o FROM UNNEST([{scores}]) AS score WITH OFFSET o ORDER BY score, o LIMIT 1)"
+        query = f"UPDATE `{self.tables[city]}` SET cluster = {nearest} WHERE cluster IS DISTINCT FROM {nearest}"
+        job = self.client.query(query)
+        job.result()
+        return job.num_dml_affected_rows or 0
+
+    # Forecasts are appended; a rewritten issue time is resolved on read by
+    # keeping its most recently computed row
+    def write_forecasts(self, records):
+        dataframe = pd.DataFrame({
+            "city": [city for city, _, _ in records],
+            "issued_at": [pd.Timestamp(issued_at, tz="UTC") for _, issued_at, _ in records],
+            "computed_at": pd.Timestamp.now(tz="UTC"),
+            "forecast": [json.dumps(forecast) for _, _, forecast in records],
+        })
+        self.client.load_table_from_dataframe(dataframe, self.forecast_table).result()
+
+    def read_forecasts(self, cities):
+        query = f"""
+        SELECT city, issued_at, forecast
+        FROM `{self.forecast_table}`
+        WHERE city IN UNNEST(@cities)
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY city ORDER BY issued_at DESC, computed_at DESC) = 1
+        """
+        job_config = self.bigquery.QueryJobConfig(query_parameters=[
+            self.bigquery.ArrayQueryParameter("cities", "STRING", list(cities))])
+        rows = self.client.query(query, job_config=job_config).result()
+        return {row["city"]: (_issued_at(row["issued_at"]), json.loads(row["forecast"])) for row in rows}
+
+    def read_forecast_history(self, city, n):
+        query = f"""
+        SELECT issued_at, forecast
+        FROM `{self.forecast_table}`
+        WHERE city = @city
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY issued_at ORDER BY computed_at DESC) = 1
+        ORDER BY issued_at DESC
+        LIMIT @n
+        """
+        job_config = self.bigquery.QueryJobConfig(query_parameters=[
+            self.bigquery.ScalarQueryParameter("city", "STRING", city),
+            self.bigquery.ScalarQueryParameter("n", "INT64", n)])
+        rows = self.client.query(query, job_config=job_config).result()
+        return [(_issued_at(row["issued_at"]), json.loads(row["forecast"])) for row in rows]
+
+
+class SQLiteStorage:
+    def __init__(self, path="weather.sqlite"):
+        self.path = path
+        self.local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            columns = ", ".join(f"{column} {_sqlite_type(column)}" for column in OBSERVATION_COLUMNS)
+            conn.execute(f"CREATE TABLE IF NOT EXISTS observations (city TEXT NOT NULL, {columns})")
+            # Files written before the key existed are deduplicated once
+            # and their non-unique index replaced
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'observations_key'"
+                            ).fetchone() is None:
+                self._deduplicate(conn)
+                conn.execute("CREATE UNIQUE INDEX observations_key ON observations (city, date, hour)")
+                conn.execute("DROP INDEX IF EXISTS observations_city_time")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS forecasts (
+                    city TEXT NOT NULL,
+                    issued_at TEXT NOT NULL,
+                    computed_at REAL NOT NULL,
+                    forecast TEXT NOT NULL,
+                    PRIMARY KEY (city, issued_at)
+                )
+            """)
+
+    # One connection per thread, committed when the block succeeds
+    @contextmanager
+    def _connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=30)
+        with conn:
+            yield conn
+
+    # Upserts on (city, date, hour); the last row of an hour wins
+    def _insert(self, rows):
+        placeholders = ", ".join("?" for _ in range(len(OBSERVATION_COLUMNS) + 1))
+        with self._connect() as conn:
+            conn.executemany(f"INSERT OR REPLACE INTO observations (city, {', '.join(OBSERVATION_COLUMNS)}) "
+                             f"VALUES ({placeholders})", rows)
+
+    # Keeps the newest row of each hour; returns the rows removed
+    def _deduplicate(self, conn, city=None):
+        where, params = ("WHERE city = ?", (city,)) if city is not None else ("", ())
+        return conn.execute(f"""
+            DELETE FROM observations WHERE rowid IN (
+                SELECT rowid FROM (
+                    SELECT rowid, ROW_NUMBER() OVER (PARTITION BY city, date, hour ORDER BY rowid DESC) AS n
+                    FROM observations {where}
+                ) WHERE n > 1
+            )
+        """, params).rowcount
+
+    def create_tables(self):
+        pass  # every city shares the observations table
+
+    def append_observations(self, dataframe):
+        self._insert(_sqlite_rows(dataframe, dataframe["city"]))
+
+    def read_latest(self, last_rows, n):
+        new_rows = {}
+        with self._connect() as conn:
+            for city, last_row in last_rows.items():
+                if last_row is None:
+                    where, params = "city = ?", (city,)
+                else:
+                    where = "city = ? AND (date, hour) > (?, ?)"
+                    params = (city, str(last_row["date"]), int(last_row["hour"]))
+                cursor = conn.execute(f"""
+                    SELECT {', '.join(OBSERVATION_COLUMNS)} FROM observations
+                    WHERE {where}
+                    ORDER BY date DESC, hour DESC
+                    LIMIT ?
+                """, params + (n,))
+                new_rows[city] = [_observation(row) for row in reversed(cursor.fetchall())]
+        return new_rows
+
+    def bulk_load(self, city, dataframe):
+        self._insert(_sqlite_rows(dataframe, [city] * len(dataframe)))
+        print(f"Loaded {len(dataframe)} rows into {self.path} for {city}.")
+        return len(dataframe)
+
+    def deduplicate(self, city):
+        with self._connect() as conn:
+            return self._deduplicate(conn, city)
+
+    # `chunk_rows` rows at a time in rowid order, each chunk updated in its
+    # own transaction; only rows whose cluster changed are written
+    def relabel_clusters(self, city, assigner, chunk_rows=200000):
+        columns = ", ".join(assigner.features)
+        last_rowid = 0
+        changed = 0
+        while True:
+            with self._connect() as conn:
+                rows = conn.execute(f"SELECT rowid, cluster, {columns} FROM observations "
+                                    f"WHERE city = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                                    (city, last_rowid, chunk_rows)).fetchall()
+                if not rows:
+                    return changed
+                values = np.array(rows, dtype=np.float64)
+                rowids = values[:, 0].astype(np.int64)
+                labels = assigner.assign(values[:, 2:])
+                moved = labels != values[:, 1]
+                conn.executemany("UPDATE observations SET cluster = ? WHERE rowid = ?",
+                                 zip(labels[moved].tolist(), rowids[moved].tolist()))
+            changed += int(moved.sum())
+            last_rowid = int(rowids[-1])
+
+    def write_forecasts(self, records):
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO forecasts VALUES (?, ?, ?, ?)",
+                             [(city, pd.Timestamp(issued_at).isoformat(), now, json.dumps(forecast))
+                              for city, issued_at, forecast in records])
+
+    def read_forecasts(self, cities):
+        forecasts = {}
+        with self._connect() as conn:
+            for city in cities:
+                row = conn.execute("SELECT issued_at, forecast FROM forecasts WHERE city = ? "
+                                   "ORDER BY issued_at DESC LIMIT 1", (city,)).fetchone()
+                if row is not None:
+                    forecasts[city] = (pd.Timestamp(row[0]), json.loads(row[1]))
+        return forecasts
+
+    def read_forecast_history(self, city, n):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT issued_at, forecast FROM forecasts WHERE city = ? "
+                                "ORDER BY issued_at DESC LIMIT ?", (city, n)).fetchall()
+        return [(pd.Timestamp(issued_at), json.loads(forecast)) for issued_at, forecast in rows]
+
+
+INTEGER_COLUMNS = {"is_day", "year", "month", "day", "hour", "cluster"}
+
+def _sqlite_type(column):
+    if column == "date":
+        return "TEXT"
+    return "INTEGER" if column in INTEGER_COLUMNS else "REAL"
+
+def _bigquery_type(column):
+    if column == "date":
+        return "DATE"
+    if column == "is_day":
+        return "BOOL"
+    return "INT64" if column in INTEGER_COLUMNS else "FLOAT64"
+
+# First and last day of a batch, as YYYY-MM-DD
+def _date_range(dataframe):
+    dates = pd.to_datetime(dataframe["date"])
+    return f"{dates.min():%Y-%m-%d}", f"{dates.max():%Y-%m-%d}"
+
+def _sqlite_value(value):
+    if isinstance(value, (date, pd.Timestamp)):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _sqlite_rows(dataframe, cities):
+    values = dataframe[OBSERVATION_COLUMNS].itertuples(index=False, name=None)
+    return [(city, *map(_sqlite_value, row)) for city, row in zip(cities, values)]
+
+# Issue times are naive UTC timestamps, like the observation times
+def _issued_at(value):
+    issued_at = pd.Timestamp(value)
+    return issued_at.tz_convert(None) if issued_at.tzinfo else issued_at
+
+# A stored row typed like the BigQuery tables return it
+def _observation(row):
+    observation = dict(zip(OBSERVATION_COLUMNS, row))
+    observation["date"] = date.fromisoformat(observation["date"])
+    observation["is_day"] = bool(observation["is_day"])
+    return observation
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+# The storage selected by WEATHER_STORAGE, created on first use
+def get_storage():
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            kind = os.environ.get("WEATHER_STORAGE", "bigquery")
+            if kind == "bigquery":
+                _storage = BigQueryStorage()
+            elif kind == "sqlite":
+                _storage = SQLiteStorage(os.environ.get("WEATHER_DB_PATH", "weather.sqlite"))
+            else:
+                raise ValueError(f"Unknown WEATHER_STORAGE {kind!r}, expected bigquery or sqlite")
+        return _storage
+
+# Replace the selected storage, e.g. with a stub for benchmarks
+def set_storage(storage):
+    global _storage
+    with _storage_lock:
+        _storage = storage
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the observation tables")
+    parser.add_argument("command", choices=["deduplicate"],
+                        help="deduplicate: keep one row per city and hour, for data stored before upserts")
+    parser.add_argument("--cities", nargs="*", default=CITIES)
+    args = parser.parse_args()
+    storage = get_storage()
+    for city in args.cities:
+        print(f"Removed {storage.deduplicate(city)} duplicate rows of {city}.")
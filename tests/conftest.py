@@ -0,0 +1,37 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+# Modules read their configuration at import time, so the tests point them
+# at local files before anything is imported: SQLite storage and ingest
+# buffer in a scratch directory, and the cities of tests/cities.json
+_scratch = tempfile.mkdtemp(prefix="weather-tests-")
+os.environ["WEATHER_STORAGE"] = "sqlite"
+os.environ["WEATHER_DB_PATH"] = os.path.join(_scratch, "weather.sqlite")
+os.environ["INGEST_BUFFER_PATH"] = os.path.join(_scratch, "ingest_buffer.sqlite")
+os.environ["CITIES_CONFIG"] = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cities.json")
+os.environ.pop("FORECAST_NOTIFY_URL", None)
+os.environ.pop("FORECAST_MODE", None)
+
+
+# Stands in for a fused pipeline: a 5-hour forecast rising from the first
+# feature, logging the rows of every predict call
+class CountingPipeline:
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, X):
+        self.calls.append(len(X))
+        return X[:, :1] + np.arange(5)
+
+
+# Stub pipelines for every target, so forecasts don't need the model files
+@pytest.fixture
+def models(monkeypatch):
+    import forecasting
+    stubs = {target: CountingPipeline() for target in forecasting.MODEL_FEATURES}
+    for target, stub in stubs.items():
+        monkeypatch.setitem(forecasting.pipelines, target, stub)
+    return stubs
@@ -0,0 +1,176 @@
+import argparse
+import json
+import math
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import flatbuffers
+import numpy as np
+
+
+# Local stand-in for the Open-Meteo forecast and historical forecast APIs,
+# answering the flatbuffers format read by openmeteo_requests.Client:
+#
+#   current=...                      one observation per location at `now`
+#   hourly=...&start_date&end_date   every hour of the range per location
+#
+# Values are a deterministic function of the variable, the coordinates and
+# the hour, so a repeated request sees the same observation until `now`
+# moves. Every call is logged in `calls`; locations listed in `failing`
+# make the whole call fail with a 400 JSON error like the real API's.
+#
+# Point the ingestion or the harvester at it with OPEN_METEO_URL or
+# HISTORICAL_API_URL:
+#
+#   python tests/openmeteo_stub.py --port 8081
+#   OPEN_METEO_URL=http://localhost:8081/v1/forecast python files_updation.py
+
+# Typical value and daily swing of each variable
+PROFILES = {
+    "temperature_2m": (10.0, 5.0), "relative_humidity_2m": (80.0, 10.0), "apparent_temperature": (8.0, 5.0),
+    "is_day": (0.5, 0.5), "precipitation": (0.2, 0.2), "rain": (0.1, 0.1), "showers": (0.1, 0.1),
+    "snowfall": (0.0, 0.0), "weather_code": (3.0, 0.0), "cloud_cover": (60.0, 40.0),
+    "pressure_msl": (1013.0, 5.0), "surface_pressure": (1010.0, 5.0), "wind_speed_10m": (15.0, 8.0),
+    "wind_direction_10m": (200.0, 90.0), "wind_gusts_10m": (30.0, 15.0),
+}
+
+
+def observation(variable, latitude, longitude, timestamp):
+    level, swing = PROFILES.get(variable, (0.0, 1.0))
+    phase = 2 * math.pi * (timestamp // 3600 % 24) / 24 + latitude + longitude
+    value = level + swing * math.sin(phase)
+    return round(value) if variable == "is_day" else value
+
+
+def _variable(builder, value=None, values=None):
+    vector = None
+    if values is not None:
+        vector = builder.CreateNumpyVector(np.asarray(values, dtype=np.float32))
+    builder.StartObject(4)
+    if vector is not None:
+        builder.PrependUOffsetTRelativeSlot(3, vector, 0)
+    if value is not None:
+        builder.PrependFloat32Slot(2, value, 0.0)
+    return builder.EndObject()
+
+
+def _variables_with_time(builder, variables, start, end, interval):
+    builder.StartVector(4, len(variables), 4)
+    for variable in reversed(variables):
+        builder.PrependUOffsetTRelative(variable)
+    vector = builder.EndVector()
+    builder.StartObject(4)
+    builder.PrependInt64Slot(0, start, 0)
+    builder.PrependInt64Slot(1, end, 0)
+    builder.PrependInt32Slot(2, interval, 0)
+    builder.PrependUOffsetTRelativeSlot(3, vector, 0)
+    return builder.EndObject()
+
+
+# One size-prefixed WeatherApiResponse
+def response_message(latitude, longitude, current=None, hourly=None, now=0, start=0, end=0):
+    builder = flatbuffers.Builder(1024)
+    block, slot = None, None
+    if current is not None:
+        variables = [_variable(builder, value=observation(name, latitude, longitude, now)) for name in current]
+        block, slot = _variables_with_time(builder, variables, now, now + 900, 900), 9
+    elif hourly is not None:
+        times = np.arange(start, end, 3600)
+        variables = [_variable(builder, values=[observation(name, latitude, longitude, t) for t in times])
+                     for name in hourly]
+        block, slot = _variables_with_time(builder, variables, start, end, 3600), 11
+    builder.StartObject(12)
+    builder.PrependFloat32Slot(0, latitude, 0.0)
+    builder.PrependFloat32Slot(1, longitude, 0.0)
+    if block is not None:
+        builder.PrependUOffsetTRelativeSlot(slot, block, 0)
+    builder.FinishSizePrefixed(builder.EndObject())
+    return bytes(builder.Output())
+
+
+def _day(value, days=0):
+    day = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    return int(day.timestamp()) + days * 86400
+
+
+class OpenMeteoStub:
+    def __init__(self, host="127.0.0.1", port=0, now=None):
+        # Unix time of the current observations; None follows the clock
+        self.now = now
+        self.calls = []
+        self.failing = set()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.url = f"http://{host}:{self.server.server_port}/v1/forecast"
+        self.thread = None
+
+    def advance(self, hours=1):
+        self.now += hours * 3600
+
+    def observed_at(self):
+        if self.now is None:
+            return int(datetime.now(timezone.utc).timestamp()) // 3600 * 3600
+        return self.now
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def answer(self, query):
+        latitudes = [float(value) for value in query.get("latitude", [])]
+        longitudes = [float(value) for value in query.get("longitude", [])]
+        locations = list(zip(latitudes, longitudes))
+        with self.lock:
+            self.calls.append({"locations": locations, "current": "current" in query, "hourly": "hourly" in query,
+                               "start_date": query.get("start_date", [None])[0],
+                               "end_date": query.get("end_date", [None])[0]})
+            failing = [location for location in locations if location in self.failing]
+            now = self.observed_at()
+        if failing or not locations or len(latitudes) != len(longitudes):
+            return 400, json.dumps({"error": True, "reason": f"Cannot serve {failing or locations}"}).encode()
+        if "current" in query:
+            kwargs = {"current": query["current"], "now": now}
+        elif "hourly" in query:
+            kwargs = {"hourly": query["hourly"], "start": _day(query["start_date"][0]),
+                      "end": _day(query["end_date"][0], days=1)}
+        else:
+            kwargs = {}
+        return 200, b"".join(response_message(latitude, longitude, **kwargs) for latitude, longitude in locations)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                # Lists come as repeated parameters or comma-separated
+                query = {key: [item for value in values for item in value.split(",")]
+                         for key, values in query.items()}
+                status, body = stub.answer(query)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json" if status != 200 else "application/octet-stream")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a local stub of the Open-Meteo API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    stub = OpenMeteoStub(args.host, args.port)
+    print(f"Serving {stub.url}")
+    stub.server.serve_forever()
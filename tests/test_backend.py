@@ -0,0 +1,131 @@
+import json
+import re
+
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+import backend
+import forecast_responses
+from forecast_cache import ForecastCache
+from storage import OBSERVATION_COLUMNS, SQLiteStorage
+
+START = pd.Timestamp("2024-06-01")
+
+
+@pytest.fixture
+def client():
+    return TestClient(backend.app)
+
+
+# Backend over an empty SQLite storage, with its own caches and stub models
+@pytest.fixture
+def service(monkeypatch, tmp_path, models):
+    storage = SQLiteStorage(str(tmp_path / "weather.sqlite"))
+    monkeypatch.setattr(backend, "storage", storage)
+    monkeypatch.setattr(backend, "forecast_cache", ForecastCache())
+    monkeypatch.setattr(backend, "city_windows", {})
+    monkeypatch.setattr(backend, "NOTIFY_TOKEN", "secret")
+    return storage
+
+
+# Hourly observations of a city from START, one per temperature
+def observations(city, temperatures, first_hour=0):
+    rows = []
+    for i, temperature in enumerate(temperatures):
+        time = START + pd.Timedelta(hours=first_hour + i)
+        row = {column: 1.0 for column in OBSERVATION_COLUMNS}
+        row.update(date=time.strftime("%Y-%m-%d"), temperature_2m=temperature, apparent_temperature=temperature,
+                   is_day=1, year=time.year, month=time.month, day=time.day, hour=time.hour, cluster=0)
+        rows.append(row)
+    return pd.DataFrame(rows).assign(city=city)
+
+
+def notify(client, cities):
+    return client.post(f"/weather/notify?cities={cities}", headers={"Authorization": "Bearer secret"})
+
+
+def test_notify_is_off_without_a_token(client, monkeypatch):
+    monkeypatch.setattr(backend, "NOTIFY_TOKEN", None)
+    assert client.post("/weather/notify").status_code == 404
+    assert client.post("/weather/notify", headers={"Authorization": "Bearer "}).status_code == 404
+
+
+def test_notify_needs_the_token(client, monkeypatch):
+    monkeypatch.setattr(backend, "NOTIFY_TOKEN", "secret")
+    assert client.post("/weather/notify").status_code == 401
+    assert client.post("/weather/notify", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.post("/weather/notify", headers={"Authorization": "Bearer secret"}).status_code == 204
+
+
+# A rewritten observation keeps its time; the notify after the write makes
+# the next forecast read it again
+def test_rewritten_observation_reaches_the_next_forecast(client, service):
+    service.append_observations(observations("colchester", [10.0, 11.0, 12.0]))
+    assert client.get("/weather/colchester").json()["current"]["temperature"] == 12
+
+    service.append_observations(observations("colchester", [20.0], first_hour=2))
+    assert client.get("/weather/colchester").json()["current"]["temperature"] == 12
+    assert notify(client, "colchester").status_code == 204
+    forecast = client.get("/weather/colchester").json()
+    assert forecast["current"]["temperature"] == 20
+    assert len(service.read_latest({"colchester": None}, 10)["colchester"]) == 3
+
+
+# The ETag names the hour of the newest observation and the body's digest
+def test_etag_answers_not_modified_until_a_new_observation(client, service):
+    service.append_observations(observations("colchester", [10.0, 11.0, 12.0]))
+    response = client.get("/weather/colchester")
+    etag = response.headers["etag"]
+    assert re.fullmatch(r'"2024060102-[0-9a-f]{16}"', etag)
+    assert response.headers["last-modified"] == "Sat, 01 Jun 2024 02:00:00 GMT"
+
+    for headers in ({"If-None-Match": etag}, {"If-None-Match": f'"other", W/{etag}'},
+                    {"If-Modified-Since": response.headers["last-modified"]}):
+        cached = client.get("/weather/colchester", headers=headers)
+        assert cached.status_code == 304
+        assert cached.content == b""
+        assert cached.headers["etag"] == etag
+    assert client.get("/weather/colchester", headers={"If-None-Match": '"other"'}).status_code == 200
+
+    service.append_observations(observations("colchester", [13.0], first_hour=3))
+    assert notify(client, "colchester").status_code == 204
+    response = client.get("/weather/colchester", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert re.fullmatch(r'"2024060103-[0-9a-f]{16}"', response.headers["etag"])
+    assert response.json()["current"]["temperature"] == 13
+
+
+# Bodies are compact JSON, gzipped from GZIP_MIN_BYTES when the client takes it
+def test_bodies_are_compact_and_gzipped(client, service, monkeypatch):
+    service.append_observations(observations("colchester", [10.0, 11.0, 12.0]))
+    plain = client.get("/weather/colchester", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert plain.content == json.dumps(plain.json(), separators=(",", ":")).encode()
+
+    monkeypatch.setattr(forecast_responses, "GZIP_MIN_BYTES", len(plain.content))
+    zipped = client.get("/weather/colchester", headers={"Accept-Encoding": "gzip"})
+    assert zipped.headers["content-encoding"] == "gzip"
+    assert zipped.headers["vary"] == "Accept-Encoding"
+    assert zipped.headers["etag"] == plain.headers["etag"]
+    assert zipped.content == plain.content
+
+    monkeypatch.setattr(forecast_responses, "GZIP_MIN_BYTES", len(plain.content) + 1)
+    assert "content-encoding" not in client.get("/weather/colchester",
+                                                headers={"Accept-Encoding": "gzip"}).headers
+
+
+# All cities are forecast with one predict call per model; cities with
+# fewer than WINDOW_SIZE observations are left out
+def test_all_cities_share_one_predict_call_per_model(client, service, models):
+    for city in ("colchester", "london", "bristol"):
+        service.append_observations(observations(city, [10.0, 11.0, 12.0]))
+    service.append_observations(observations("ipswich", [10.0, 11.0]))
+    response = client.get("/weather/all")
+    assert response.status_code == 200
+    assert sorted(response.json()) == ["bristol", "colchester", "london"]
+    assert {target: model.calls for target, model in models.items()} == {target: [3] for target in models}
+
+    # Repeats are answered from the cache
+    assert client.get("/weather/all").json() == response.json()
+    assert all(model.calls == [3] for model in models.values())
@@ -0,0 +1,172 @@
+import threading
+import time
+
+import pytest
+
+import forecast_cache
+from forecast_cache import ForecastCache
+
+
+# Stands in for forecast_cache's time module, moved by hand
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+# Counting load_many/compute_many over the latest observation time of each
+# city; cities set to None have no observations yet
+class Source:
+    def __init__(self, **observed):
+        self.observed = observed
+        self.loads = []
+        self.computes = []
+        self.before_load = None
+
+    def load_many(self, cities):
+        self.loads.append(sorted(cities))
+        if self.before_load is not None:
+            self.before_load()
+        return {city: (self.observed[city], (city, self.observed[city]))
+                for city in cities if self.observed[city] is not None}
+
+    def compute_many(self, datas):
+        self.computes.append(sorted(city for city, _ in datas))
+        return [f"{city}@{observed_at}" for city, observed_at in datas]
+
+    def get(self, cache, *cities):
+        return cache.get_many(list(cities), self.load_many, self.compute_many)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(forecast_cache, "time", clock)
+    return clock
+
+
+def test_fresh_forecasts_are_served_from_memory(clock):
+    cache = ForecastCache(ttl=60, stale_ttl=0)
+    source = Source(london=1, bristol=1)
+    assert cache.get_fresh(["london"]) is None
+    assert source.get(cache, "london", "bristol") == {"london": "london@1", "bristol": "bristol@1"}
+    assert source.get(cache, "bristol") == {"bristol": "bristol@1"}
+    assert cache.get_fresh(["london", "bristol"]) == {"london": "london@1", "bristol": "bristol@1"}
+    assert source.loads == [["bristol", "london"]]
+    assert source.computes == [["bristol", "london"]]
+
+    # Past the ttl the city is re-checked, and recomputed only when a newer
+    # observation came in
+    clock.advance(60)
+    assert cache.get_fresh(["london"]) is None
+    source.observed["bristol"] = 2
+    assert source.get(cache, "london", "bristol") == {"london": "london@1", "bristol": "bristol@2"}
+    assert source.loads[1:] == [["bristol", "london"]]
+    assert source.computes[1:] == [["bristol"]]
+
+
+def test_city_without_observations_is_remembered(clock):
+    cache = ForecastCache(ttl=60, stale_ttl=0)
+    source = Source(london=1, norwich=None)
+    assert source.get(cache, "london", "norwich") == {"london": "london@1", "norwich": None}
+    assert cache.get_fresh(["norwich"]) == {"norwich": None}
+    assert source.get(cache, "norwich") == {"norwich": None}
+    assert len(source.loads) == 1
+    clock.advance(60)
+    source.observed["norwich"] = 5
+    assert source.get(cache, "norwich") == {"norwich": "norwich@5"}
+
+
+# Concurrent misses of a city share one load and one compute
+def test_concurrent_misses_are_coalesced(clock):
+    cache = ForecastCache()
+    source = Source(london=1)
+    loading, release = threading.Event(), threading.Event()
+
+    def before_load():
+        loading.set()
+        release.wait(5)
+
+    source.before_load = before_load
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(source.get(cache, "london"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    assert loading.wait(5)
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == [{"london": "london@1"}] * 8
+    assert source.loads == [["london"]]
+    assert source.computes == [["london"]]
+
+
+def test_stale_forecast_is_served_while_refreshing(clock):
+    cache = ForecastCache(ttl=60, stale_ttl=600)
+    source = Source(london=1)
+    source.get(cache, "london")
+    source.observed["london"] = 2
+
+    # Within the stale window the old forecast is answered at once and one
+    # refresh runs in the background
+    clock.advance(100)
+    assert source.get(cache, "london") == {"london": "london@1"}
+    cache.refresh_pool.shutdown(wait=True)
+    assert source.loads == [["london"], ["london"]]
+    assert cache.get_fresh(["london"]) == {"london": "london@2"}
+
+    # Past it the caller waits for the refresh
+    clock.advance(660)
+    source.observed["london"] = 3
+    assert source.get(cache, "london") == {"london": "london@3"}
+    assert len(source.loads) == 3
+
+
+def test_least_recently_used_forecast_is_evicted(clock):
+    cache = ForecastCache(ttl=60, stale_ttl=0, max_entries=2)
+    source = Source(london=1, bristol=1, oxford=1)
+    source.get(cache, "london")
+    source.get(cache, "bristol")
+    source.get(cache, "london")
+    source.get(cache, "oxford")
+    assert list(cache.entries) == [("london", 1), ("oxford", 1)]
+
+    # An evicted forecast is computed again even within the ttl
+    assert source.get(cache, "bristol") == {"bristol": "bristol@1"}
+    assert source.computes == [["london"], ["bristol"], ["oxford"], ["bristol"]]
+    assert list(cache.entries) == [("oxford", 1), ("bristol", 1)]
+
+
+# Expired cities are loaded and computed again, as their observation may
+# have been rewritten without a new time; the others stay cached
+def test_expire_and_clear_drop_cached_forecasts(clock):
+    cache = ForecastCache(ttl=60, stale_ttl=600)
+    source = Source(london=1, bristol=1)
+    source.get(cache, "london", "bristol")
+    cache.expire(["london"])
+    assert cache.get_fresh(["london"]) is None
+    assert cache.get_fresh(["bristol"]) == {"bristol": "bristol@1"}
+    assert source.get(cache, "london", "bristol") == {"london": "london@1", "bristol": "bristol@1"}
+    assert source.computes == [["bristol", "london"], ["london"]]
+
+    cache.clear()
+    assert not cache.entries
+    assert cache.get_fresh(["bristol"]) is None
+    source.get(cache, "london", "bristol")
+    assert source.computes[2:] == [["bristol", "london"]]
+
+
+# A refresh overlapping an expire answers its callers but caches nothing
+def test_refresh_overlapping_an_expire_is_not_cached(clock):
+    cache = ForecastCache()
+    source = Source(london=1)
+    source.before_load = lambda: cache.expire(["london"])
+    assert source.get(cache, "london") == {"london": "london@1"}
+    assert not cache.entries
+    assert cache.get_fresh(["london"]) is None
@@ -0,0 +1,109 @@
+import json
+import os
+
+import numpy as np
+import openmeteo_requests
+import pandas as pd
+import pytest
+
+import data_injection
+import harvester
+import storage
+from openmeteo_stub import OpenMeteoStub, observation
+
+LOCATIONS = [("colchester", 51.8959, 0.8919), ("london", 51.5072, -0.1276), ("bristol", 51.4545, -2.5879)]
+START, END = "2024-01-01", "2024-01-10"
+HOURS = 10 * 24
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = OpenMeteoStub().start()
+    monkeypatch.setattr(harvester, "HISTORICAL_API_URL", stub.url)
+    yield stub
+    stub.stop()
+
+
+def harvest(output, **kwargs):
+    return harvester.harvest(LOCATIONS, START, END, str(output), chunk_days=4, locations_per_call=2, workers=2,
+                             client=openmeteo_requests.Client(), **kwargs)
+
+
+def parts(output):
+    return sorted(os.path.relpath(os.path.join(root, name), output)
+                  for root, _, names in os.walk(output) for name in names)
+
+
+def test_parts_are_partitioned_by_city(stub, tmp_path):
+    rows, failed = harvest(tmp_path)
+    assert (rows, failed) == (len(LOCATIONS) * HOURS, 0)
+    # Three chunks of 4, 4 and 2 days for two groups of locations
+    assert len(stub.calls) == 6
+    assert sorted(len(call["locations"]) for call in stub.calls) == [1, 1, 1, 2, 2, 2]
+    assert parts(tmp_path) == sorted(os.path.join(f"city={city}", name) for city, _, _ in LOCATIONS
+                                     for name in ("20240101-20240104.parquet", "20240105-20240108.parquet",
+                                                  "20240109-20240110.parquet"))
+    for city, latitude, longitude in LOCATIONS:
+        frame = pd.read_parquet(tmp_path / f"city={city}")
+        times = frame["date"] + pd.to_timedelta(frame["hour"], unit="h")
+        assert list(times) == list(pd.date_range(START, periods=HOURS, freq="h"))
+        assert list(frame.dtypes[["year", "month", "day", "hour", "cluster"]]) == [np.int64] * 5
+        expected = [observation("temperature_2m", latitude, longitude, int(t.timestamp())) for t in times]
+        np.testing.assert_allclose(frame["temperature_2m"], np.float32(expected))
+
+
+# A rerun only fetches the chunks whose parts are missing
+def test_rerun_resumes_failed_chunks(stub, tmp_path):
+    stub.failing.add(LOCATIONS[0][1:])
+    rows, failed = harvest(tmp_path)
+    assert (rows, failed) == (HOURS, 3)
+    assert all(name.startswith("city=bristol") for name in parts(tmp_path))
+
+    stub.failing.clear()
+    stub.calls.clear()
+    rows, failed = harvest(tmp_path)
+    assert (rows, failed) == (2 * HOURS, 0)
+    assert sorted(call["locations"] for call in stub.calls) == [[LOCATIONS[0][1:], LOCATIONS[1][1:]]] * 3
+    assert len(parts(tmp_path)) == 9
+
+    stub.calls.clear()
+    assert harvest(tmp_path) == (0, 0)
+    assert not stub.calls
+
+
+# SQLite storage whose bulk_load fails on one call
+class FailingStorage(storage.SQLiteStorage):
+    def __init__(self, path, fail_on=None):
+        super().__init__(path)
+        self.fail_on = fail_on
+        self.loads = 0
+
+    def bulk_load(self, city, dataframe):
+        self.loads += 1
+        if self.loads == self.fail_on:
+            raise RuntimeError("upload failed")
+        return super().bulk_load(city, dataframe)
+
+
+# An interrupted backfill of harvested parts resumes from its checkpoint
+def test_backfill_resumes_from_checkpoint(stub, tmp_path, monkeypatch):
+    output = tmp_path / "history"
+    harvest(output)
+    files = [(city, str(output / f"city={city}")) for city, _, _ in LOCATIONS[:1]]
+    checkpoint = str(tmp_path / "checkpoint.json")
+    database = str(tmp_path / "weather.sqlite")
+
+    monkeypatch.setattr(storage, "_storage", FailingStorage(database, fail_on=3))
+    with pytest.raises(RuntimeError):
+        data_injection.backfill(files, chunk_rows=50, workers=1, checkpoint_path=checkpoint)
+    with open(checkpoint) as f:
+        assert [entry["done"] for entry in json.load(f).values()] == [[0, 1]]
+
+    # The first part of 96 rows was read as chunks of 50 and 46 rows
+    monkeypatch.setattr(storage, "_storage", FailingStorage(database))
+    assert data_injection.backfill(files, chunk_rows=50, workers=1, checkpoint_path=checkpoint) == HOURS - 96
+    rows = storage.get_storage().read_latest({"colchester": None}, 2 * HOURS)["colchester"]
+    assert len(rows) == HOURS
+    assert len({(str(row["date"]), row["hour"]) for row in rows}) == HOURS
+
+    assert data_injection.backfill(files, chunk_rows=50, workers=1, checkpoint_path=checkpoint) == 0
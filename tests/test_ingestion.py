@@ -0,0 +1,185 @@
+import openmeteo_requests
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+import backend
+import files_updation
+from forecast_cache import ForecastCache
+from ingest_buffer import IngestBuffer
+from openmeteo_stub import OpenMeteoStub
+from storage import SQLiteStorage
+
+# 2024-06-01 12:00 UTC
+NOON = 1717243200
+
+
+@pytest.fixture
+def stub(monkeypatch, tmp_path):
+    stub = OpenMeteoStub(now=NOON).start()
+    storage = SQLiteStorage(str(tmp_path / "weather.sqlite"))
+    monkeypatch.setattr(files_updation, "url", stub.url)
+    monkeypatch.setattr(files_updation, "storage", storage)
+    monkeypatch.setattr(files_updation, "ingest_buffer",
+                        IngestBuffer(str(tmp_path / "ingest_buffer.sqlite"), writer=files_updation.write_observations))
+    files_updation.city_backoff.clear()
+    files_updation.last_ingested.clear()
+    yield stub
+    stub.stop()
+    files_updation.city_backoff.clear()
+    files_updation.last_ingested.clear()
+
+
+@pytest.fixture
+def client():
+    return openmeteo_requests.Client()
+
+
+def coordinates(city):
+    location = files_updation.CITIES[city]
+    return location["latitude"], location["longitude"]
+
+
+def stored_hours(city):
+    rows = files_updation.storage.read_latest({city: None}, 100)[city]
+    return [(str(row["date"]), row["hour"]) for row in rows]
+
+
+def test_cities_are_fetched_in_chunks(stub, client, monkeypatch):
+    monkeypatch.setattr(files_updation, "LOCATIONS_PER_CALL", 3)
+    new_df = files_updation.ingest(client=client)
+    cities = list(files_updation.CITIES)
+    assert sorted(len(call["locations"]) for call in stub.calls) == [1, 3, 3]
+    fetched = [location for call in stub.calls for location in call["locations"]]
+    assert sorted(fetched) == sorted(coordinates(city) for city in cities)
+    assert sorted(new_df["city"]) == sorted(cities)
+    for city in cities:
+        assert stored_hours(city) == [("2024-06-01", 12)]
+
+
+# Each response is matched to its own city
+def test_observations_belong_to_their_city(stub, client, monkeypatch):
+    monkeypatch.setattr(files_updation, "LOCATIONS_PER_CALL", 2)
+    new_df = files_updation.ingest(client=client).set_index("city")
+    for city in files_updation.CITIES:
+        expected = files_updation.read_current(
+            client.weather_api(stub.url, params={"latitude": [coordinates(city)[0]],
+                                                 "longitude": [coordinates(city)[1]],
+                                                 "current": files_updation.CURRENT_VARIABLES})[0])
+        assert new_df.loc[city, "temperature_2m"] == expected["temperature_2m"]
+
+
+def test_repeated_observation_is_skipped(stub, client):
+    first = files_updation.ingest(client=client)
+    assert len(first) == len(files_updation.CITIES)
+    skipped = dict(files_updation.duplicates_skipped.values)
+    again = files_updation.ingest(client=client)
+    assert len(again) == 0
+    for city in files_updation.CITIES:
+        assert files_updation.duplicates_skipped.values[(city,)] == skipped.get((city,), 0) + 1
+        assert stored_hours(city) == [("2024-06-01", 12)]
+    stub.advance()
+    assert len(files_updation.ingest(client=client)) == len(files_updation.CITIES)
+    for city in files_updation.CITIES:
+        assert stored_hours(city) == [("2024-06-01", 12), ("2024-06-01", 13)]
+
+
+# A batch replayed from the buffer after a restart keeps one row per hour
+def test_replayed_batch_is_upserted(stub, client):
+    new_df = files_updation.ingest(client=client)
+    files_updation.write_observations(pd.concat([new_df, new_df]))
+    for city in files_updation.CITIES:
+        assert stored_hours(city) == [("2024-06-01", 12)]
+
+
+def test_failed_call_is_retried(stub, client, monkeypatch):
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        stub.failing.clear()
+
+    monkeypatch.setattr(files_updation, "FETCH_RETRIES", 2)
+    monkeypatch.setattr(files_updation, "FETCH_BACKOFF_SECONDS", 10)
+    monkeypatch.setattr(files_updation.time, "sleep", sleep)
+    stub.failing.add(coordinates("london"))
+    new_df = files_updation.ingest(client=client)
+    assert len(sleeps) == 1 and 5 <= sleeps[0] <= 15
+    assert sorted(new_df["city"]) == sorted(files_updation.CITIES)
+    assert not files_updation.city_backoff
+
+
+# A city whose call keeps failing sits out, then is retried on its own
+def test_failing_city_backs_off_alone(stub, client, monkeypatch):
+    monkeypatch.setattr(files_updation, "LOCATIONS_PER_CALL", 3)
+    monkeypatch.setattr(files_updation, "FETCH_RETRIES", 0)
+    monkeypatch.setattr(files_updation, "FETCH_BACKOFF_SECONDS", 60)
+    cities = list(files_updation.CITIES)
+    first_chunk = cities[:3]
+    stub.failing.add(coordinates("bristol"))
+
+    def tick():
+        stub.calls.clear()
+        stub.advance()
+        return set(files_updation.ingest(client=client)["city"])
+
+    def make_due():
+        for city, (failures, _) in list(files_updation.city_backoff.items()):
+            files_updation.city_backoff[city] = (failures, 0)
+
+    # The whole chunk of the bad city fails, the other chunks are written
+    assert tick() == set(cities[3:])
+    assert set(files_updation.city_backoff) == set(first_chunk)
+    assert all(failures == 1 for failures, _ in files_updation.city_backoff.values())
+
+    # Backing-off cities are not fetched before they are due
+    assert tick() == set(cities[3:])
+    assert all(coordinates(city) not in call["locations"] for call in stub.calls for city in first_chunk)
+
+    # When due they are fetched one per call, so only the bad city fails again
+    make_due()
+    assert tick() == set(cities) - {"bristol"}
+    singles = [call["locations"] for call in stub.calls if len(call["locations"]) == 1]
+    assert sorted(singles) == sorted([coordinates(city)] for city in first_chunk + cities[-1:])
+    assert list(files_updation.city_backoff) == ["bristol"]
+    assert files_updation.city_backoff["bristol"][0] == 2
+
+    stub.failing.clear()
+    make_due()
+    assert tick() == set(cities)
+    assert not files_updation.city_backoff
+    assert len(stored_hours("bristol")) == 1
+    assert len(stored_hours("colchester")) == 2
+    assert len(stored_hours("ipswich")) == 4
+
+
+# FORECAST_MODE=materialized: each write stores the forecasts of its cities,
+# which the backend serves without running the models
+def test_written_observations_are_forecast_once(stub, client, models, monkeypatch):
+    monkeypatch.setattr(files_updation, "FORECAST_MODE", "materialized")
+    cities = list(files_updation.CITIES)
+    for _ in range(4):
+        files_updation.ingest(client=client)
+        stub.advance()
+    # The first two hours can't be forecast yet, the next two are batched
+    assert all(model.calls == [len(cities)] * 2 for model in models.values())
+
+    storage = files_updation.storage
+    stored = storage.read_forecasts(cities)
+    assert sorted(stored) == sorted(cities)
+    for city, (issued_at, forecast) in stored.items():
+        assert issued_at == pd.Timestamp("2024-06-01 15:00")
+        latest = storage.read_latest({city: None}, 1)[city][0]
+        assert forecast["current"]["temperature"] == round(latest["temperature_2m"])
+
+    monkeypatch.setattr(backend, "storage", storage)
+    monkeypatch.setattr(backend, "FORECAST_MODE", "materialized")
+    monkeypatch.setattr(backend, "forecast_cache", ForecastCache())
+    monkeypatch.setattr(backend, "city_windows", {})
+    api = TestClient(backend.app)
+    history = api.get("/weather/colchester/history").json()
+    assert [entry["issued_at"] for entry in history] == ["2024-06-01T15:00:00", "2024-06-01T14:00:00"]
+    assert history[0]["forecast"] == stored["colchester"][1]["forecast"]
+    assert len(api.get("/weather/colchester/history?limit=1").json()) == 1
+    assert api.get("/weather/colchester").json() == stored["colchester"][1]
+    assert all(len(model.calls) == 2 for model in models.values())
@@ -0,0 +1,155 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor, RandomForestRegressor
+from sklearn.linear_model import LinearRegression, Ridge
+from sklearn.multioutput import MultiOutputRegressor
+from sklearn.preprocessing import MinMaxScaler, StandardScaler
+
+from features import MODEL_FEATURES, build_windows, model_input
+from model_registry import MANIFEST_PATH, ModelRegistry
+from pipelines import build_pipeline, fold_trees, raw_thresholds, three_step_predict
+from tree_compiler import compile_model
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOLERANCE = 1e-6
+
+
+# Registry-like holder for one model and its scalers
+class Registry:
+    def __init__(self, model, x_scaler, y_scaler, compiled=None):
+        self.parts = {"model": model, "x_scaler": x_scaler, "y_scaler": y_scaler, "compiled": compiled}
+
+    def model(self, target):
+        return self.parts["model"]
+
+    def x_scaler(self, target):
+        return self.parts["x_scaler"]
+
+    def y_scaler(self, target):
+        return self.parts["y_scaler"]
+
+    def compiled(self, target):
+        return self.parts["compiled"]
+
+
+# Raw features on very different scales and two outputs, with the models
+# trained in scaled space like the production ones
+def fit(estimator, x_scaler=None, y_scaler=None, n=400, seed=0, missing=None):
+    rng = np.random.RandomState(seed)
+    X = rng.normal(size=(n, 4)) * [1.0, 50.0, 0.01, 1000.0] + [0.0, 1000.0, 5.0, -300.0]
+    y = np.column_stack([X[:, 0] * 3 + X[:, 1] / 100, np.sin(X[:, 2] * 100) + X[:, 3] / 1000]) * [10.0, 0.5]
+    if missing is not None:
+        X[rng.rand(*X.shape) < 0.2] = missing
+    x_scaler = (x_scaler or StandardScaler()).fit(X)
+    y_scaler = (y_scaler or StandardScaler()).fit(y)
+    model = MultiOutputRegressor(estimator).fit(x_scaler.transform(X), y_scaler.transform(y))
+    return X, Registry(model, x_scaler, y_scaler)
+
+
+def assert_matches_three_step(pipeline, registry, X):
+    expected = three_step_predict(registry, "target", X)
+    np.testing.assert_allclose(pipeline.predict(X), expected, rtol=0, atol=TOLERANCE)
+    single = np.vstack([pipeline.predict(X[i:i + 1]) for i in range(20)])
+    np.testing.assert_allclose(single, expected[:20], rtol=0, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("scalers", [(StandardScaler, StandardScaler), (MinMaxScaler, StandardScaler),
+                                     (StandardScaler, MinMaxScaler)], ids=["standard", "minmax_x", "minmax_y"])
+@pytest.mark.parametrize("estimator", [LinearRegression, Ridge])
+def test_folded_linear(estimator, scalers):
+    X, registry = fit(estimator(), scalers[0](), scalers[1]())
+    pipeline = build_pipeline(registry, "target")
+    assert pipeline.folded is not None
+    assert_matches_three_step(pipeline, registry, X)
+
+
+@pytest.mark.parametrize("scalers", [(StandardScaler, StandardScaler), (MinMaxScaler, MinMaxScaler)],
+                         ids=["standard", "minmax"])
+@pytest.mark.parametrize("make", [
+    lambda: GradientBoostingRegressor(n_estimators=20, max_depth=3, random_state=0),
+    lambda: RandomForestRegressor(n_estimators=10, max_depth=6, random_state=0),
+    lambda: GradientBoostingRegressor(n_estimators=1, max_depth=2, random_state=0),
+], ids=["gradient_boosting", "random_forest", "one_tree"])
+def test_folded_trees(make, scalers):
+    X, registry = fit(make(), scalers[0](), scalers[1]())
+    registry.parts["compiled"] = compile_model(registry.parts["model"])
+    pipeline = build_pipeline(registry, "target", compiled_max_rows=None)
+    assert pipeline.folded is not None
+    assert_matches_three_step(pipeline, registry, X)
+
+
+# NaN is NaN on either side of the x scaler, so trees trained with missing
+# values still fold
+def test_folded_trees_nan_inputs():
+    X, registry = fit(HistGradientBoostingRegressor(max_iter=20, random_state=0), missing=np.nan)
+    registry.parts["compiled"] = compile_model(registry.parts["model"])
+    pipeline = build_pipeline(registry, "target", compiled_max_rows=None)
+    assert pipeline.folded is not None
+    assert_matches_three_step(pipeline, registry, X)
+
+
+# A scaled zero is a raw value at the feature mean, so zero-as-missing trees
+# keep the unfolded path and stay correct
+def test_zero_as_missing_trees_stay_unfolded():
+    lgb = pytest.importorskip("lightgbm")
+    X, registry = fit(lgb.LGBMRegressor(n_estimators=20, min_child_samples=5, zero_as_missing=True, verbose=-1))
+    X[::7, 1] = registry.parts["x_scaler"].mean_[1]
+    X[::11, 2] = 0.0
+    compiled = compile_model(registry.parts["model"])
+    assert compiled.has_missing
+    assert fold_trees(compiled, registry.parts["x_scaler"], registry.parts["y_scaler"]) is None
+    registry.parts["compiled"] = compiled
+    pipeline = build_pipeline(registry, "target", compiled_max_rows=None)
+    assert pipeline.folded is None
+    assert_matches_three_step(pipeline, registry, X)
+
+
+# Batches past compiled_max_rows go through the native estimators
+def test_large_batches_use_the_scaled_model():
+    X, registry = fit(RandomForestRegressor(n_estimators=5, max_depth=4, random_state=0))
+    registry.parts["compiled"] = compile_model(registry.parts["model"])
+    pipeline = build_pipeline(registry, "target", compiled_max_rows=16)
+    assert_matches_three_step(pipeline, registry, X)
+
+
+@pytest.mark.parametrize("float32", [False, True])
+def test_raw_thresholds_split_like_the_scaled_features(float32):
+    rng = np.random.RandomState(0)
+    threshold = rng.normal(size=500)
+    mean = rng.normal(size=500) * 100
+    scale = np.exp(rng.normal(size=500) * 3)
+
+    def scaled(x):
+        value = (x - mean) / scale
+        return value.astype(np.float32).astype(np.float64) if float32 else value
+
+    raw = raw_thresholds(threshold, mean, scale, float32)
+    assert (scaled(raw) <= threshold).all()
+    assert (scaled(np.nextafter(raw, np.inf)) > threshold).all()
+
+
+# Every shipped pipeline matches the three-step path on real feature rows
+def test_registry_pipelines():
+    data_path = os.path.join(ROOT, "Data/processed.csv")
+    if not os.path.exists(data_path):
+        pytest.skip("Data/processed.csv is not available")
+    windows = build_windows(pd.read_csv(data_path, nrows=2000))[2:]
+    registry = ModelRegistry(os.path.join(ROOT, MANIFEST_PATH))
+    checked = 0
+    for target in MODEL_FEATURES:
+        try:
+            pipeline = build_pipeline(registry, target)
+        except FileNotFoundError:
+            continue
+        X = model_input(windows, target)
+        expected = three_step_predict(registry, target, X)
+        for rows in (1, 64, len(X)):
+            got = np.vstack([pipeline.predict(X[i:i + rows]) for i in range(0, min(len(X), 64 * rows), rows)])
+            np.testing.assert_allclose(got, expected[:len(got)], rtol=0, atol=TOLERANCE, err_msg=target)
+        checked += 1
+    if not checked:
+        pytest.skip("No models in the registry")
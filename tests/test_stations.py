@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+from stations import StationIndex, idw_weights, load_cities
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Landmarks near each shipped city: west of Greenwich longitudes are negative
+@pytest.mark.parametrize("latitude, longitude, city", [
+    (51.4769, 0.0, "london"),         # Greenwich
+    (51.3811, -2.359, "bristol"),     # Bath
+    (51.7343, 0.4691, "colchester"),  # Chelmsford
+])
+def test_shipped_cities_are_near_their_landmarks(latitude, longitude, city):
+    index = StationIndex(load_cities(os.path.join(ROOT, "cities.json")))
+    [(name, km)] = index.nearest(latitude, longitude, k=1)
+    assert name == city
+    assert km < 40
+
+
+def test_exact_station_gets_all_the_weight():
+    assert list(idw_weights([0.0, 10.0, 20.0])) == [1.0, 0.0, 0.0]
@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import harvester
+import training
+from data_injection import clean_chunk
+from storage import OBSERVATION_COLUMNS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def history(tmp_path):
+    data_path = os.path.join(ROOT, "Data/processed.csv")
+    if not os.path.exists(data_path):
+        pytest.skip("Data/processed.csv is not available")
+    rows = clean_chunk(pd.read_csv(data_path, nrows=200, usecols=OBSERVATION_COLUMNS))
+    output = tmp_path / "history"
+    harvester.write_part(str(output / "city=colchester" / "a.parquet"), rows[:100])
+    # Three missing hours in the middle of london's history
+    harvester.write_part(str(output / "city=london" / "a.parquet"), rows[100:150])
+    harvester.write_part(str(output / "city=london" / "b.parquet"), rows[153:200])
+    return output
+
+
+def matrices(cache_dir, target):
+    return [np.asarray(matrix) for matrix in training.load_matrices(str(cache_dir), target)]
+
+
+def test_windows_stay_within_a_city_and_skip_gaps(history, tmp_path):
+    training.build_cache(str(history), str(tmp_path / "all"))
+    training.build_cache(str(history / "city=colchester"), str(tmp_path / "colchester"))
+    training.build_cache(str(history / "city=london"), str(tmp_path / "london"))
+    for target, (_, lags) in training.MODEL_FEATURES.items():
+        span = lags + training.FORECAST_HOURS
+        X, y = matrices(tmp_path / "all", target)
+        colchester = matrices(tmp_path / "colchester", target)
+        london = matrices(tmp_path / "london", target)
+        assert len(colchester[0]) == 100 - span
+        assert len(london[0]) == (50 - span) + (47 - span)
+        # Merged in issue time order
+        assert len(X) == len(colchester[0]) + len(london[0])
+        hours = np.asarray(training.load_hours(str(tmp_path / "all"), target))
+        order = np.argsort(np.concatenate([training.load_hours(str(tmp_path / city), target)
+                                           for city in ("colchester", "london")]), kind="stable")
+        np.testing.assert_array_equal(X, np.vstack([colchester[0], london[0]])[order])
+        np.testing.assert_array_equal(y, np.vstack([colchester[1], london[1]])[order])
+        assert (np.diff(hours) >= 0).all()
+
+
+# Rewriting a nested part leaves the root's mtime alone but rebuilds the cache
+def test_cache_follows_nested_parts(history, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    training.build_cache(str(history), cache_dir)
+    before = matrices(cache_dir, "temperature")[0]
+    part = history / "city=colchester" / "a.parquet"
+    stat = os.stat(history)
+    frame = pd.read_parquet(part)
+    frame["temperature_2m"] += 1.0
+    harvester.write_part(str(part), frame[OBSERVATION_COLUMNS])
+    os.utime(history, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    training.build_cache(str(history), cache_dir)
+    after = matrices(cache_dir, "temperature")[0]
+    assert not np.array_equal(before, after)
+
+
+# Cities are split at one time cutoff: every city is scored on its latest
+# hours, and no training row comes after a scored one
+def test_every_city_is_scored_on_its_latest_hours(tmp_path):
+    data_path = os.path.join(ROOT, "Data/processed.csv")
+    if not os.path.exists(data_path):
+        pytest.skip("Data/processed.csv is not available")
+    rows = clean_chunk(pd.read_csv(data_path, nrows=300, usecols=OBSERVATION_COLUMNS))
+    output = tmp_path / "history"
+    # Overlapping hours; london starts and ends 50 hours after colchester,
+    # and is told apart by its temperatures
+    harvester.write_part(str(output / "city=colchester" / "a.parquet"), rows[:250])
+    london = rows[50:300].copy()
+    london["temperature_2m"] += 1000.0
+    harvester.write_part(str(output / "city=london" / "a.parquet"), london)
+    training.build_cache(str(output), str(tmp_path / "cache"))
+    for target in training.TARGET_COLUMNS:
+        hours = np.asarray(training.load_hours(str(tmp_path / "cache"), target))
+        split = training.train_rows(hours)
+        assert (np.diff(hours) >= 0).all()
+        assert hours[:split].max() < hours[split:].min()
+        assert abs(split - len(hours) * training.TRAIN_FRACTION) <= 1
+
+    X, _ = matrices(tmp_path / "cache", "temperature")
+    hours = np.asarray(training.load_hours(str(tmp_path / "cache"), "temperature"))
+    split = training.train_rows(hours)
+    is_london = X[:, training.feature_names("temperature").index("temperature_2m")] > 500
+    for city, rows_of_city in (("colchester", ~is_london), ("london", is_london)):
+        scored = hours[split:][rows_of_city[split:]]
+        every = hours[rows_of_city]
+        assert len(scored) and len(scored) < len(every)
+        # The scored rows of each city are its latest hours
+        np.testing.assert_array_equal(scored, every[-len(scored):])
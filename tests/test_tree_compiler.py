@@ -0,0 +1,133 @@
+import os
+
+import numpy as np
+import pytest
+from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor, RandomForestRegressor
+from sklearn.multioutput import MultiOutputRegressor
+from sklearn.tree import DecisionTreeRegressor
+
+from model_registry import MANIFEST_PATH, ModelRegistry
+from tree_compiler import check_parity, compile_model
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOLERANCE = 1e-5
+
+
+# Small two-output regression problem
+def dataset(n=400, n_features=5, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.normal(size=(n, n_features))
+    y = np.column_stack([X[:, 0] * 2 + np.sin(X[:, 1]), X[:, 2] * X[:, 3] + rng.normal(scale=0.1, size=n)])
+    return X, y
+
+
+def assert_parity(model, X):
+    compiled = compile_model(model)
+    expected = np.asarray(model.predict(X)).reshape(len(X), -1)
+    np.testing.assert_allclose(compiled.predict(X), expected, rtol=0, atol=TOLERANCE)
+    single = np.vstack([compiled.predict(X[i:i + 1]) for i in range(20)])
+    np.testing.assert_allclose(single, expected[:20], rtol=0, atol=TOLERANCE)
+    assert check_parity(model, compiled) <= TOLERANCE
+    return compiled
+
+
+def lightgbm(**params):
+    lgb = pytest.importorskip("lightgbm")
+    return lgb.LGBMRegressor(n_estimators=20, num_leaves=15, min_child_samples=5, verbose=-1, **params)
+
+
+def xgboost():
+    xgb = pytest.importorskip("xgboost")
+    return xgb.XGBRegressor(n_estimators=20, max_depth=4)
+
+
+@pytest.mark.parametrize("make", [
+    lambda: GradientBoostingRegressor(n_estimators=20, max_depth=3, random_state=0),
+    lambda: RandomForestRegressor(n_estimators=10, max_depth=6, random_state=0),
+    lambda: DecisionTreeRegressor(max_depth=5, random_state=0),
+    lambda: HistGradientBoostingRegressor(max_iter=20, random_state=0),
+    lightgbm,
+    xgboost,
+], ids=["gradient_boosting", "random_forest", "decision_tree", "hist_gradient_boosting", "lightgbm", "xgboost"])
+def test_matches_original_predictions(make):
+    X, y = dataset()
+    model = MultiOutputRegressor(make()).fit(X, y)
+    assert_parity(model, X)
+
+
+def test_single_regressor():
+    X, y = dataset()
+    model = GradientBoostingRegressor(n_estimators=10, random_state=0).fit(X, y[:, 0])
+    compiled = compile_model(model)
+    np.testing.assert_allclose(compiled.predict(X)[:, 0], model.predict(X), rtol=0, atol=TOLERANCE)
+
+
+# Missing values follow each node's learned default direction
+@pytest.mark.parametrize("make", [
+    lambda: HistGradientBoostingRegressor(max_iter=20, random_state=0),
+    lightgbm,
+    xgboost,
+], ids=["hist_gradient_boosting", "lightgbm", "xgboost"])
+def test_nan_inputs(make):
+    X, y = dataset()
+    X[np.random.RandomState(1).rand(*X.shape) < 0.2] = np.nan
+    model = MultiOutputRegressor(make()).fit(X, y)
+    compiled = assert_parity(model, X)
+    assert not compiled.has_missing
+
+
+# LightGBM zero_as_missing treats zeros like NaN
+def test_lightgbm_zero_as_missing():
+    X, y = dataset()
+    X[np.random.RandomState(1).rand(*X.shape) < 0.2] = 0.0
+    model = MultiOutputRegressor(lightgbm(zero_as_missing=True)).fit(X, y)
+    compiled = assert_parity(model, X)
+    assert compiled.has_missing
+    X[:5] = np.nan
+    np.testing.assert_allclose(compiled.predict(X), model.predict(X), rtol=0, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("make", [
+    lambda: GradientBoostingRegressor(n_estimators=1, max_depth=3, random_state=0),
+    lambda: DecisionTreeRegressor(max_depth=1, random_state=0),
+    lambda: RandomForestRegressor(n_estimators=1, max_depth=2, random_state=0),
+], ids=["one_tree", "stump", "one_tree_forest"])
+def test_one_tree(make):
+    X, y = dataset()
+    model = MultiOutputRegressor(make()).fit(X, y)
+    assert_parity(model, X)
+
+
+# A constant target gives trees that are a single leaf
+def test_single_leaf_trees():
+    X, _ = dataset()
+    y = np.column_stack([np.full(len(X), 3.5), np.full(len(X), -1.0)])
+    model = MultiOutputRegressor(DecisionTreeRegressor()).fit(X, y)
+    compiled = assert_parity(model, X)
+    assert compiled.max_depth == 0
+    np.testing.assert_allclose(compiled.predict(X[:3]), [[3.5, -1.0]] * 3)
+
+
+def test_wrong_feature_count():
+    X, y = dataset()
+    compiled = compile_model(MultiOutputRegressor(DecisionTreeRegressor(max_depth=2)).fit(X, y))
+    with pytest.raises(ValueError):
+        compiled.predict(X[:, :3])
+
+
+# Shipped compiled models still match the models they were built from
+def test_registry_compiled_models():
+    registry = ModelRegistry(os.path.join(ROOT, MANIFEST_PATH))
+    checked = 0
+    for target in registry.targets():
+        try:
+            compiled = registry.compiled(target)
+        except FileNotFoundError:
+            continue
+        if compiled is None:
+            continue
+        assert check_parity(registry.model(target), compiled) <= TOLERANCE, target
+        checked += 1
+    if not checked:
+        pytest.skip("No compiled models in the registry")
@@ -0,0 +1,328 @@
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+
+import joblib
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from features import FEATURE_COLUMNS, FEATURE_INDEX, MODEL_FEATURES, build_windows, feature_names
+from model_registry import MANIFEST_PATH
+
+# Retraining of the five target models, replacing the per-target notebooks:
+#
+#   python training.py                          # search every target, report only
+#   python training.py rain wind --export       # retrain two targets and install them
+#
+# The lagged feature and target matrices of every target are built once from
+# the history, with the same window layout the backend feeds the models
+# (features.build_windows), and cached as .npy files that every worker opens
+# memory-mapped, so the search never rebuilds or copies them. Each
+# (target, candidate, parameters) fit is one task on a process pool. As in the
+# notebooks, the first TRAIN_FRACTION of the rows trains, the rest scores, and
+# candidates are ranked by their mean absolute error over the forecast hours.
+# With several cities the rows are ordered by issue time and split at one
+# time cutoff, so every city is scored on its latest hours and no training
+# row comes after a scored one.
+#
+# --export writes the winning model and its scalers to the paths listed in
+# Models/manifest.json, records the version and feature list, and recompiles
+# the tree ensembles (tree_compiler.py).
+
+DATA_PATH = "Data/processed.csv"
+CACHE_DIR = os.environ.get("TRAINING_CACHE_DIR", "Data/training_cache")
+RESULTS_PATH = "training_results.json"
+TRAIN_FRACTION = 0.8
+FORECAST_HOURS = 5
+# Columns giving the observation time of a row
+TIME_COLUMNS = ["year", "month", "day", "hour"]
+
+# Observation column each target forecasts
+TARGET_COLUMNS = {
+    "temperature": "temperature_2m",
+    "rain": "precipitation",
+    "snow": "snowfall",
+    "cloud": "cloud_cover",
+    "wind": "wind_speed_10m",
+}
+
+# Candidate estimators, each wrapped in a MultiOutputRegressor, and the
+# parameter grid searched for each. Candidates whose package isn't installed
+# are skipped.
+CANDIDATES = {
+    "linear": ("sklearn.linear_model", "LinearRegression", {}, [{}]),
+    "knn": ("sklearn.neighbors", "KNeighborsRegressor", {}, [{"n_neighbors": k} for k in (5, 10, 20)]),
+    "tree": ("sklearn.tree", "DecisionTreeRegressor", {"random_state": 0},
+             [{"max_depth": depth} for depth in (8, 12, None)]),
+    "forest": ("sklearn.ensemble", "RandomForestRegressor", {"random_state": 0, "n_jobs": 1},
+               [{"n_estimators": 100, "max_depth": depth} for depth in (12, None)]),
+    "gradient_boosting": ("sklearn.ensemble", "GradientBoostingRegressor", {"random_state": 0},
+                          [{"n_estimators": n} for n in (100, 300)]),
+    "hist_gradient_boosting": ("sklearn.ensemble", "HistGradientBoostingRegressor", {"random_state": 0},
+                               [{"max_iter": n} for n in (100, 300)]),
+    "lightgbm": ("lightgbm", "LGBMRegressor", {"random_state": 0, "n_jobs": 1, "verbose": -1},
+                 [{"n_estimators": n} for n in (100, 300)]),
+    "xgboost": ("xgboost", "XGBRegressor", {"random_state": 0, "n_jobs": 1},
+                [{"n_estimators": n, "max_depth": 6} for n in (100, 300)]),
+}
+
+
+def available_candidates(names=None):
+    names = names or list(CANDIDATES)
+    unknown = set(names) - set(CANDIDATES)
+    if unknown:
+        raise ValueError(f"Unknown candidates: {', '.join(sorted(unknown))}")
+    return [name for name in names if importlib.util.find_spec(CANDIDATES[name][0]) is not None]
+
+
+def make_model(candidate, params):
+    from sklearn.multioutput import MultiOutputRegressor
+    module, name, fixed, _ = CANDIDATES[candidate]
+    estimator = getattr(importlib.import_module(module), name)(**fixed, **params)
+    return MultiOutputRegressor(estimator)
+
+
+# Feature rows of `target` for every issue time with full lags and
+# FORECAST_HOURS observed hours after it, the matching target rows and the
+# issue times.
+# `hours` numbers the rows in hours, increasing; issue times whose lags and
+# forecast hours aren't consecutive hours are left out, so no row spans a gap
+# in the history.
+def target_matrices(windows, values, hours, target):
+    lags = MODEL_FEATURES[target][1]
+    column = values[:, FEATURE_COLUMNS.index(TARGET_COLUMNS[target])]
+    rows = np.arange(lags, len(values) - FORECAST_HOURS)
+    rows = rows[hours[rows + FORECAST_HOURS] - hours[rows - lags] == lags + FORECAST_HOURS]
+    X = windows[rows][:, FEATURE_INDEX[target]]
+    y = sliding_window_view(column[1:], FORECAST_HOURS)[rows]
+    keep = ~(np.isnan(X).any(axis=1) | np.isnan(y).any(axis=1))
+    return X[keep], y[keep], hours[rows][keep]
+
+
+# The files the history is read from: the file itself, or every Parquet part
+# under a directory such as Data/history or one of its city partitions
+def _source_files(data_path):
+    if not os.path.isdir(data_path):
+        return [data_path]
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(data_path)
+                  for name in names if name.endswith(".parquet"))
+
+
+# Keyed on every source file, since rewriting a part nested in a partitioned
+# directory doesn't change the directory's own mtime
+def _cache_meta(data_path):
+    files = []
+    for path in _source_files(data_path):
+        stat = os.stat(path)
+        files.append([os.path.relpath(path, data_path), stat.st_size, stat.st_mtime])
+    return {"data": os.path.abspath(data_path), "files": files,
+            "columns": FEATURE_COLUMNS, "models": MODEL_FEATURES, "hours": FORECAST_HOURS, "order": "issue_time"}
+
+
+# History rows with the feature and time columns, and the city column when
+# reading the root of a dataset partitioned by city
+def read_history(data_path):
+    columns = list(dict.fromkeys(FEATURE_COLUMNS + TIME_COLUMNS))
+    if data_path.endswith(".parquet") or os.path.isdir(data_path):
+        import pyarrow.dataset as ds
+        dataset = ds.dataset(data_path, format="parquet", partitioning="hive")
+        if "city" in dataset.schema.names:
+            columns.append("city")
+        return dataset.to_table(columns=columns).to_pandas()
+    return pd.read_csv(data_path, usecols=columns)
+
+
+# Each city's rows in time order, one per hour, with their hours since the
+# epoch
+def city_series(data):
+    groups = data.groupby("city", observed=True, sort=True) if "city" in data else [(None, data)]
+    for _, rows in groups:
+        hours = pd.to_datetime(rows[TIME_COLUMNS]).to_numpy().astype("datetime64[h]").astype(np.int64)
+        order = np.argsort(hours, kind="stable")
+        # The last copy of a repeated hour wins, like the storage upserts
+        last = np.append(hours[order][1:] != hours[order][:-1], True)
+        order = order[last]
+        yield rows.iloc[order].reset_index(drop=True), hours[order]
+
+
+def _save(path, array):
+    tmp_path = f"{path}.tmp.npy"
+    np.save(tmp_path, np.ascontiguousarray(array))
+    os.replace(tmp_path, path)
+
+
+# Cached (X, y) matrices of every target and the issue hour of each row,
+# rebuilt when the history or the feature layout changed. Windows are built
+# per city, so lags never reach into another city's rows; the cities' rows
+# are then merged in issue time order.
+def build_cache(data_path=DATA_PATH, cache_dir=CACHE_DIR):
+    meta_path = os.path.join(cache_dir, "meta.json")
+    meta = json.loads(json.dumps(_cache_meta(data_path)))  # tuples as lists, like the stored copy
+    try:
+        with open(meta_path) as f:
+            if json.load(f) == meta:
+                return
+    except (FileNotFoundError, ValueError):
+        pass
+    os.makedirs(cache_dir, exist_ok=True)
+    matrices = {target: ([], [], []) for target in TARGET_COLUMNS}
+    for data, hours in city_series(read_history(data_path)):
+        windows = build_windows(data)
+        values = data[FEATURE_COLUMNS].to_numpy(dtype=np.float64)
+        for target, parts in matrices.items():
+            for part, array in zip(parts, target_matrices(windows, values, hours, target)):
+                part.append(array)
+    for target, (Xs, ys, issued) in matrices.items():
+        issued = np.concatenate(issued)
+        order = np.argsort(issued, kind="stable")
+        X, y = np.concatenate(Xs)[order], np.concatenate(ys)[order]
+        _save(os.path.join(cache_dir, f"{target}_X.npy"), X)
+        _save(os.path.join(cache_dir, f"{target}_y.npy"), y)
+        _save(os.path.join(cache_dir, f"{target}_hours.npy"), issued[order])
+        print(f"Cached {target}: {X.shape[0]} rows, {X.shape[1]} features")
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=4)
+
+
+def load_matrices(cache_dir, target):
+    return (np.load(os.path.join(cache_dir, f"{target}_X.npy"), mmap_mode="r"),
+            np.load(os.path.join(cache_dir, f"{target}_y.npy"), mmap_mode="r"))
+
+
+def load_hours(cache_dir, target):
+    return np.load(os.path.join(cache_dir, f"{target}_hours.npy"), mmap_mode="r")
+
+
+# Number of leading rows that train: the first TRAIN_FRACTION of the rows,
+# moved back to the start of an issue hour so the cities sharing that hour
+# all land on the scored side
+def train_rows(hours):
+    split = round(len(hours) * TRAIN_FRACTION)
+    if split >= len(hours):
+        return len(hours)
+    return int(np.searchsorted(hours, hours[split], side="left"))
+
+
+# Fit one candidate on the training rows and score it on the rest, in the
+# target's own units. With `keep`, the fitted model and scalers are returned
+# too. Runs in a worker process.
+def evaluate(cache_dir, target, candidate, params, keep=False):
+    from sklearn.preprocessing import StandardScaler
+    X, y = load_matrices(cache_dir, target)
+    split = train_rows(load_hours(cache_dir, target))
+    x_scaler = StandardScaler()
+    y_scaler = StandardScaler()
+    # Fitted on named columns, like the notebooks, so the registry can check
+    # the column order on load
+    x_train = x_scaler.fit_transform(pd.DataFrame(X[:split], columns=feature_names(target)))
+    y_train = y_scaler.fit_transform(y[:split])
+    start = time.perf_counter()
+    model = make_model(candidate, params)
+    model.fit(x_train, y_train)
+    fit_seconds = time.perf_counter() - start
+    x_test = x_scaler.transform(pd.DataFrame(X[split:], columns=feature_names(target)))
+    pred = y_scaler.inverse_transform(model.predict(x_test))
+    error = pred - y[split:]
+    result = {
+        "target": target,
+        "candidate": candidate,
+        "params": params,
+        "mae": np.abs(error).mean(axis=0).tolist(),
+        "rmse": np.sqrt((error ** 2).mean(axis=0)).tolist(),
+        "fit_seconds": fit_seconds,
+    }
+    result["mean_mae"] = float(np.mean(result["mae"]))
+    if keep:
+        return result, model, x_scaler, y_scaler
+    return result
+
+
+# Every candidate of every target on a pool of `workers` processes; returns
+# all results and the best of each target
+def search(targets, candidates, cache_dir=CACHE_DIR, workers=None):
+    tasks = [(target, candidate, params)
+             for target in targets for candidate in candidates for params in CANDIDATES[candidate][3]]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(evaluate, cache_dir, *task): task for task in tasks}
+        for future in as_completed(futures):
+            target, candidate, params = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"{target:12s} {candidate:24s} {params} failed: {e}")
+                continue
+            results.append(result)
+            print(f"{target:12s} {candidate:24s} {json.dumps(params):36s} "
+                  f"MAE {result['mean_mae']:8.4f}  fit {result['fit_seconds']:7.1f} s")
+    best = {}
+    for result in results:
+        if result["target"] not in best or result["mean_mae"] < best[result["target"]]["mean_mae"]:
+            best[result["target"]] = result
+    return results, best
+
+
+def refit(cache_dir, result):
+    return evaluate(cache_dir, result["target"], result["candidate"], result["params"], keep=True)
+
+
+# Refit the winners and install them where the manifest points, then
+# recompile the tree ensembles among them
+def export(best, cache_dir=CACHE_DIR, manifest_path=MANIFEST_PATH, version=None, workers=None):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(manifest_path)))
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        fitted = pool.map(refit, [cache_dir] * len(best), best.values())
+        for result, model, x_scaler, y_scaler in fitted:
+            target = result["target"]
+            entry = manifest["models"][target]
+            for kind, obj in (("model", model), ("x_scaler", x_scaler), ("y_scaler", y_scaler)):
+                path = os.path.join(root, entry[kind])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                joblib.dump(obj, path)
+            entry["version"] = version or date.today().isoformat()
+            entry["features"] = feature_names(target)
+            entry.pop("compiled", None)  # compiled from the previous model
+            print(f"Exported {target}: {result['candidate']} {json.dumps(result['params'])} "
+                  f"to {entry['model']} (version {entry['version']})")
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+        f.write("\n")
+    import tree_compiler
+    tree_compiler.compile_registry(manifest_path, list(best))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the forecast models")
+    parser.add_argument("targets", nargs="*", help=f"targets to train (default: {', '.join(TARGET_COLUMNS)})")
+    parser.add_argument("--data", default=DATA_PATH, help="history CSV, Parquet file or directory of Parquet parts")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--candidates", nargs="*", help=f"subset of {', '.join(CANDIDATES)}")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--export", action="store_true", help="install the best model of each target")
+    parser.add_argument("--version", help="version recorded in the manifest (default: today)")
+    parser.add_argument("--manifest", default=MANIFEST_PATH)
+    parser.add_argument("--output", default=RESULTS_PATH)
+    args = parser.parse_args()
+
+    targets = args.targets or list(TARGET_COLUMNS)
+    unknown = set(targets) - set(TARGET_COLUMNS)
+    if unknown:
+        parser.error(f"unknown targets: {', '.join(sorted(unknown))}")
+    candidates = available_candidates(args.candidates)
+    build_cache(args.data, args.cache_dir)
+    results, best = search(targets, candidates, args.cache_dir, args.workers)
+    with open(args.output, "w") as f:
+        json.dump({"results": results, "best": best}, f, indent=2)
+    for target, result in best.items():
+        print(f"Best {target}: {result['candidate']} {json.dumps(result['params'])} "
+              f"MAE {result['mean_mae']:.4f} by hour {np.round(result['mae'], 4).tolist()}")
+    if args.export:
+        export(best, args.cache_dir, args.manifest, args.version, args.workers)
@@ -0,0 +1,297 @@
+import argparse
+import json
+import os
+import sys
+
+import joblib
+import numpy as np
+
+from model_registry import MANIFEST_PATH, ModelRegistry
+
+
+# Offline compiler for the tree-ensemble models. A fitted MultiOutputRegressor
+# (or a single regressor) of sklearn GradientBoosting / RandomForest /
+# ExtraTrees / DecisionTree / HistGradientBoosting, LightGBM or XGBoost trees
+# is packed into flat NumPy node arrays, and CompiledEnsemble.predict walks
+# every tree of every output at once, one level per step, instead of calling
+# hundreds of estimator objects from Python.
+#
+# Nodes of all trees live in the same arrays, renumbered breadth-first so the
+# two children of a node are adjacent: a row moves to left[node] + go_right.
+# A leaf points to itself with an infinite threshold and sends missing values
+# left, so a row that reaches a leaf before its tree's last level just stays
+# there. Leaf values are pre-multiplied by the learning rate (or 1 / n_trees
+# for forests), summed per output and added to the output's base score.
+class CompiledEnsemble:
+    def __init__(self, trees, n_features, float32=False):
+        # trees: one (base, [tree, ...]) pair per output, each tree a dict of
+        # node arrays from _tree()
+        packed_trees = []
+        base = []
+        for output, (output_base, output_trees) in enumerate(trees):
+            base.append(output_base)
+            packed_trees += [(*_pack(tree), output) for tree in output_trees]
+        # Deepest trees first, so level d only has to advance the first
+        # n_active[d] trees
+        packed_trees.sort(key=lambda packed: -packed[1])
+        columns = {name: [] for name in ("feature", "threshold", "left", "default_left", "zero_missing", "value")}
+        roots = []
+        offset = 0
+        for packed, _, _ in packed_trees:
+            roots.append(offset)
+            packed["left"] = packed["left"] + offset
+            for name, column in columns.items():
+                column.append(packed[name])
+            offset += len(packed["feature"])
+        depths = np.array([depth for _, depth, _ in packed_trees])
+        self.max_depth = int(depths.max())
+        self.n_active = np.array([(depths > level).sum() for level in range(self.max_depth)], dtype=np.intp)
+        self.feature = np.concatenate(columns["feature"]).astype(np.intp)
+        self.threshold = np.concatenate(columns["threshold"]).astype(np.float64)
+        self.left = np.concatenate(columns["left"]).astype(np.intp)
+        self.default_left = np.concatenate(columns["default_left"]).astype(bool)
+        self.zero_missing = np.concatenate(columns["zero_missing"]).astype(bool)
+        self.value = np.concatenate(columns["value"]).astype(np.float64)
+        self.roots = np.array(roots, dtype=np.intp)
+        # Which output each tree adds to
+        self.tree_outputs = np.zeros((len(roots), len(trees)))
+        self.tree_outputs[np.arange(len(roots)), [output for _, _, output in packed_trees]] = 1.0
+        self.base = np.array(base, dtype=np.float64)
+        self.n_features_in_ = n_features
+        # sklearn trees and XGBoost compare float32 features
+        self.float32 = float32
+        self.has_missing = bool(self.zero_missing.any())
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float32 if self.float32 else np.float64).astype(np.float64, copy=False)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f"Expected input with {self.n_features_in_} features, got shape {X.shape}")
+        X = np.ascontiguousarray(X)
+        flat = X.ravel()
+        row_offsets = (np.arange(len(X)) * X.shape[1])[:, None]
+        node = np.repeat(self.roots[None, :], len(X), axis=0)
+        check_missing = self.has_missing or np.isnan(flat).any()
+        for n_active in self.n_active:
+            active = node[:, :n_active]
+            x = flat.take(row_offsets + self.feature.take(active))
+            go_right = x > self.threshold.take(active)
+            if check_missing:
+                missing = np.isnan(x)
+                if self.has_missing:
+                    missing |= self.zero_missing.take(active) & (np.abs(x) <= 1e-35)
+                go_right = np.where(missing, ~self.default_left.take(active), go_right)
+            node[:, :n_active] = self.left.take(active) + go_right
+        return self.value.take(node) @ self.tree_outputs + self.base
+
+
+# Renumber a tree breadth-first with siblings adjacent; returns the packed
+# node arrays and the depth of the tree
+def _pack(tree):
+    left, right = tree["left"], tree["right"]
+    order, first_child, depth = [0], {}, {0: 0}
+    i = 0
+    while i < len(order):
+        node = order[i]
+        if left[node] != node:
+            first_child[node] = len(order)
+            order += [left[node], right[node]]
+            depth[left[node]] = depth[right[node]] = depth[node] + 1
+        i += 1
+    packed = {name: tree[name][order] for name in ("feature", "threshold", "default_left", "zero_missing", "value")}
+    packed["left"] = np.array([first_child.get(node, i) for i, node in enumerate(order)])
+    return packed, max(depth.values())
+
+
+def _tree(feature, threshold, left, right, default_left, value, zero_missing=None):
+    n = len(feature)
+    is_leaf = np.asarray(left) == np.arange(n)
+    return {
+        "feature": np.asarray(feature), "threshold": np.asarray(threshold, dtype=np.float64),
+        "left": np.asarray(left), "right": np.asarray(right),
+        "default_left": np.asarray(default_left, dtype=bool) | is_leaf, "value": np.asarray(value, dtype=np.float64),
+        "zero_missing": np.zeros(n, dtype=bool) if zero_missing is None else np.asarray(zero_missing, dtype=bool),
+    }
+
+
+# sklearn DecisionTreeRegressor.tree_, scaled by `scale`
+def _sklearn_tree(tree, scale):
+    is_leaf = tree.children_left == -1
+    own = np.arange(tree.node_count)
+    missing_left = getattr(tree, "missing_go_to_left", np.zeros(tree.node_count, dtype=np.uint8))
+    return _tree(
+        feature=np.where(is_leaf, 0, tree.feature),
+        threshold=np.where(is_leaf, np.inf, tree.threshold),
+        left=np.where(is_leaf, own, tree.children_left),
+        right=np.where(is_leaf, own, tree.children_right),
+        default_left=missing_left,
+        value=np.where(is_leaf, tree.value[:, 0, 0] * scale, 0.0),
+    )
+
+
+def _hist_tree(nodes):
+    if nodes["is_categorical"].any():
+        raise NotImplementedError("Categorical splits are not supported")
+    is_leaf = nodes["is_leaf"].astype(bool)
+    own = np.arange(len(nodes))
+    return _tree(
+        feature=np.where(is_leaf, 0, nodes["feature_idx"]),
+        threshold=np.where(is_leaf, np.inf, nodes["num_threshold"]),
+        left=np.where(is_leaf, own, nodes["left"]),
+        right=np.where(is_leaf, own, nodes["right"]),
+        default_left=nodes["missing_go_to_left"],
+        value=np.where(is_leaf, nodes["value"], 0.0),
+    )
+
+
+def _lightgbm_tree(structure):
+    feature, threshold, left, right, default_left, zero_missing, value = [], [], [], [], [], [], []
+
+    def add(node):
+        i = len(feature)
+        for column in (feature, threshold, left, right, default_left, zero_missing, value):
+            column.append(None)
+        if "leaf_value" in node:
+            feature[i], threshold[i], left[i], right[i] = 0, np.inf, i, i
+            default_left[i], zero_missing[i], value[i] = True, False, node["leaf_value"]
+            return i
+        if node["decision_type"] != "<=":
+            raise NotImplementedError("Categorical splits are not supported")
+        feature[i], threshold[i], value[i] = node["split_feature"], node["threshold"], 0.0
+        if node["missing_type"] == "None":
+            # LightGBM treats NaN as 0.0 when no missing values were seen
+            default_left[i], zero_missing[i] = 0.0 <= node["threshold"], False
+        else:
+            default_left[i], zero_missing[i] = node["default_left"], node["missing_type"] == "Zero"
+        left[i] = add(node["left_child"])
+        right[i] = add(node["right_child"])
+        return i
+
+    add(structure)
+    return _tree(feature, threshold, left, right, default_left, value, zero_missing)
+
+
+def _xgboost_tree(tree):
+    left = np.array(tree["left_children"])
+    right = np.array(tree["right_children"])
+    conditions = np.array(tree["split_conditions"], dtype=np.float32)
+    is_leaf = left == -1
+    own = np.arange(len(left))
+    # XGBoost goes left on x < split with float32 values, which for float32
+    # inputs is x <= the next float32 below the split
+    below = np.nextafter(conditions, np.float32(-np.inf))
+    return _tree(
+        feature=np.where(is_leaf, 0, tree["split_indices"]),
+        threshold=np.where(is_leaf, np.inf, below.astype(np.float64)),
+        left=np.where(is_leaf, own, left),
+        right=np.where(is_leaf, own, right),
+        default_left=np.array(tree["default_left"], dtype=bool),
+        value=np.where(is_leaf, conditions.astype(np.float64), 0.0),
+    )
+
+
+# (base, trees, float32) for one single-output regressor
+def _compile_estimator(est):
+    name = type(est).__name__
+    n_features = est.n_features_in_
+    if name == "GradientBoostingRegressor":
+        base = est._raw_predict_init(np.zeros((1, n_features), dtype=np.float32))[0, 0]
+        trees = [_sklearn_tree(e.tree_, est.learning_rate) for e in est.estimators_[:, 0]]
+        return base, trees, True
+    if name in ("RandomForestRegressor", "ExtraTreesRegressor"):
+        trees = [_sklearn_tree(e.tree_, 1.0 / len(est.estimators_)) for e in est.estimators_]
+        return 0.0, trees, True
+    if name in ("DecisionTreeRegressor", "ExtraTreeRegressor"):
+        return 0.0, [_sklearn_tree(est.tree_, 1.0)], True
+    if name == "HistGradientBoostingRegressor":
+        if type(est._loss.link).__name__ != "IdentityLink":
+            raise NotImplementedError(f"Loss {est.loss!r} is not supported")
+        if getattr(est, "_preprocessor", None) is not None:
+            raise NotImplementedError("Categorical features are not supported")
+        trees = [_hist_tree(predictors[0].nodes) for predictors in est._predictors]
+        return est._baseline_prediction[0][0], trees, False
+    if name == "LGBMRegressor":
+        model = est.booster_.dump_model()
+        if model["num_tree_per_iteration"] != 1 or not model["objective"].startswith(
+                ("regression", "huber", "fair", "quantile")):
+            raise NotImplementedError(f"Objective {model['objective']!r} is not supported")
+        return 0.0, [_lightgbm_tree(info["tree_structure"]) for info in model["tree_info"]], False
+    if name == "XGBRegressor":
+        model = json.loads(est.get_booster().save_raw("json"))["learner"]
+        if not model["objective"]["name"].startswith("reg:squared"):
+            raise NotImplementedError(f"Objective {model['objective']['name']!r} is not supported")
+        base = float(model["learner_model_param"]["base_score"].strip("[]"))
+        trees = [_xgboost_tree(tree) for tree in model["gradient_booster"]["model"]["trees"]]
+        return base, trees, True
+    raise NotImplementedError(f"Cannot compile {name}")
+
+
+def compile_model(model):
+    estimators = model.estimators_ if type(model).__name__ == "MultiOutputRegressor" else [model]
+    compiled = [_compile_estimator(est) for est in estimators]
+    float32 = {f32 for _, _, f32 in compiled}
+    if len(float32) != 1:
+        raise NotImplementedError("Outputs mix estimators with different input precision")
+    return CompiledEnsemble([(base, trees) for base, trees, _ in compiled], model.n_features_in_, float32.pop())
+
+
+# Largest absolute difference between the compiled and original predictions
+# on `n` random rows in the (standardized) model input space
+def check_parity(model, compiled, n=2000, seed=0):
+    X = np.random.RandomState(seed).normal(size=(n, model.n_features_in_)) * 2
+    expected = np.asarray(model.predict(X)).reshape(n, -1)
+    single = np.vstack([compiled.predict(X[i:i + 1]) for i in range(min(n, 50))])
+    return max(np.abs(compiled.predict(X) - expected).max(), np.abs(single - expected[:len(single)]).max())
+
+
+def compile_registry(manifest_path=MANIFEST_PATH, targets=None, tolerance=1e-5):
+    registry = ModelRegistry(manifest_path, mmap_mode=None)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    for target in targets or registry.targets():
+        try:
+            model = registry.model(target)
+            compiled = compile_model(model)
+        except (NotImplementedError, FileNotFoundError) as e:
+            print(f"Skipping {target}: {e}")
+            continue
+        error = check_parity(model, compiled)
+        if error > tolerance:
+            raise ValueError(f"Compiled {target} model differs from the original by {error}")
+        path = f"Models/compiled/{target}_model.joblib"
+        os.makedirs(os.path.join(registry.root, "Models/compiled"), exist_ok=True)
+        joblib.dump(compiled, os.path.join(registry.root, path))
+        manifest["models"][target]["compiled"] = path
+        print(f"Compiled {target}: {len(compiled.roots)} trees, {len(compiled.feature)} nodes, "
+              f"max error {error:.2e}")
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+        f.write("\n")
+
+
+def verify_registry(manifest_path=MANIFEST_PATH, targets=None, tolerance=1e-5):
+    registry = ModelRegistry(manifest_path)
+    ok = True
+    for target in targets or registry.targets():
+        compiled = registry.compiled(target)
+        if compiled is None:
+            continue
+        error = check_parity(registry.model(target), compiled)
+        ok &= error <= tolerance
+        print(f"{target}: max error {error:.2e} {'ok' if error <= tolerance else 'FAILED'}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile tree-ensemble models into flat arrays")
+    parser.add_argument("command", choices=["compile", "verify"])
+    parser.add_argument("targets", nargs="*", help="targets from the manifest (all by default)")
+    parser.add_argument("--manifest", default=MANIFEST_PATH)
+    parser.add_argument("--tolerance", type=float, default=1e-5)
+    args = parser.parse_args()
+    # Go through the importable module so pickles refer to
+    # tree_compiler.CompiledEnsemble rather than __main__
+    import tree_compiler
+    if args.command == "compile":
+        tree_compiler.compile_registry(args.manifest, args.targets, args.tolerance)
+    elif not tree_compiler.verify_registry(args.manifest, args.targets, args.tolerance):
+        sys.exit(1)